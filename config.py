@@ -22,3 +22,145 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
 LOGGING_LEVEL = logging.INFO
+
+# Wishlist name autocomplete
+AUTOCOMPLETE_LIMIT = int(os.getenv("AUTOCOMPLETE_LIMIT", "10"))
+AUTOCOMPLETE_MAX_LIMIT = int(os.getenv("AUTOCOMPLETE_MAX_LIMIT", "50"))
+
+# Most wishlisted products report
+STATS_PRODUCTS_LIMIT = int(os.getenv("STATS_PRODUCTS_LIMIT", "10"))
+STATS_PRODUCTS_MAX_LIMIT = int(os.getenv("STATS_PRODUCTS_MAX_LIMIT", "100"))
+
+# Pages of wishlists holding a product
+PRODUCT_WISHLISTS_LIMIT = int(os.getenv("PRODUCT_WISHLISTS_LIMIT", "100"))
+PRODUCT_WISHLISTS_MAX_LIMIT = int(os.getenv("PRODUCT_WISHLISTS_MAX_LIMIT", "1000"))
+
+# Largest page of GET /wishlists?limit=...
+WISHLISTS_MAX_LIMIT = int(os.getenv("WISHLISTS_MAX_LIMIT", "1000"))
+
+# Largest number of wishlists fetched by one multi-get request
+MULTIGET_MAX_IDS = int(os.getenv("MULTIGET_MAX_IDS", "1000"))
+
+# Most wishlists changed per transaction by the bulk user operations
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# Stats: the wishlist and item totals are each spread over
+# STATS_TOTAL_STRIPES rows so that concurrent writers rarely share one
+STATS_TOTAL_STRIPES = int(os.getenv("STATS_TOTAL_STRIPES", "8"))
+
+# Group commit of item additions: concurrent adds arriving within
+# GROUP_COMMIT_MAX_DELAY_MS share one transaction of up to
+# GROUP_COMMIT_MAX_BATCH items (needs a threaded worker to matter)
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+GROUP_COMMIT_MAX_DELAY_MS = int(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "5"))
+
+# Idempotency-Key responses are stored in the database for
+# IDEMPOTENCY_TTL seconds; a request that has not finished after
+# IDEMPOTENCY_CLAIM_TIMEOUT seconds is taken to have died and a retry
+# runs again
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CLAIM_TIMEOUT = int(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT", "60"))
+
+# Threads of the gunicorn worker (gunicorn.conf.py and the Procfile read
+# the same variable); the admission and change stream limits below are
+# sized from it so that a thread is always left to turn requests away
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "16"))
+
+# Admission control: token buckets per client IP and per user (X-User-Id
+# header or user_id argument, sent by the client so only advisory), and a
+# cap on requests running at once. Behind a proxy the client IP is taken
+# from X-Forwarded-For, trusting TRUSTED_PROXY_HOPS proxies (the Cloud
+# Foundry router is one; 0 uses the address of the connection)
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+ADMISSION_IP_RATE = float(os.getenv("ADMISSION_IP_RATE", "50"))
+ADMISSION_IP_BURST = int(os.getenv("ADMISSION_IP_BURST", "100"))
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "20"))
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "40"))
+ADMISSION_MAX_KEYS = int(os.getenv("ADMISSION_MAX_KEYS", "10000"))
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT",
+                                         str(max(1, GUNICORN_THREADS // 4))))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE",
+                                    str(GUNICORN_THREADS // 8)))
+ADMISSION_QUEUE_TIMEOUT_MS = int(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "100"))
+ADMISSION_EXEMPT_PATHS = ["/metrics"]
+
+# Request deadlines in milliseconds, also used as the database statement
+# timeout; ROUTE_DEADLINES_MS overrides the default per endpoint name,
+# e.g. '{"autocomplete_resource": 500}', and 0 means no deadline
+REQUEST_DEADLINE_MS = int(os.getenv("REQUEST_DEADLINE_MS", "5000"))
+ROUTE_DEADLINES_MS = json.loads(os.getenv("ROUTE_DEADLINES_MS", json.dumps({
+    "autocomplete_resource": 500,
+    "explain_resource": 10000,
+    "user_wishlists_resource": 30000,
+    "user_enable_resource": 30000,
+    "user_disable_resource": 30000,
+    "change_collection": 35000,
+    "change_stream_resource": 0,
+})))
+
+# Change feed: events per page, the longest a long-poll waits in seconds,
+# how often waiting readers look for commits of other processes, and how
+# many days events are kept by the prune-changes command
+CHANGES_LIMIT = int(os.getenv("CHANGES_LIMIT", "100"))
+CHANGES_MAX_LIMIT = int(os.getenv("CHANGES_MAX_LIMIT", "1000"))
+CHANGES_MAX_WAIT = int(os.getenv("CHANGES_MAX_WAIT", "30"))
+CHANGES_POLL_INTERVAL_MS = int(os.getenv("CHANGES_POLL_INTERVAL_MS", "500"))
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", "7"))
+
+# Server-Sent Event streams of changes end after CHANGES_STREAM_SECONDS
+# (browsers reconnect and resume) and send a keepalive comment every
+# CHANGES_HEARTBEAT_SECONDS without changes
+CHANGES_STREAM_SECONDS = int(os.getenv("CHANGES_STREAM_SECONDS", "300"))
+CHANGES_HEARTBEAT_SECONDS = int(os.getenv("CHANGES_HEARTBEAT_SECONDS", "15"))
+
+# Most change streams and long polls waiting at once in a process; each
+# holds one of the gunicorn threads, so keep it together with
+# ADMISSION_MAX_CONCURRENT and ADMISSION_MAX_QUEUE below GUNICORN_THREADS
+CHANGES_MAX_WAITERS = int(os.getenv("CHANGES_MAX_WAITERS",
+                                    str(max(1, GUNICORN_THREADS // 2))))
+
+# Bulk exports: where admin export jobs write their files, the most rows
+# held in memory at once and the most finished jobs remembered
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "10000"))
+EXPORT_MAX_JOBS = int(os.getenv("EXPORT_MAX_JOBS", "100"))
+
+# The admin API needs an "Authorization: Bearer ADMIN_TOKEN" header and is
+# off when ADMIN_TOKEN is not set; the flask commands work either way
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Analytics snapshot: the most seconds between refreshes from the change
+# feed, the most changes applied incrementally before a full reload, and
+# the page sizes of its top lists
+ANALYTICS_MAX_AGE = int(os.getenv("ANALYTICS_MAX_AGE", "10"))
+ANALYTICS_MAX_DELTA = int(os.getenv("ANALYTICS_MAX_DELTA", "10000"))
+ANALYTICS_LIMIT = int(os.getenv("ANALYTICS_LIMIT", "10"))
+ANALYTICS_MAX_LIMIT = int(os.getenv("ANALYTICS_MAX_LIMIT", "1000"))
+
+# The archive-wishlists command moves disabled wishlists and wishlists not
+# updated for ARCHIVE_AFTER_DAYS out of the hot tables
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "730"))
+
+# Horizontal sharding by user_id: DATABASE_URI is shard 0 and holds the
+# user to shard directory, SHARD_URIS lists the other shards as a JSON
+# array. The wishlist, item and change ids of shard k start at
+# k * SHARD_ID_SPACE, which must keep them below 2**31 on Postgres
+SHARD_URIS = json.loads(os.getenv("SHARD_URIS", "[]"))
+SHARD_ID_SPACE = int(os.getenv("SHARD_ID_SPACE", "100000000"))
+
+# Product catalog: item responses read product names through an in-process
+# cache of at most PRODUCT_NAMES_CACHE_SIZE names, each kept for
+# PRODUCT_NAMES_CACHE_TTL seconds so renames by other processes show up
+PRODUCT_NAMES_CACHE_SIZE = int(os.getenv("PRODUCT_NAMES_CACHE_SIZE", "10000"))
+PRODUCT_NAMES_CACHE_TTL = int(os.getenv("PRODUCT_NAMES_CACHE_TTL", "60"))
+
+# Items are ordered by fractional ranks; a move that makes a rank longer
+# than POSITION_REBALANCE_LENGTH spreads the wishlist's ranks in the
+# background
+POSITION_REBALANCE_LENGTH = int(os.getenv("POSITION_REBALANCE_LENGTH", "16"))
+
+# The UI files are served under content-hashed names and may be cached by
+# browsers for ASSETS_MAX_AGE seconds (one year) without revalidation
+ASSETS_MAX_AGE = int(os.getenv("ASSETS_MAX_AGE", "31536000"))
@@ -3,4 +3,7 @@ import os
 PORT = os.getenv("PORT", "5000")
 bind = "0.0.0.0:" + PORT
 workers = 1
+# the threads of the worker serve requests while change streams wait
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
 log_level = "info"
@@ -48,5 +48,6 @@ app.logger.info("  WISHLISTS  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 service.init_db()  # make our sqlalchemy tables
+service.api_spec.build()  # render swagger.json once, now every route is in
 
 app.logger.info("Service initialized!")
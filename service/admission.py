@@ -0,0 +1,216 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Admission Control
+
+Decides before any work is done whether a request may run. Every client IP
+and every user (the X-User-Id header or user_id query argument) draws from
+its own token bucket, and a global limit caps the requests running at once
+with a short wait queue behind it. A request takes a token from both of its
+buckets or from neither. Requests over a rate are answered with 429 and
+requests that find the service saturated with 503, both with a Retry-After
+header, without touching the database. Behind a proxy, such as the Cloud
+Foundry router, the client IP comes from the X-Forwarded-For header
+entries added by the TRUSTED_PROXY_HOPS proxies.
+
+The service does not authenticate users, so the user key is whatever the
+client sends: the user buckets are advisory, keeping honest clients of one
+user from crowding out others, and the IP buckets are what bounds a client
+that sends a different user id on every request. A client can also drain
+another user's bucket by sending their id; key the user buckets on an
+authenticated identity once there is one.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, jsonify
+from flask_api import status
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+
+class RateLimiter():
+    """
+    Token buckets keyed by client
+
+    :param rate: tokens added per second to each bucket
+    :param burst: the most tokens a bucket holds
+    :param max_keys: the most buckets kept, the least recently used bucket
+        is dropped first (it comes back full)
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Takes a token from the bucket of key
+
+        :return: 0 when a token was taken, otherwise the seconds until the
+            bucket has one again
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def refund(self, key):
+        """ Puts back a token taken for a request that was not let through """
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(self.burst, tokens + 1), updated)
+
+
+class ConcurrencyLimiter():
+    """
+    Caps the number of requests running at the same time
+
+    :param limit: the most requests running at once
+    :param max_queue: the most requests waiting for a slot
+    :param timeout: the longest a request waits for a slot, in seconds
+    """
+
+    def __init__(self, limit: int, max_queue: int, timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Returns True once a slot is taken, False if none came in time """
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            if self.running >= self.limit and self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                while self.running >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            return True
+
+    def release(self):
+        """ Frees the slot of a finished request """
+        with self._condition:
+            self.running -= 1
+            self._condition.notify()
+
+
+class AdmissionControl():
+    """ Admits, throttles or sheds the requests of a Flask app """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ip_limiter = None
+        self.user_limiter = None
+        self.concurrency = None
+        self.counters = {"admitted": 0, "rate_limited": 0, "shed": 0}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Sets up the limiters from the app config and hooks the app """
+        config = app.config
+        self.app = app
+        self.ip_limiter = RateLimiter(config["ADMISSION_IP_RATE"],
+                                      config["ADMISSION_IP_BURST"],
+                                      config["ADMISSION_MAX_KEYS"])
+        self.user_limiter = RateLimiter(config["ADMISSION_USER_RATE"],
+                                        config["ADMISSION_USER_BURST"],
+                                        config["ADMISSION_MAX_KEYS"])
+        self.concurrency = ConcurrencyLimiter(
+            config["ADMISSION_MAX_CONCURRENT"],
+            config["ADMISSION_MAX_QUEUE"],
+            config["ADMISSION_QUEUE_TIMEOUT_MS"] / 1000)
+        if config["TRUSTED_PROXY_HOPS"]:
+            # the buckets are keyed by the client, not by the proxy in front
+            app.wsgi_app = ProxyFix(app.wsgi_app,
+                                    x_for=config["TRUSTED_PROXY_HOPS"])
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def metrics(self):
+        """ Returns the admission counters for monitoring """
+        with self._lock:
+            metrics = dict(self.counters)
+        metrics["running"] = self.concurrency.running
+        metrics["waiting"] = self.concurrency.waiting
+        return metrics
+
+    def admit(self):
+        """ Runs before each request and answers it if it is not admitted """
+        if not self.app.config["ADMISSION_ENABLED"] \
+                or request.path in self.app.config["ADMISSION_EXEMPT_PATHS"]:
+            return None
+        wait = self.ip_limiter.acquire(request.remote_addr)
+        user_id = request.headers.get("X-User-Id") or request.args.get("user_id")
+        if not wait and user_id:
+            wait = self.user_limiter.acquire(user_id)
+            if wait:
+                # the IP only pays for requests that both buckets let through
+                self.ip_limiter.refund(request.remote_addr)
+        if wait:
+            self._count("rate_limited")
+            return self._reject(status.HTTP_429_TOO_MANY_REQUESTS,
+                                "Too Many Requests",
+                                "Request rate limit exceeded", wait)
+        if not self.concurrency.acquire():
+            self._count("shed")
+            return self._reject(status.HTTP_503_SERVICE_UNAVAILABLE,
+                                "Service Unavailable",
+                                "The service is at capacity", 1)
+        g.admitted = True
+        self._count("admitted")
+        return None
+
+    def release(self, exception=None):
+        """ Runs after each request and frees its concurrency slot """
+        # pylint: disable=unused-argument
+        if g.pop("admitted", False):
+            self.concurrency.release()
+
+    def _count(self, counter):
+        """ Increments one of the counters """
+        with self._lock:
+            self.counters[counter] += 1
+
+    @staticmethod
+    def _reject(code, error, message, retry_after):
+        """ Builds a rejection in the same form as the other errors """
+        response = jsonify(status=code, error=error, message=message)
+        response.status_code = code
+        response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+        return response
@@ -0,0 +1,283 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Columnar Analytics
+
+Keeps the wishlist and item tables in memory as NumPy column arrays sorted
+by id and answers aggregate queries over them with vectorized operations
+instead of ORM scans. The snapshot is refreshed from the change feed: only
+the wishlists and items changed since the last refresh are read again, and
+the whole snapshot is reloaded when too much changed. Every shard is
+read. NumPy is an optional dependency.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from service.models import db, Wishlist, Item
+from service.sharding import ShardRouter
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+logger = logging.getLogger("flask.app")
+
+# the column arrays of one snapshot, each table sorted by its id
+Columns = namedtuple("Columns", ["wishlist_id", "user_id", "status",
+                                 "item_id", "item_wishlist_id", "product_id"])
+
+# stay below the bound parameter limit of sqlite
+CHUNK_SIZE = 500
+
+
+class AnalyticsSnapshot():
+    """
+    An in-memory columnar copy of the wishlists and items
+
+    :param max_age: how old the snapshot may get before a query refreshes
+        it, in seconds
+    :param max_delta: the most changes applied incrementally, more than
+        that reloads the whole snapshot
+    :param shards: the shards to read, the default database when None
+    """
+
+    def __init__(self, max_age: float, max_delta: int,
+                 shards: ShardRouter = None):
+        self.max_age = max_age
+        self.max_delta = max_delta
+        self.shards = shards or ShardRouter()
+        self.columns = None
+        self.cursor = [0]
+        self.refreshed = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        """ Returns True when NumPy is installed """
+        return numpy is not None
+
+    def current(self):
+        """ Returns the columns, refreshing them first if they are too old """
+        with self._lock:
+            if self.refreshed is None or \
+                    time.monotonic() - self.refreshed >= self.max_age:
+                self.refresh()
+            return self.columns
+
+    def refresh(self):
+        """ Brings the snapshot up to date with the change feed """
+        if self.columns is None:
+            self.load()
+            return
+        changes = self.shards.changes_since(self.cursor, self.max_delta + 1)
+        if len(changes) > self.max_delta:
+            self.load()
+            return
+        if changes:
+            self._apply(changes)
+            self.cursor = self.shards.parse_cursor(changes[-1]["cursor"])
+        self.refreshed = time.monotonic()
+
+    def load(self):
+        """ Reads the whole snapshot """
+        logger.info("Loading analytics snapshot")
+        # changes after this cursor are applied again later, which is safe
+        # because applying a change rereads the current rows
+        self.cursor = self.shards.latest_cursor()
+
+        def read():
+            wishlists = db.session.query(Wishlist.id, Wishlist.user_id,
+                                         Wishlist.status).all()
+            items = db.session.query(Item.id, Item.wishlist_id,
+                                     Item.product_id).all()
+            db.session.commit()
+            return wishlists, items
+
+        shard_rows = self.shards.every(read)
+        wishlists = sorted(row for rows, _ in shard_rows for row in rows)
+        items = sorted(row for _, rows in shard_rows for row in rows)
+        self.columns = _without_orphans(Columns(
+            *(_wishlist_arrays(wishlists) + _item_arrays(items))))
+        self.refreshed = time.monotonic()
+
+    def _apply(self, changes):
+        """ Rereads the wishlists and items that changed """
+        logger.info("Applying %d changes to analytics snapshot", len(changes))
+        columns = self.columns
+        wishlist_ids = sorted({change["id"] for change in changes
+                               if change["entity"] == "wishlist"})
+        deleted_ids = [change["id"] for change in changes
+                       if change["entity"] == "wishlist"
+                       and change["op"] == "deleted"]
+        item_ids = sorted({change["id"] for change in changes
+                           if change["entity"] == "item"})
+        keep_wishlists = ~numpy.isin(columns.wishlist_id, wishlist_ids)
+        # items deleted by cascade with their wishlist have no events
+        keep_items = ~(numpy.isin(columns.item_id, item_ids) |
+                       numpy.isin(columns.item_wishlist_id, deleted_ids))
+
+        def read():
+            wishlists = _read_chunks(
+                lambda chunk: db.session.query(
+                    Wishlist.id, Wishlist.user_id, Wishlist.status)
+                .filter(Wishlist.id.in_(chunk)), wishlist_ids)
+            items = _read_chunks(
+                lambda chunk: db.session.query(
+                    Item.id, Item.wishlist_id, Item.product_id)
+                .filter(Item.id.in_(chunk)), item_ids)
+            db.session.commit()
+            return wishlists, items
+
+        shard_rows = self.shards.every(read)
+        wishlists = [row for rows, _ in shard_rows for row in rows]
+        items = [row for _, rows in shard_rows for row in rows]
+        fresh = _wishlist_arrays(wishlists) + _item_arrays(items)
+        kept = [column[keep_wishlists] for column in columns[:3]] + \
+            [column[keep_items] for column in columns[3:]]
+        merged = [numpy.concatenate([old, new]) for old, new in zip(kept, fresh)]
+        wishlist_order = numpy.argsort(merged[0], kind="stable")
+        item_order = numpy.argsort(merged[3], kind="stable")
+        self.columns = _without_orphans(Columns(
+            *([column[wishlist_order] for column in merged[:3]] +
+              [column[item_order] for column in merged[3:]])))
+
+    ##################################################
+    # QUERIES
+    ##################################################
+
+    def summary(self):
+        """ Returns the size and freshness of the snapshot """
+        columns = self.current()
+        return {
+            "wishlists": int(columns.wishlist_id.size),
+            "items": int(columns.item_id.size),
+            "users": int(numpy.unique(columns.user_id).size),
+            "products": int(numpy.unique(columns.product_id).size),
+            "cursor": self.shards.format_cursor(self.cursor)
+        }
+
+    def item_count_histogram(self, status: bool = None):
+        """Returns how many wishlists hold each number of items
+
+        :param status: only count enabled (True) or disabled (False)
+            wishlists when given
+
+        :return: the item counts held by at least one wishlist, ascending
+        :rtype: list
+        """
+        columns = self.current()
+        counts = numpy.bincount(_wishlist_positions(columns),
+                                minlength=columns.wishlist_id.size)
+        if status is not None:
+            counts = counts[columns.status == status]
+        histogram = numpy.bincount(counts)
+        return [{"items": int(items), "wishlists": int(histogram[items])}
+                for items in numpy.flatnonzero(histogram)]
+
+    def top_products(self, limit: int, min_user_id: int = None,
+                     max_user_id: int = None, status: bool = None):
+        """Returns the products in the most items of a cohort of users
+
+        :param limit: the most products to return
+        :param min_user_id: the lowest user id of the cohort
+        :param max_user_id: the highest user id of the cohort
+        :param status: only count enabled (True) or disabled (False)
+            wishlists when given
+
+        :return: the products and their item counts, most items first
+        :rtype: list
+        """
+        columns = self.current()
+        positions = _wishlist_positions(columns)
+        mask = numpy.ones(columns.item_id.size, dtype=bool)
+        if min_user_id is not None:
+            mask &= columns.user_id[positions] >= min_user_id
+        if max_user_id is not None:
+            mask &= columns.user_id[positions] <= max_user_id
+        if status is not None:
+            mask &= columns.status[positions] == status
+        products, counts = numpy.unique(columns.product_id[mask],
+                                        return_counts=True)
+        return _top(products, counts, limit, "product_id")
+
+    def top_users(self, limit: int):
+        """Returns the users with the most items across their wishlists
+
+        :param limit: the most users to return
+
+        :return: the users, their wishlist and item counts, most items first
+        :rtype: list
+        """
+        columns = self.current()
+        users, user_index, wishlists = numpy.unique(
+            columns.user_id, return_inverse=True, return_counts=True)
+        items = numpy.bincount(user_index[_wishlist_positions(columns)],
+                               minlength=users.size)
+        top = _top(users, items, limit, "user_id")
+        for entry in top:
+            entry["wishlists"] = int(wishlists[numpy.searchsorted(
+                users, entry["user_id"])])
+        return top
+
+
+def _without_orphans(columns):
+    """ Drops items whose wishlist was written after the wishlists were read """
+    # their events come after the cursor and bring them back with it
+    known = numpy.isin(columns.item_wishlist_id, columns.wishlist_id)
+    if known.all():
+        return columns
+    return columns._replace(item_id=columns.item_id[known],
+                            item_wishlist_id=columns.item_wishlist_id[known],
+                            product_id=columns.product_id[known])
+
+
+def _wishlist_positions(columns):
+    """ Returns the index of each item's wishlist in the wishlist columns """
+    return numpy.searchsorted(columns.wishlist_id, columns.item_wishlist_id)
+
+
+def _top(keys, counts, limit, key_name):
+    """ Returns the keys with the highest counts, ties by ascending key """
+    if keys.size > limit:
+        # only the limit largest counts need sorting
+        threshold = numpy.partition(counts, keys.size - limit)[keys.size - limit]
+        chosen = counts >= threshold
+        keys, counts = keys[chosen], counts[chosen]
+    order = numpy.lexsort((keys, -counts))[:limit]
+    return [{key_name: int(keys[index]), "items": int(counts[index])}
+            for index in order]
+
+
+def _read_chunks(query, ids):
+    """ Runs query for each chunk of ids and returns all of the rows """
+    rows = []
+    for start in range(0, len(ids), CHUNK_SIZE):
+        rows.extend(query(ids[start:start + CHUNK_SIZE]))
+    return rows
+
+
+def _wishlist_arrays(rows):
+    """ Returns the id, user_id and status arrays of wishlist rows """
+    return [numpy.array([row[0] for row in rows], dtype=numpy.int64),
+            numpy.array([row[1] for row in rows], dtype=numpy.int64),
+            numpy.array([row[2] for row in rows], dtype=bool)]
+
+
+def _item_arrays(rows):
+    """ Returns the id, wishlist_id and product_id arrays of item rows """
+    return [numpy.array([row[index] for row in rows], dtype=numpy.int64)
+            for index in range(3)]
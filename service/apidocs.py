@@ -0,0 +1,109 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+API Documentation
+
+flask_restplus serves the Swagger document behind /apidocs/index.html by
+serializing it again on every request for swagger.json. The document only
+changes with the code, so it is built once at startup and kept in memory as
+compact JSON and gzip bytes, each with its own ETag. Clients that already
+have it get a 304, and the others get the gzip bytes when they accept them.
+check() compares the document with the routes of the app, so a resource
+that is not documented, or documented but gone, is caught by the tests.
+"""
+import gzip
+import hashlib
+import json
+import threading
+from flask import Response, request
+from flask_restplus.swagger import Swagger, extract_path
+
+# methods every route answers that the document does not list
+IMPLICIT_METHODS = {"HEAD", "OPTIONS"}
+
+
+class ApiSpec():
+    """ Serves the Swagger document of an Api from precomputed bytes """
+
+    def __init__(self, app=None, api=None):
+        self.app = None
+        self.api = None
+        self.schema = None
+        self.body = None
+        self.compressed = None
+        self.etag = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, api)
+
+    def init_app(self, app, api):
+        """ Takes over the swagger.json route of the Api """
+        self.app = app
+        self.api = api
+        app.view_functions[api.endpoint("specs")] = self.send
+
+    def build(self):
+        """ Renders, serializes and compresses the document once """
+        with self.app.test_request_context():
+            schema = Swagger(self.api).as_dict()
+        body = json.dumps(schema, separators=(",", ":"),
+                          sort_keys=True).encode("utf-8")
+        with self._lock:
+            self.schema = schema
+            self.body = body
+            self.compressed = gzip.compress(body, 9)
+            self.etag = hashlib.sha256(body).hexdigest()
+        self.app.logger.info("Built the API document: %d bytes, %d gzipped",
+                             len(self.body), len(self.compressed))
+
+    def check(self):
+        """Compares the document with the routes of the Api
+
+        :return: one message per path whose methods differ
+        :rtype: list
+
+        """
+        if self.schema is None:
+            self.build()
+        documented = {
+            path: {method.upper() for method in operations
+                   if method != "parameters"}
+            for path, operations in self.schema["paths"].items()}
+        routed = {}
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint in self.api.endpoints and \
+                    rule.endpoint != self.api.endpoint("specs"):
+                routed.setdefault(extract_path(rule.rule), set()).update(
+                    rule.methods - IMPLICIT_METHODS)
+        return ["{} is routed for {} but documented for {}".format(
+            path, sorted(routed.get(path, ())),
+            sorted(documented.get(path, ())))
+                for path in sorted(set(documented) | set(routed))
+                if documented.get(path) != routed.get(path)]
+
+    def send(self):
+        """ Sends the document, gzipped if accepted, or 304 if unchanged """
+        if self.body is None:
+            self.build()
+        compress = "gzip" in request.accept_encodings
+        response = Response(self.compressed if compress else self.body,
+                            mimetype="application/json")
+        # the two encodings are different bytes, so they get their own tags
+        response.set_etag(self.etag + ("-gzip" if compress else ""))
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
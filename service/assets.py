@@ -0,0 +1,113 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Static Assets
+
+The stylesheets, scripts and images of the UI are served under names that
+carry a hash of their content, e.g. assets/js/rest_api.3f2a9c0d1e4b.js, so
+their responses can be cached by browsers forever: a changed file gets a new
+name. The manifest of names is built once at startup, when the HTML pages
+are also rewritten to point at the hashed names and kept in memory. Pages
+are revalidated on every visit with their ETag, which answers 304 when
+nothing changed, and the assets they name are then read from the cache
+without any request.
+"""
+import hashlib
+import os
+import re
+from flask import Response, abort, request, send_from_directory
+
+# characters of the SHA-256 hex digest kept in the hashed names
+DIGEST_LENGTH = 12
+
+# the static references of the pages: href="static/..." and src="static/..."
+STATIC_REFERENCE = re.compile(r'((?:href|src)\s*=\s*")static/([^"?#]+)"')
+
+
+class StaticAssets():
+    """ Serves the static files under content-hashed, immutable URLs """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.manifest = {}
+        self.files = {}
+        self.pages = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Builds the manifest and adds the route of the hashed files """
+        self.app = app
+        self.build()
+        app.add_url_rule("/assets/<path:filename>", "assets", self.send_asset)
+
+    def build(self):
+        """ Hashes every static file and rewrites the pages that use them """
+        folder = self.app.static_folder
+        self.manifest = {}
+        self.files = {}
+        self.pages = {}
+        for directory, _, names in os.walk(folder):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                if filename.endswith(".html"):
+                    continue
+                with open(path, "rb") as asset:
+                    digest = hashlib.sha256(asset.read()).hexdigest()
+                stem, extension = os.path.splitext(filename)
+                hashed = "{}.{}{}".format(stem, digest[:DIGEST_LENGTH],
+                                          extension)
+                self.manifest[filename] = hashed
+                self.files[hashed] = filename
+        for name in os.listdir(folder):
+            if name.endswith(".html"):
+                with open(os.path.join(folder, name), encoding="utf-8") as page:
+                    body = STATIC_REFERENCE.sub(self._rewrite, page.read())
+                body = body.encode("utf-8")
+                self.pages[name] = (body, hashlib.sha256(body).hexdigest())
+        self.app.logger.info("Hashed %d static assets for %d pages",
+                             len(self.manifest), len(self.pages))
+
+    def url(self, filename: str):
+        """ Returns the hashed URL of a static file, relative to the root """
+        hashed = self.manifest.get(filename)
+        return "static/" + filename if hashed is None else "assets/" + hashed
+
+    def _rewrite(self, match):
+        """ Points one static reference of a page at its hashed URL """
+        return '{}{}"'.format(match.group(1), self.url(match.group(2)))
+
+    def send_asset(self, filename):
+        """ Sends a static file by its hashed name, to be cached for good """
+        original = self.files.get(filename)
+        if original is None:
+            abort(404)
+        max_age = self.app.config["ASSETS_MAX_AGE"]
+        response = send_from_directory(self.app.static_folder, original,
+                                       cache_timeout=max_age)
+        response.headers["Cache-Control"] = \
+            "public, max-age={}, immutable".format(max_age)
+        return response
+
+    def send_page(self, name: str):
+        """ Sends a rewritten page, revalidated on every visit by its ETag """
+        if name not in self.pages:
+            abort(404)
+        body, etag = self.pages[name]
+        response = Response(body, mimetype="text/html")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
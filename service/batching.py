@@ -0,0 +1,184 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Group Commit
+
+Coalesces writes submitted by concurrent requests into shared transactions.
+A background thread collects the writes that arrive within a short window
+and hands them to a batch write function in one call, so a burst of
+requests pays for one commit instead of one each. Every request still
+waits for and receives its own result, but no longer than its deadline,
+and a request whose batch was lost with a dead thread is told at once.
+"""
+import logging
+import queue
+import threading
+import time
+from werkzeug.exceptions import ServiceUnavailable
+from service.deadlines import DeadlineExceeded
+
+logger = logging.getLogger("flask.app")
+
+# how often a waiting request checks that the committing thread is alive,
+# in seconds
+THREAD_CHECK_INTERVAL = 1.0
+
+
+class CommitterStopped(ServiceUnavailable):
+    """ Raised when the committing thread died during the batch of a write """
+    description = "The write may not have been committed, try again"
+
+    def get_headers(self, environ=None):
+        """ Asks the client to retry in a second """
+        return super().get_headers(environ) + [("Retry-After", "1")]
+
+
+class _PendingWrite():
+    """ A write waiting for its batch to be committed """
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.started = False
+        self.abandoned = False
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Claims the write for a batch, False if its request gave up """
+        with self._lock:
+            self.started = not self.abandoned
+            return self.started
+
+    def abandon(self):
+        """ Gives up on the write, True if no batch had claimed it yet """
+        with self._lock:
+            self.abandoned = not self.started
+            return self.abandoned
+
+    def resolve(self, result):
+        """ Hands the result back to the waiting request """
+        self.result = result
+        self.done.set()
+
+    def fail(self, error):
+        """ Hands an error back to the waiting request """
+        self.error = error
+        self.done.set()
+
+
+class GroupCommitter():
+    """
+    Batches writes from many threads into single transactions
+
+    :param app: the Flask app whose context the writes run in
+    :param write_batch: called with a list of writes, commits them in one
+        transaction and returns one result per write in the same order
+    :param max_batch: the most writes committed together
+    :param max_delay: the longest a write waits for others to join, in seconds
+    """
+
+    def __init__(self, app, write_batch, max_batch: int, max_delay: float):
+        self.app = app
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, data, timeout: float = None):
+        """Queues a write and waits until its batch is committed
+
+        A committing thread that died before taking the write is started
+        again; one that died with the write in its batch fails the write.
+
+        :param data: the write handed to the batch write function
+        :param timeout: the longest to wait in seconds, None for no limit
+
+        :return: the result of the write
+        :raises DeadlineExceeded: if the write was not committed in time,
+            it is dropped unless its batch had already started
+        :raises CommitterStopped: if the thread died during its batch
+        """
+        pending = _PendingWrite(data)
+        self._start()
+        self._queue.put(pending)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = THREAD_CHECK_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if wait > 0 and pending.done.wait(wait):
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                if pending.abandon():
+                    logger.warning("Group commit dropped a write past its "
+                                   "deadline")
+                raise DeadlineExceeded()
+            if not self._thread.is_alive():
+                if pending.started:
+                    raise CommitterStopped()
+                self._start()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _start(self):
+        """ Starts the committing thread in this process if needed """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="group-commit",
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """ Collects and commits batches for as long as the process lives """
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # requests that gave up on their writes are not waiting for them
+            batch = [pending for pending in batch if pending.start()]
+            if batch:
+                with self.app.app_context():
+                    self._commit(batch)
+
+    def _commit(self, batch):
+        """ Commits a batch, falling back to one write at a time on errors """
+        logger.info("Group committing %d writes", len(batch))
+        try:
+            results = self.write_batch([pending.data for pending in batch])
+        except Exception as error:  # pylint: disable=broad-except
+            if len(batch) == 1:
+                batch[0].fail(error)
+                return
+            # one bad write must not fail the others that joined its batch
+            logger.warning("Group commit failed, retrying writes alone: %s",
+                           error)
+            for pending in batch:
+                self._commit([pending])
+            return
+        for pending, result in zip(batch, results):
+            pending.resolve(result)
@@ -0,0 +1,125 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request Deadlines
+
+Every request gets a deadline, per route or the default, when it starts.
+The time left is handed to the database so a slow query is cancelled by
+the database itself when the deadline passes: Postgres transactions get a
+statement_timeout and sqlite statements a progress handler that interrupts
+them. Statements that would start after the deadline are not sent at all.
+Either way the request ends with 504 Gateway Timeout and the worker is free
+for the next one.
+"""
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from werkzeug.exceptions import GatewayTimeout
+
+# how many sqlite virtual machine steps run between deadline checks
+SQLITE_CHECK_STEPS = 1000
+
+
+class DeadlineExceeded(GatewayTimeout):
+    """ Raised when a request runs past its deadline """
+    description = "The request did not complete before its deadline"
+
+
+class Deadlines():
+    """ Sets request deadlines and enforces them on database statements """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Hooks the app and the database engines """
+        self.app = app
+        app.before_request(self.start)
+        app.teardown_request(self.finish)
+        event.listen(Engine, "before_cursor_execute", self.before_statement)
+        event.listen(Engine, "after_cursor_execute", self.after_statement)
+        event.listen(Engine, "handle_error", self.translate_error)
+        event.listen(Session, "after_begin", self.begin_transaction)
+
+    def start(self):
+        """ Sets the deadline of the request that is starting """
+        deadlines = self.app.config["ROUTE_DEADLINES_MS"]
+        budget = deadlines.get(request.endpoint,
+                               self.app.config["REQUEST_DEADLINE_MS"])
+        if budget:
+            g.deadline = time.monotonic() + budget / 1000
+
+    @staticmethod
+    def finish(exception=None):
+        """ Clears the deadline of the request that ended """
+        # pylint: disable=unused-argument
+        g.pop("deadline", None)
+
+    @staticmethod
+    def remaining():
+        """ Returns the seconds left before the deadline, None if unbounded """
+        if not has_request_context() or "deadline" not in g:
+            return None
+        return g.deadline - time.monotonic()
+
+    def begin_transaction(self, session, transaction, connection):
+        """ Bounds every statement of a Postgres transaction by the deadline """
+        # pylint: disable=unused-argument
+        remaining = self.remaining()
+        if remaining is not None and connection.dialect.name == "postgresql":
+            milliseconds = max(1, int(remaining * 1000))
+            connection.execute("SET LOCAL statement_timeout = {}"
+                               .format(milliseconds))
+
+    def before_statement(self, conn, cursor, statement, parameters,
+                         context, executemany):
+        """ Refuses statements past the deadline and arms sqlite's check """
+        # pylint: disable=unused-argument,too-many-arguments
+        remaining = self.remaining()
+        if remaining is None:
+            return
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        if conn.dialect.name == "sqlite":
+            deadline = g.deadline
+            conn.connection.set_progress_handler(
+                lambda: time.monotonic() > deadline, SQLITE_CHECK_STEPS)
+
+    @staticmethod
+    def after_statement(conn, cursor, statement, parameters,
+                        context, executemany):
+        """ Disarms sqlite's deadline check """
+        # pylint: disable=unused-argument,too-many-arguments
+        if conn.dialect.name == "sqlite":
+            conn.connection.set_progress_handler(None, SQLITE_CHECK_STEPS)
+
+    def translate_error(self, context):
+        """ Turns statements cancelled by the deadline into a 504 """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        if context.engine.dialect.name == "sqlite":
+            context.connection.connection.set_progress_handler(
+                None, SQLITE_CHECK_STEPS)
+        error = context.original_exception
+        cancelled = getattr(error, "pgcode", None) == "57014" or \
+            "interrupted" in str(error)
+        if cancelled or remaining <= 0:
+            return DeadlineExceeded()
+        return None
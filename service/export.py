@@ -0,0 +1,247 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk Export
+
+Writes the wishlist, item and product tables to CSV or Parquet files. The
+tables are read in one read-only transaction, REPEATABLE READ on Postgres
+and an explicit BEGIN on sqlite, so the files form a consistent snapshot,
+and through server-side cursors a
+chunk at a time, so memory stays bounded whatever the table sizes. When the
+tables are sharded every shard is read in a snapshot of its own, and the
+product catalog from shard 0. Parquet needs the optional pyarrow package.
+Export jobs run one at a time.
+"""
+import csv
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from werkzeug.exceptions import Conflict
+from service.models import db, Wishlist, Item, Product, DataValidationError
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("csv", "parquet")
+
+# the exported columns of each table, with their Parquet types
+TABLES = OrderedDict([
+    (Wishlist.__table__, OrderedDict([("id", "int64"), ("name", "string"),
+                                      ("user_id", "int64"),
+                                      ("status", "bool")])),
+    (Item.__table__, OrderedDict([("id", "int64"), ("wishlist_id", "int64"),
+                                  ("product_id", "int64"),
+                                  ("position", "string")])),
+    (Product.__table__, OrderedDict([("id", "int64"), ("name", "string")])),
+])
+
+
+class ExportRunning(Conflict):
+    """ Raised when an export job is started while another one runs """
+
+    def __init__(self, job_id):
+        super().__init__("Export '{}' is still running".format(job_id))
+        self.job_id = job_id
+
+
+def check_format(fmt: str):
+    """ Raises a DataValidationError unless fmt can be exported here """
+    if fmt not in FORMATS:
+        raise DataValidationError(
+            "format should be one of {}".format(", ".join(FORMATS)))
+    if fmt == "parquet" and pyarrow is None:
+        raise DataValidationError("parquet export needs the pyarrow package")
+
+
+def export_snapshot(directory: str, fmt: str, chunk_size: int,
+                    engines: list = None):
+    """Exports the wishlist, item and product tables into a directory
+
+    :param directory: where the files are written, created if needed
+    :param fmt: "csv" or "parquet"
+    :param chunk_size: the most rows held in memory at once
+    :param engines: the shards to read, the default database when None
+
+    :return: the files written with their row counts, and the throughput
+    :rtype: dict
+    """
+    check_format(fmt)
+    os.makedirs(directory, exist_ok=True)
+    started = time.monotonic()
+    files = OrderedDict()
+    snapshots = []
+    try:
+        for engine in engines or [db.engine]:
+            snapshots.append(_begin_snapshot(engine))
+        for table, columns in TABLES.items():
+            path = os.path.join(directory, "{}.{}".format(table.name, fmt))
+            rows = _WRITERS[fmt](path, columns, _read_table(
+                snapshots, table, columns, chunk_size))
+            files[table.name] = {"path": path, "rows": rows}
+            logger.info("Exported %d rows of %s to %s", rows, table.name, path)
+    finally:
+        for connection, transaction in snapshots:
+            transaction.rollback()  # nothing was written, end the snapshot
+            connection.close()
+    seconds = time.monotonic() - started
+    rows = sum(exported["rows"] for exported in files.values())
+    return {
+        "format": fmt,
+        "files": files,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds else rows
+    }
+
+
+def _begin_snapshot(engine):
+    """ Opens a read-only transaction on an engine for the whole export """
+    connection = engine.connect()
+    try:
+        if connection.dialect.name == "postgresql":
+            connection = connection.execution_options(
+                isolation_level="REPEATABLE READ")
+        transaction = connection.begin()
+        if connection.dialect.name == "postgresql":
+            connection.execute("SET TRANSACTION READ ONLY")
+        elif connection.dialect.name == "sqlite":
+            # pysqlite only begins transactions before writes, so each read
+            # would see the latest commit instead of the first one's snapshot
+            connection.execute("BEGIN")
+    except Exception:
+        connection.close()
+        raise
+    return connection, transaction
+
+
+def _read_table(snapshots, table, columns, chunk_size):
+    """ Generates the chunks of rows of a table in each snapshot in turn """
+    query = table.select().with_only_columns(
+        [table.c[name] for name in columns]).order_by(table.c.id)
+    if table.info.get("unsharded"):
+        snapshots = snapshots[:1]
+    for connection, _ in snapshots:
+        result = connection.execution_options(stream_results=True) \
+            .execute(query)
+        chunk = result.fetchmany(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = result.fetchmany(chunk_size)
+
+
+def _write_csv(path, columns, chunks):
+    """ Writes chunks of rows to a CSV file with a header row """
+    rows = 0
+    with open(path, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+
+def _write_parquet(path, columns, chunks):
+    """ Writes chunks of rows to a Parquet file, one row group per chunk """
+    schema = pyarrow.schema([(name, getattr(pyarrow, kind)())
+                             for name, kind in columns.items()])
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            arrays = [pyarrow.array([row[index] for row in chunk],
+                                    type=field.type)
+                      for index, field in enumerate(schema)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+_WRITERS = {"csv": _write_csv, "parquet": _write_parquet}
+
+
+class ExportJobs():
+    """
+    Runs exports in the background and remembers how they went
+
+    :param app: the Flask app whose context the exports run in
+    :param directory: the directory under which each job gets its own
+    :param chunk_size: the most rows held in memory at once
+    :param max_jobs: the most jobs remembered, the oldest is forgotten first
+    :param engines: returns the shards to read, the default database when
+        None
+    """
+
+    def __init__(self, app, directory: str, chunk_size: int, max_jobs: int,
+                 engines=None):
+        self.app = app
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.max_jobs = max_jobs
+        self.engines = engines
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, fmt: str):
+        """Starts an export job
+
+        :return: the job, whose status is "running" until the export is
+            "done" or has "failed"
+        :rtype: dict
+        :raises ExportRunning: if another job is still running
+        """
+        check_format(fmt)
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "format": fmt, "status": "running"}
+        with self._lock:
+            for running in self._jobs.values():
+                if running["status"] == "running":
+                    raise ExportRunning(running["id"])
+            self._jobs[job_id] = dict(job)
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        thread = threading.Thread(target=self._run, args=(job_id, fmt),
+                                  name="export-" + job_id, daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id: str):
+        """ Returns a copy of a job, or None if it is not known """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _run(self, job_id, fmt):
+        """ Runs an export and records its report or error on the job """
+        update = {}
+        try:
+            with self.app.app_context():
+                update["report"] = export_snapshot(
+                    os.path.join(self.directory, job_id), fmt, self.chunk_size,
+                    self.engines() if self.engines else None)
+            update["status"] = "done"
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Export %s failed: %s", job_id, error)
+            update.update(status="failed", error=str(error))
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(update)
@@ -0,0 +1,174 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Idempotency Keys
+
+Requests carrying an Idempotency-Key header are remembered with a
+fingerprint of the request and the response they produced. A retry with
+the same key and body is answered from the stored response without running
+the handler again, so client retries after a timeout do not create
+duplicates. Keys are stored in the database, so a retry that reaches
+another process, or comes after a restart, is answered the same way.
+
+Keys belong to a client (the X-User-Id header, or the client address
+without it) and a path, so two clients that happen to pick the same key
+do not see each other's requests.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, abort
+from flask_api import status
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from service.models import IdempotencyKey, db
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# the longest client, path or key that is stored
+MAX_LENGTH = 255
+
+
+class IdempotencyStore():
+    """
+    An expiring table of idempotency keys and their responses
+
+    :param ttl: how long a key is remembered, in seconds
+    :param claim_timeout: how long a request may hold a key without
+        finishing, in seconds, after which a retry runs again (the first
+        request is taken to have died)
+    """
+
+    def __init__(self, ttl: float, claim_timeout: float):
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+
+    def begin(self, key, fingerprint):
+        """Claims a key (client, path, key) for a request
+
+        :return: None when the request should run, otherwise the entry
+            (fingerprint, response) already stored under the key, where a
+            response of None means the first request is still running
+        """
+        table = IdempotencyKey.__table__
+        now = datetime.utcnow()
+        claim = {"fingerprint": fingerprint, "response": None,
+                 "created_at": now,
+                 "expires_at": now + timedelta(seconds=self.ttl)}
+        # the keys are on shard 0 and commit apart from the request
+        with db.engine.begin() as connection:
+            row = connection.execute(
+                select([table.c.fingerprint, table.c.response,
+                        table.c.created_at, table.c.expires_at])
+                .where(_where(key)).with_for_update()).first()
+            if row is not None and not self._stale(row, now):
+                response = row.response and tuple(json.loads(row.response))
+                return row.fingerprint, response
+            if row is not None:
+                connection.execute(table.update().where(_where(key))
+                                   .values(claim))
+                return None
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values(
+                    claim, client=key[0], path=key[1], key=key[2]))
+        except IntegrityError:
+            # another request claimed the key first
+            return self.begin(key, fingerprint)
+        return None
+
+    @staticmethod
+    def finish(key, response):
+        """ Stores the response of a request that claimed a key """
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(_where(key))
+                               .values(response=json.dumps(response)))
+
+    @staticmethod
+    def release(key):
+        """ Forgets a key whose request failed so that it can be retried """
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(
+                db.and_(_where(key), table.c.response.is_(None))))
+
+    @staticmethod
+    def prune(before: datetime = None):
+        """ Deletes the keys that expired before a time and returns how many """
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(table.delete().where(
+                table.c.expires_at <= (before or datetime.utcnow()))).rowcount
+
+    def _stale(self, row, now):
+        """ Tells if a stored key expired or its request was abandoned """
+        return row.expires_at <= now or row.response is None and \
+            row.created_at + timedelta(seconds=self.claim_timeout) <= now
+
+
+def _where(key):
+    """ Returns the condition selecting the row of a key """
+    table = IdempotencyKey.__table__
+    client, path, name = key
+    return db.and_(table.c.client == client, table.c.path == path,
+                   table.c.key == name)
+
+
+def idempotent(store: IdempotencyStore):
+    """
+    Makes a resource method replay its response for repeated keys
+
+    Only successful responses are stored; a request that fails releases its
+    key. Reusing a key for a different request is answered with 400 and a
+    retry that arrives while the first request runs with 409.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return function(*args, **kwargs)
+            client = request.headers.get("X-User-Id") or request.remote_addr
+            key = (client or "", request.path, key)
+            if any(len(part) > MAX_LENGTH for part in key):
+                abort(status.HTTP_400_BAD_REQUEST,
+                      "{} should be at most {} characters"
+                      .format(HEADER, MAX_LENGTH))
+            fingerprint = hashlib.sha256(
+                request.method.encode() + request.get_data()).hexdigest()
+            entry = store.begin(key, fingerprint)
+            if entry is not None:
+                if entry[0] != fingerprint:
+                    abort(status.HTTP_400_BAD_REQUEST,
+                          "{} was already used for a different request"
+                          .format(HEADER))
+                if entry[1] is None:
+                    abort(status.HTTP_409_CONFLICT,
+                          "A request with this {} is still in progress"
+                          .format(HEADER))
+                data, code, headers = entry[1]
+                return data, code, dict(headers, **{REPLAYED_HEADER: "true"})
+            try:
+                response = function(*args, **kwargs)
+            except Exception:
+                store.release(key)
+                raise
+            store.finish(key, response)
+            return response
+        return wrapper
+    return decorator
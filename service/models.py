@@ -27,13 +27,56 @@ Attributes:
 
 """
 import logging
-from flask_sqlalchemy import SQLAlchemy
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import (ClauseElement, ColumnElement,
+                                       Executable)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import (Session, column_property, selectinload,
+                            sessionmaker)
+from service.positions import rank_between, spread_ranks
 
 logger = logging.getLogger("flask.app")
 
 
+class RoutingSession(SignallingSession):
+    """
+    A session that talks to the shard named in its info
+
+    Sessions start on shard 0, the default database; ShardRouter moves them
+    by setting info["shard"]. Tables marked unsharded stay on shard 0.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = self.info.get("shard")
+        if shard and not (mapper is not None and
+                          mapper.persist_selectable.info.get("unsharded")):
+            return db.get_engine(self.app, bind=shard_bind(shard))
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that can be routed to a shard """
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def shard_bind(shard: int):
+    """ Returns the SQLALCHEMY_BINDS key of a shard, None for shard 0 """
+    return "shard{}".format(shard) if shard else None
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
@@ -41,6 +84,30 @@ class DataValidationError(Exception):
     pass
 
 
+def _integer(data: dict, name: str, model: str, nullable: bool = False):
+    """ Returns an integer field of a document, accepting numeric strings """
+    value = data[name]
+    if value is None and nullable:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip("-").isdigit():
+            value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise DataValidationError("Invalid {}: {} should be an integer"
+                                  .format(model, name))
+    return value
+
+
+def _string(data: dict, name: str, model: str):
+    """ Returns a string field of a document """
+    value = data[name]
+    if not isinstance(value, str):
+        raise DataValidationError("Invalid {}: {} should be a string"
+                                  .format(model, name))
+    return value
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
@@ -101,6 +168,9 @@ class PersistentBase():
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        product_names.max_size = app.config["PRODUCT_NAMES_CACHE_SIZE"]
+        product_names.ttl = app.config["PRODUCT_NAMES_CACHE_TTL"]
+        Stats.stripes = app.config["STATS_TOTAL_STRIPES"]
 
     @classmethod
     def all(cls):
@@ -108,6 +178,239 @@ class PersistentBase():
         cls.logger.info("Processing all Wishlists")
         return cls.query.all()
 
+    @classmethod
+    def explain(cls, query):
+        """Returns the SQL of a query and the plan the database picked for it
+
+        :param query: the query to explain
+        :type query: Query
+
+        :return: a dictionary with the "sql" and its "plan" lines
+        :rtype: dict
+        """
+        connection = db.session.connection()
+        # the values are only written into the SQL that is shown, the
+        # EXPLAIN itself gets them as bound parameters
+        sql = str(query.statement.compile(
+            dialect=connection.dialect,
+            compile_kwargs={"literal_binds": True}))
+        rows = connection.execute(Explain(query.statement))
+        # the plan text is the last column for both sqlite and postgres
+        return {"sql": sql, "plan": [str(row[-1]) for row in rows]}
+
+
+class Explain(Executable, ClauseElement):
+    """ The EXPLAIN of a statement, which keeps its bound parameters """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kwargs):
+    """ Writes EXPLAIN, or EXPLAIN QUERY PLAN on sqlite, before a statement """
+    prefix = "EXPLAIN QUERY PLAN " if compiler.dialect.name == "sqlite" \
+        else "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+class ByteOrder(ColumnElement):
+    """ A string column compared byte by byte, as sqlite always does """
+
+    def __init__(self, column):
+        self.column = column
+        self.type = column.type
+
+    def get_children(self, **kwargs):
+        return [self.column]
+
+
+@compiles(ByteOrder)
+def compile_byte_order(element, compiler, **kwargs):
+    """ Collates the column as "C" on Postgres """
+    column = compiler.process(element.column, **kwargs)
+    if compiler.dialect.name == "postgresql":
+        return column + ' COLLATE "C"'
+    return column
+
+
+##################################################
+# PRODUCT CATALOG MODEL
+##################################################
+class Product(db.Model):
+    """
+    The name of a product, stored once however many items hold it
+
+    Items only keep the product_id; their names are read through the
+    product_names cache. The catalog always lives on shard 0.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    __table_args__ = {'info': {'unsharded': True}}
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(63), nullable=False)
+
+    def serialize(self):
+        """ Serializes a Product into a dictionary """
+        return {"id": self.id, "name": self.name}
+
+    @classmethod
+    def rename(cls, product_id: int, name: str):
+        """Renames a product with a single-row update
+
+        :param product_id: the id of the product
+        :type product_id: int
+        :param name: the new name
+        :type name: str
+
+        :return: the serialized product, or None if it is not in the catalog
+        :rtype: dict
+
+        """
+        cls.logger.info("Renaming product %s to %s", product_id, name)
+        if not isinstance(name, str) or not name:
+            raise DataValidationError("Invalid Product: name should be a "
+                                      "non-empty string")
+        renamed = cls.query.filter(cls.id == product_id) \
+            .update({cls.name: name}, synchronize_session=False)
+        if renamed:
+            _written_products(db.session)[product_id] = name
+        db.session.commit()
+        return {"id": product_id, "name": name} if renamed else None
+
+    @classmethod
+    def register(cls, session, names: dict):
+        """Adds the products missing from the catalog
+
+        The names of products already in the catalog are kept: items only
+        name new products, and renames go through rename() alone.
+
+        :param names: the names given to items keyed by product id
+
+        :return: the catalog names of the products keyed by product id
+        :rtype: dict
+        """
+        table = cls.__table__
+        connection = session.connection(mapper=inspect(cls))
+        ids = sorted(names)
+        stored = cls._read_names(connection, ids)
+        missing = [{"id": product_id, "name": names[product_id]}
+                   for product_id in ids if product_id not in stored]
+        if missing:
+            # another transaction may add the same product meanwhile
+            if connection.dialect.name == "postgresql":
+                statement = postgresql.insert(table).on_conflict_do_nothing()
+            else:
+                statement = table.insert().prefix_with("OR IGNORE")
+            connection.execute(statement, missing)
+            added = cls._read_names(connection, [row["id"]
+                                                 for row in missing])
+            stored.update(added)
+            _written_products(session).update(added)
+            product_names.forget(added)
+        return stored
+
+    @staticmethod
+    def _read_names(connection, ids: list):
+        """ Reads the catalog names of products in chunks of ids """
+        table = Product.__table__
+        stored = {}
+        for start in range(0, len(ids), PRODUCT_CHUNK_SIZE):
+            stored.update(connection.execute(
+                select([table.c.id, table.c.name])
+                .where(table.c.id.in_(ids[start:start + PRODUCT_CHUNK_SIZE])))
+                .fetchall())
+        return stored
+
+
+class ProductNames():
+    """
+    A bounded cache of product names keyed by product id
+
+    Names are kept for at most ttl seconds, so renames made by other
+    processes show up within that time, and the least recently used names
+    are dropped beyond max_size. Misses are read with one query per chunk
+    of ids.
+
+    :param max_size: the most names kept
+    :param ttl: the seconds a name is kept
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, product_id: int):
+        """ Returns the name of a product, None if it is not in the catalog """
+        return self.get_many([product_id]).get(product_id)
+
+    def get_many(self, product_ids):
+        """ Returns the names of the products in the catalog keyed by id """
+        now = time.monotonic()
+        names = {}
+        missing = set()
+        with self._lock:
+            for product_id in product_ids:
+                entry = self._names.get(product_id)
+                if entry is None or entry[1] <= now:
+                    missing.add(product_id)
+                else:
+                    self._names.move_to_end(product_id)
+                    names[product_id] = entry[0]
+        if not missing:
+            return names
+        ids = sorted(missing)
+        loaded = {}
+        for start in range(0, len(ids), PRODUCT_CHUNK_SIZE):
+            loaded.update(db.session.query(Product.id, Product.name).filter(
+                Product.id.in_(ids[start:start + PRODUCT_CHUNK_SIZE])))
+        self.put(loaded)
+        names.update(loaded)
+        return names
+
+    def put(self, names: dict):
+        """ Keeps names that were just committed, keyed by product id """
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for product_id, name in names.items():
+                self._names[product_id] = (name, expires)
+                self._names.move_to_end(product_id)
+            while len(self._names) > self.max_size:
+                self._names.popitem(last=False)
+
+    def forget(self, product_ids):
+        """ Drops the names of products being written """
+        with self._lock:
+            for product_id in product_ids:
+                self._names.pop(product_id, None)
+
+    def clear(self):
+        """ Drops every name """
+        with self._lock:
+            self._names.clear()
+
+
+# stay below the bound parameter limit of sqlite
+PRODUCT_CHUNK_SIZE = 500
+
+# the longest item rank; longer ones are spread before they are stored
+POSITION_MAX_LENGTH = 64
+# ranks must compare byte by byte, whatever the collation of the database
+POSITION_TYPE = db.String(POSITION_MAX_LENGTH).with_variant(
+    postgresql.VARCHAR(POSITION_MAX_LENGTH, collation="C"), "postgresql")
+
+# the names of products, shared by every request of the process
+product_names = ProductNames(10000, 60)
+
+
+def _written_products(session):
+    """ Returns the names a transaction added or renamed keyed by product id """
+    return session.info.setdefault("products_written", {})
+
 
 ##################################################
 # ITEM MODEL
@@ -122,10 +425,31 @@ class Item(db.Model, PersistentBase):
     # Table Schema
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
-    wishlist_id = db.Column(db.Integer, db.ForeignKey('wishlist.id'),
+    wishlist_id = db.Column(db.Integer,
+                            db.ForeignKey('wishlist.id', ondelete='CASCADE'),
                             nullable=False)
-    product_id = db.Column(db.Integer, nullable=False)
-    product_name = db.Column(db.String(63), nullable=False)
+    # active history keeps the old value around for the product stats
+    product_id = column_property(db.Column(db.Integer, nullable=False),
+                                 active_history=True)
+    # the fractional rank of the item in its wishlist, which must compare
+    # byte by byte; new items get one after the last item
+    position = db.Column(POSITION_TYPE, nullable=False)
+    # a name given to the item, added to the catalog when it is flushed
+    _product_name = None
+    _product_name_pending = False
+
+    # reverse index from a product to the wishlists holding it, ordered by
+    # wishlist so pages of wishlists are read as index ranges; unique, as a
+    # product is in a wishlist at most once
+    __table_args__ = (
+        db.Index('ix_item_product_id_wishlist_id', 'product_id', 'wishlist_id',
+                 unique=True),
+        # the items of a wishlist in order, as one index range
+        db.Index('ix_item_wishlist_id_position', 'wishlist_id', 'position',
+                 'id'),
+        # sqlite must not reuse ids below the range of its shard
+        {'sqlite_autoincrement': True},
+    )
 
     def __repr__(self):
         return "<Item %r id=[%s] wishlist_id[%s] product_id[%s]>" % (
@@ -135,6 +459,18 @@ class Item(db.Model, PersistentBase):
         return "%s: product_id: %s, item_id: %s, wishlist_id: %s" % (
             self.product_name, self.product_id, self.id, self.wishlist_id)
 
+    @property
+    def product_name(self):
+        """ The name of the product, from the catalog unless one was given """
+        if self._product_name is not None:
+            return self._product_name
+        return product_names.get(self.product_id)
+
+    @product_name.setter
+    def product_name(self, name):
+        self._product_name = name
+        self._product_name_pending = True
+
     ##################################################
     # INSTANCE METHODS
     ##################################################
@@ -144,13 +480,220 @@ class Item(db.Model, PersistentBase):
         db.session.delete(self)
         db.session.commit()
 
-    def serialize(self):
-        """ Serializes an Item into a dictionary """
+    @classmethod
+    def create_many(cls, items: list):
+        """Adds many Items to their Wishlists in one transaction
+
+        A product is in a Wishlist at most once: adding it again returns
+        the Item already there, read by the same upsert statement that
+        would have inserted it.
+
+        :param items: the Items to add
+        :type items: list
+
+        :return: for each Item the serialized Item and whether it was
+            created, or None when its Wishlist does not exist
+        :rtype: list
+        """
+        cls.logger.info("Creating %d items", len(items))
+        for item in items:
+            if item.wishlist_id is None or item.product_id is None:
+                raise DataValidationError(
+                    "Invalid Item: wishlist_id and product_id are required")
+        owners = dict(db.session.query(Wishlist.id, Wishlist.user_id)
+                      .filter(Wishlist.id.in_({item.wishlist_id
+                                               for item in items})))
+        try:
+            names = {}
+            for item in items:
+                if item.wishlist_id in owners and \
+                        item._product_name is not None:
+                    names.setdefault(item.product_id, item._product_name)
+            if names:
+                # the catalog names win over the names given to the items
+                catalog = Product.register(db.session, names)
+                for item in items:
+                    if item.product_id in catalog:
+                        item._product_name = catalog[item.product_id]
+                        item._product_name_pending = False
+            connection = db.session.connection()
+            last = dict(db.session.query(cls.wishlist_id,
+                                         db.func.max(cls.position))
+                        .filter(cls.wishlist_id.in_(owners))
+                        .group_by(cls.wishlist_id))
+            results = []
+            products = defaultdict(int)
+            events = []
+            for item in items:
+                if item.wishlist_id not in owners:
+                    results.append(None)
+                    continue
+                item.position = rank_between(last.get(item.wishlist_id))
+                item.id, item.position, created = cls._upsert(
+                    connection, item.wishlist_id, item.product_id,
+                    item.position)
+                if created:
+                    last[item.wishlist_id] = item.position
+                    products[item.product_id] += 1
+                    events.append(change_event(
+                        "item", item.id, item.wishlist_id,
+                        owners[item.wishlist_id], "created"))
+                results.append((item.serialize(), created))
+            # the upserts skip the flush events that keep these current
+            Stats.add(db.session, {}, products,
+                      {"items": sum(products.values())})
+            Change.record(db.session, events)
+            touched = {event["wishlist_id"] for event in events}
+            if touched:
+                table = Wishlist.__table__
+                connection.execute(
+                    table.update().where(table.c.id.in_(touched))
+                    .values(updated_at=datetime.utcnow()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return results
+
+    @classmethod
+    def _upsert(cls, connection, wishlist_id: int, product_id: int,
+                position: str):
+        """Inserts an item unless its product is in the wishlist already
+
+        :return: the id and position of the new or existing item and
+            whether it is new
+        :rtype: tuple
+        """
+        table = cls.__table__
+        values = {"wishlist_id": wishlist_id, "product_id": product_id,
+                  "position": position}
+        if connection.dialect.name == "postgresql":
+            statement = postgresql.insert(table).values(values)
+            # a no-op update makes RETURNING give the existing row as well;
+            # xmax is 0 only for a row this statement inserted
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.product_id, table.c.wishlist_id],
+                set_={"product_id": statement.excluded.product_id}
+            ).returning(table.c.id, table.c.position,
+                        db.literal_column("xmax = 0"))
+            return tuple(connection.execute(statement).first())
+        result = connection.execute(table.insert().prefix_with("OR IGNORE")
+                                    .values(values))
+        if result.rowcount:
+            return result.inserted_primary_key[0], position, True
+        row = connection.execute(select([table.c.id, table.c.position]).where(
+            (table.c.product_id == product_id) &
+            (table.c.wishlist_id == wishlist_id))).first()
+        return row.id, row.position, False
+
+    @classmethod
+    def move(cls, wishlist_id: int, item_id: int, after_id: int = None):
+        """Moves an Item of a Wishlist to right after another one
+
+        Only the moved Item is written: it gets a rank between the ranks of
+        its new neighbours. The ranks of the Wishlist are spread first when
+        there is no room left between them.
+
+        :param wishlist_id: the id of the Wishlist
+        :type wishlist_id: int
+        :param item_id: the id of the Item to move
+        :type item_id: int
+        :param after_id: the Item to put it after, None for the first place
+        :type after_id: int
+
+        :return: the serialized Item, or None if it is not in the Wishlist
+        :rtype: dict
+
+        """
+        cls.logger.info("Moving item %s of wishlist %s after %s", item_id,
+                        wishlist_id, after_id)
+        item = cls.query.filter(cls.id == item_id,
+                                cls.wishlist_id == wishlist_id).first()
+        if item is None:
+            db.session.rollback()
+            return None
+        if after_id == item_id:
+            raise DataValidationError(
+                "Invalid position: an item cannot follow itself")
+        before, after = cls._neighbours(wishlist_id, item_id, after_id)
+        position = rank_between(before, after) \
+            if after is None or before is None or before < after else None
+        if position is None or len(position) > POSITION_MAX_LENGTH:
+            # equal ranks of concurrent appends, or too long a rank
+            cls.spread_positions(wishlist_id)
+            before, after = cls._neighbours(wishlist_id, item_id, after_id)
+            position = rank_between(before, after)
+        item.position = position
+        db.session.flush()
+        moved = item.serialize()
+        db.session.commit()
+        return moved
+
+    @classmethod
+    def _neighbours(cls, wishlist_id, item_id, after_id):
+        """ Returns the ranks an Item moved after another one goes between """
+        others = db.session.query(cls.position).filter(
+            cls.wishlist_id == wishlist_id, cls.id != item_id)
+        before = None
+        if after_id is not None:
+            before = db.session.query(cls.position).filter(
+                cls.id == after_id, cls.wishlist_id == wishlist_id).scalar()
+            if before is None:
+                db.session.rollback()
+                raise DataValidationError(
+                    "Invalid position: item '{}' is not in the wishlist"
+                    .format(after_id))
+            others = others.filter(db.or_(
+                cls.position > before,
+                db.and_(cls.position == before, cls.id > after_id)))
+        after = others.order_by(cls.position, cls.id).limit(1).scalar()
+        return before, after
+
+    @classmethod
+    def spread_positions(cls, wishlist_id: int):
+        """Gives the Items of a Wishlist short, evenly spaced ranks
+
+        The order is kept and no events are recorded, as nothing visible
+        changes.
+
+        :param wishlist_id: the id of the Wishlist
+        :type wishlist_id: int
+
+        :return: the number of Items whose rank was rewritten
+        :rtype: int
+
+        """
+        cls.logger.info("Spreading positions of wishlist %s", wishlist_id)
+        table = cls.__table__
+        rows = db.session.query(cls.id, cls.position) \
+            .filter(cls.wishlist_id == wishlist_id) \
+            .order_by(cls.position, cls.id).with_for_update().all()
+        changed = [{"item_id": item_id, "rank": rank}
+                   for (item_id, position), rank
+                   in zip(rows, spread_ranks(len(rows))) if rank != position]
+        if changed:
+            db.session.connection().execute(
+                table.update().where(table.c.id == db.bindparam("item_id"))
+                .values(position=db.bindparam("rank")), changed)
+        db.session.commit()
+        return len(changed)
+
+    def serialize(self, names: dict = None):
+        """Serializes an Item into a dictionary
+
+        :param names: catalog names read for many items at once, used
+            instead of looking the product up again
+        """
+        if names is None or self._product_name is not None:
+            product_name = self.product_name
+        else:
+            product_name = names.get(self.product_id)
         return {
             "id": self.id,
             "wishlist_id": self.wishlist_id,
             "product_id": self.product_id,
-            "product_name": self.product_name
+            "product_name": product_name,
+            "position": self.position
         }
 
     def deserialize(self, data):
@@ -160,9 +703,11 @@ class Item(db.Model, PersistentBase):
             data (dict): A dictionary containing the resource data
         """
         try:
-            self.wishlist_id = data["wishlist_id"]
-            self.product_id = data["product_id"]
-            self.product_name = data["product_name"]
+            # the wishlist of an item created with it is not known yet
+            self.wishlist_id = _integer(data, "wishlist_id", "Item",
+                                        nullable=True)
+            self.product_id = _integer(data, "product_id", "Item")
+            self.product_name = _string(data, "product_name", "Item")
         except KeyError as error:
             raise DataValidationError("Invalid Item: missing " + error.args[0])
         except TypeError:
@@ -200,18 +745,38 @@ class Wishlist(db.Model, PersistentBase):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
-    user_id = db.Column(db.Integer, nullable=False)
+    # active history keeps the old value around for the user stats
+    user_id = column_property(db.Column(db.Integer, nullable=False),
+                              active_history=True)
+    # the database deletes the items of a deleted wishlist, so they are
+    # never loaded just to be deleted one by one
     items = db.relationship('Item', backref='wishlist',
                             cascade="all,delete",
-                            lazy=True)
+                            passive_deletes=True,
+                            lazy=True,
+                            order_by=[Item.position, Item.id])
     status = db.Column(db.Boolean, default=True, nullable=False)
+    # when the wishlist or its items last changed, to archive stale ones
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow,
+                           index=True)
+
+    # (user_id, name) serves per user lookups and name prefix scans; in
+    # the "C" collation Postgres uses it both for LIKE 'prefix%' and to
+    # return the names in order, whatever the database's collation
+    __table_args__ = (
+        db.Index('ix_wishlist_user_id_name', 'user_id', ByteOrder(name)),
+        {'sqlite_autoincrement': True},
+    )
 
     ##################################################
     # INSTANCE METHODS
     ##################################################
-    def serialize(self):
+    def serialize(self, names: dict = None):
         """
         Serializes a Wishlist into a dictionary
+
+        :param names: catalog names read for many wishlists at once
         """
         wishlist = {
             "id": self.id,
@@ -221,8 +786,8 @@ class Wishlist(db.Model, PersistentBase):
             "status": self.status
         }
 
-        for item in self.items:
-            wishlist['items'].append(item.serialize())
+        for item in serialize_items(self.items, names):
+            wishlist['items'].append(item)
 
         return wishlist
 
@@ -238,8 +803,8 @@ class Wishlist(db.Model, PersistentBase):
 
         """
         try:
-            self.name = data["name"]
-            self.user_id = data["user_id"]
+            self.name = _string(data, "name", "Wishlist")
+            self.user_id = _integer(data, "user_id", "Wishlist")
         except KeyError as error:
             raise DataValidationError("Invalid Wishlist: missing " +
                                       error.args[0])
@@ -249,6 +814,96 @@ class Wishlist(db.Model, PersistentBase):
             )
         return self
 
+    def update_from(self, data: dict):
+        """
+        Changes the Wishlist and its items to match a full document
+
+        Only what differs is written: changed columns are updated, items
+        without an id are added and stored items missing from the document
+        are deleted, all in one transaction.
+
+        :param data: a serialized Wishlist with the wanted state
+        :type data: dict
+
+        :return: the serialized Wishlist after the changes
+        :rtype: dict
+
+        """
+        try:
+            self._apply_document(data)
+            logger.info("Patching %s", self.name)
+            db.session.flush()
+            wishlist = self.serialize()
+            db.session.commit()
+        except Exception:
+            # drop the changes made so far, or the shared session stays in
+            # a failed transaction for the requests that follow
+            db.session.rollback()
+            raise
+        return wishlist
+
+    def _apply_document(self, data: dict):
+        """ Sets the attributes and items that differ from the document """
+        self.deserialize(data)
+        if data.get("id", self.id) != self.id:
+            raise DataValidationError("Invalid Wishlist: id cannot change")
+        if "status" in data:
+            if not isinstance(data["status"], bool):
+                raise DataValidationError(
+                    "Invalid Wishlist: status should be true or false")
+            self.status = data["status"]
+        items = data.get("items", [])
+        if not isinstance(items, list):
+            raise DataValidationError("Invalid Wishlist: items should be a list")
+
+        listed = []
+        for item_data in items:
+            if not isinstance(item_data, dict):
+                raise DataValidationError(
+                    "Invalid Wishlist: items should be objects")
+            item_data = dict(item_data)
+            item_data.setdefault("wishlist_id", self.id)
+            if item_data["wishlist_id"] != self.id:
+                raise DataValidationError(
+                    "Invalid Wishlist: items cannot move to another wishlist")
+            listed.append(item_data)
+
+        stored = {item.id: item for item in self.items}
+        kept = set()
+        for item_data in listed:
+            item_id = item_data.get("id")
+            if item_id is None:
+                continue
+            if item_id not in stored or item_id in kept:
+                raise DataValidationError(
+                    "Invalid Wishlist: item '{}' is not in the wishlist"
+                    .format(item_id))
+            kept.add(item_id)
+        removed = [item for item_id, item in stored.items()
+                   if item_id not in kept]
+        for item in removed:
+            self.items.remove(item)
+            db.session.delete(item)
+        if removed:
+            db.session.flush()  # frees their products for the other items
+
+        by_product = {}
+        for item_data in listed:
+            if item_data.get("id") is not None:
+                item = stored[item_data["id"]].deserialize(item_data)
+                if item.product_id in by_product:
+                    raise DataValidationError(
+                        "Invalid Wishlist: product '{}' is in the wishlist "
+                        "twice".format(item.product_id))
+                by_product[item.product_id] = item
+        for item_data in listed:
+            if item_data.get("id") is None:
+                item = Item().deserialize(item_data)
+                if item.product_id in by_product:
+                    continue  # a product is in a wishlist once
+                self.items.append(item)
+                by_product[item.product_id] = item
+
     ##################################################
     # CLASS METHODS
     ##################################################
@@ -280,3 +935,1148 @@ class Wishlist(db.Model, PersistentBase):
         """
         cls.logger.info("Processing user id query for %s ...", user_id)
         return cls.query.filter(cls.user_id == user_id)
+
+    @classmethod
+    def update_by_id(cls, wishlist_id: int, values: dict):
+        """Updates columns of a Wishlist without loading it first
+
+        Databases that support it run a single UPDATE ... RETURNING, which
+        also returns the old user id the stats need from a locked subquery
+        of the row. Others read the row once and then update it. The items
+        are read in the same transaction and nothing is reloaded after the
+        commit.
+
+        :param wishlist_id: the id of the Wishlist to update
+        :type wishlist_id: int
+        :param values: the new column values keyed by column name
+        :type values: dict
+
+        :return: the serialized Wishlist, or None if it was not found
+        :rtype: dict
+
+        """
+        cls.logger.info("Updating %s with %s", wishlist_id, values)
+        table = cls.__table__
+        columns = [table.c.id, table.c.name, table.c.user_id, table.c.status]
+        statement = table.update().where(table.c.id == wishlist_id) \
+            .values(values)
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            # UPDATE wishlist SET ... FROM (SELECT ... FOR UPDATE) AS old
+            # RETURNING ..., old.user_id
+            old = select([table.c.id, table.c.user_id]) \
+                .where(table.c.id == wishlist_id).with_for_update() \
+                .alias("old")
+            row = connection.execute(
+                table.update().where(table.c.id == old.c.id).values(values)
+                .returning(*columns, old.c.user_id.label("old_user_id"))
+            ).first()
+            wishlist = dict(row) if row else None
+            old_user_id = wishlist.pop("old_user_id") if row else None
+        else:
+            row = connection.execute(select(columns)
+                                     .where(table.c.id == wishlist_id)
+                                     .with_for_update()).first()
+            wishlist = dict(row) if row else None
+            if wishlist:
+                old_user_id = wishlist["user_id"]
+                connection.execute(statement)
+                wishlist.update(values)
+        if wishlist is None:
+            db.session.rollback()
+            return None
+        if old_user_id != wishlist["user_id"]:
+            Stats.add(db.session, {old_user_id: -1, wishlist["user_id"]: 1},
+                      {}, {})
+        Change.record(db.session, [change_event(
+            "wishlist", wishlist_id, wishlist_id, wishlist["user_id"],
+            "updated")])
+        items = Item.query.filter(Item.wishlist_id == wishlist_id) \
+            .order_by(Item.position, Item.id)
+        wishlist["items"] = serialize_items(items)
+        db.session.commit()
+        return wishlist
+
+    @classmethod
+    def set_status_by_user(cls, user_id: int, status: bool, chunk_size: int):
+        """Enables or disables all of the Wishlists of a user
+
+        Each chunk of Wishlists is flipped by a single UPDATE of its ids and
+        committed on its own, so row locks are held for one chunk at a time.
+        The archived Wishlists of the user are changed the same way where
+        they are, once the hot ones are done.
+
+        :param user_id: the user id of the Wishlists to change
+        :type user_id: int
+        :param status: True to enable and False to disable the Wishlists
+        :type status: bool
+        :param chunk_size: the most Wishlists changed per transaction
+        :type chunk_size: int
+
+        :return: the number of Wishlists changed
+        :rtype: int
+
+        """
+        cls.logger.info("Setting status of user %s wishlists to %s",
+                        user_id, status)
+        changed = 0
+        for wishlist in (cls, ArchivedWishlist):
+            while True:
+                ids = [wishlist_id for (wishlist_id,)
+                       in db.session.query(wishlist.id)
+                       .filter(wishlist.user_id == user_id,
+                               wishlist.status != status)
+                       .order_by(wishlist.id).limit(chunk_size)]
+                if ids:
+                    wishlist.query.filter(wishlist.id.in_(ids)) \
+                        .update({wishlist.status: status},
+                                synchronize_session=False)
+                    Change.record(db.session, [
+                        change_event("wishlist", wishlist_id, wishlist_id,
+                                     user_id, "updated")
+                        for wishlist_id in ids])
+                db.session.commit()
+                changed += len(ids)
+                if len(ids) < chunk_size:
+                    break
+        return changed
+
+    @classmethod
+    def delete_by_user(cls, user_id: int, chunk_size: int):
+        """Deletes all of the Wishlists of a user and their items
+
+        Each chunk of Wishlists is removed with a single DELETE, cascaded to
+        the items by the database, and committed on its own, so row locks
+        are held for one chunk at a time. The archived Wishlists of the user
+        are deleted the same way once the hot ones are gone.
+
+        :param user_id: the user id of the Wishlists to delete
+        :type user_id: int
+        :param chunk_size: the most Wishlists deleted per transaction
+        :type chunk_size: int
+
+        :return: the number of Wishlists and of Items deleted
+        :rtype: tuple
+
+        """
+        cls.logger.info("Deleting wishlists of user %s", user_id)
+        deleted_wishlists = deleted_items = 0
+        for wishlist, item in ((cls, Item), (ArchivedWishlist, ArchivedItem)):
+            while True:
+                ids = [wishlist_id for (wishlist_id,)
+                       in db.session.query(wishlist.id)
+                       .filter(wishlist.user_id == user_id)
+                       .order_by(wishlist.id).limit(chunk_size)]
+                if not ids:
+                    break
+                products = db.session.query(item.product_id,
+                                            db.func.count(item.id)) \
+                    .filter(item.wishlist_id.in_(ids)) \
+                    .group_by(item.product_id).all()
+                items = sum(count for _, count in products)
+                # the items go with their wishlists through ON DELETE CASCADE
+                wishlists = wishlist.query.filter(wishlist.id.in_(ids)) \
+                    .delete(synchronize_session=False)
+                # bulk statements skip the flush events that keep stats
+                # current, and the stats only count the hot tables
+                if wishlist is cls:
+                    Stats.add(db.session, {user_id: -wishlists},
+                              {product_id: -count
+                               for product_id, count in products},
+                              {"wishlists": -wishlists, "items": -items})
+                # and the outbox events; consumers drop the items with them
+                Change.record(db.session, [
+                    change_event("wishlist", wishlist_id, wishlist_id,
+                                 user_id, "deleted") for wishlist_id in ids])
+                db.session.commit()
+                deleted_wishlists += wishlists
+                deleted_items += items
+        return deleted_wishlists, deleted_items
+
+    @classmethod
+    def find_many(cls, wishlist_ids: list):
+        """Finds many Wishlists and their items by their ids
+
+        The Wishlists are read with one query per chunk of ids and their
+        items with one more, instead of a query per Wishlist.
+
+        :param wishlist_ids: the ids of the Wishlists to find
+        :type wishlist_ids: list
+
+        :return: the Wishlists found keyed by id
+        :rtype: dict
+
+        """
+        cls.logger.info("Processing lookup for %d ids ...", len(wishlist_ids))
+        chunk_size = 500  # stay below the bound parameter limit of sqlite
+        found = {}
+        for start in range(0, len(wishlist_ids), chunk_size):
+            chunk = wishlist_ids[start:start + chunk_size]
+            query = cls.query.options(selectinload(cls.items)) \
+                .filter(cls.id.in_(chunk))
+            found.update((wishlist.id, wishlist) for wishlist in query)
+        return found
+
+    @classmethod
+    def find_names_by_prefix(cls, user_id: int, prefix: str, limit: int):
+        """Returns the distinct names of a user's Wishlists starting with prefix
+
+        :param user_id: the user id of the Wishlists you want to match
+        :type user_id: int
+        :param prefix: the leading characters of the names
+        :type prefix: str
+        :param limit: the maximum number of names to return
+        :type limit: int
+
+        :return: the matching names in byte order
+        :rtype: list
+
+        """
+        cls.logger.info("Processing name prefix query for %s ...", user_id)
+        name = ByteOrder(cls.name)
+        query = db.session.query(name).filter(
+            cls.user_id == user_id,
+            name.startswith(prefix, autoescape=True)
+        ).distinct().order_by(name).limit(limit)
+        return [name for (name,) in query]
+
+    @classmethod
+    def find_by_product(cls, product_id: int, after: int, limit: int):
+        """Returns a page of the Wishlists holding a product
+
+        Pages are keyed on the wishlist id, so each one is a range scan of
+        the (product_id, wishlist_id) index no matter how deep it is.
+
+        :param product_id: the product the Wishlists must contain
+        :type product_id: int
+        :param after: only Wishlists with a greater id are returned
+        :type after: int
+        :param limit: the maximum number of Wishlists to return
+        :type limit: int
+
+        :return: the id, name, user_id and status of each Wishlist by id
+        :rtype: list
+
+        """
+        cls.logger.info("Processing product query for %s after %s ...",
+                        product_id, after)
+        wishlist_ids = db.session.query(Item.wishlist_id) \
+            .filter(Item.product_id == product_id,
+                    Item.wishlist_id > after) \
+            .distinct().order_by(Item.wishlist_id).limit(limit).subquery()
+        query = db.session.query(cls.id, cls.name, cls.user_id, cls.status) \
+            .join(wishlist_ids, cls.id == wishlist_ids.c.wishlist_id) \
+            .order_by(cls.id)
+        return [row._asdict() for row in query]
+
+    @classmethod
+    def count_by_product(cls, product_id: int):
+        """Returns the number of Wishlists holding a product
+
+        :param product_id: the product the Wishlists must contain
+        :type product_id: int
+
+        :return: the number of distinct Wishlists
+        :rtype: int
+
+        """
+        cls.logger.info("Processing product count for %s ...", product_id)
+        return db.session.query(
+            db.func.count(db.distinct(Item.wishlist_id))
+        ).filter(Item.product_id == product_id).scalar()
+
+    @classmethod
+    def find_by_filters(cls, user_id: int = None, name: str = None,
+                        status: bool = None, product_id: int = None,
+                        min_items: int = None, max_items: int = None):
+        """Returns the Wishlists matching all of the given criteria
+
+        Criteria left as None are not applied. Everything is combined into
+        a single statement: product and item count predicates become
+        correlated subqueries on the indexed item.wishlist_id and
+        item.product_id columns.
+
+        :param user_id: the user id of the Wishlists
+        :type user_id: int
+        :param name: the name of the Wishlists
+        :type name: str
+        :param status: True for enabled and False for disabled Wishlists
+        :type status: bool
+        :param product_id: a product that must be in the Wishlists
+        :type product_id: int
+        :param min_items: the least number of items in the Wishlists
+        :type min_items: int
+        :param max_items: the most number of items in the Wishlists
+        :type max_items: int
+
+        :return: a query of the matching Wishlists ordered by id
+        :rtype: Query
+
+        """
+        cls.logger.info("Processing filter query user_id=%s name=%s "
+                        "status=%s product_id=%s items=[%s, %s] ...",
+                        user_id, name, status, product_id,
+                        min_items, max_items)
+        return _filter_wishlists(cls, Item, user_id, name, status,
+                                 product_id, min_items, max_items)
+
+    @classmethod
+    def archive(cls, before: datetime, chunk_size: int):
+        """Moves the disabled and stale Wishlists to the archive tables
+
+        Each chunk of Wishlists is copied with its items by INSERT ...
+        SELECT, deleted from the hot tables and committed on its own. The
+        stats only count the hot tables, and each Wishlist gets an
+        "archived" event.
+
+        :param before: Wishlists not updated since then are stale
+        :type before: datetime
+        :param chunk_size: the most Wishlists archived per transaction
+        :type chunk_size: int
+
+        :return: the number of Wishlists and of Items archived
+        :rtype: tuple
+
+        """
+        cls.logger.info("Archiving wishlists disabled or untouched since %s",
+                        before)
+        archived_wishlists = archived_items = 0
+        while True:
+            rows = db.session.query(cls.id, cls.user_id) \
+                .filter(db.or_(db.not_(cls.status), cls.updated_at < before)) \
+                .order_by(cls.id).limit(chunk_size).all()
+            if not rows:
+                return archived_wishlists, archived_items
+            ids = [wishlist_id for wishlist_id, _ in rows]
+            connection = db.session.connection()
+            _copy_wishlists(connection, cls, Item, ArchivedWishlist,
+                            ArchivedItem, ids,
+                            archived_at=db.literal(datetime.utcnow(),
+                                                   db.DateTime))
+            products = db.session.query(Item.product_id, db.func.count(Item.id)) \
+                .filter(Item.wishlist_id.in_(ids)) \
+                .group_by(Item.product_id).all()
+            items = sum(count for _, count in products)
+            # the items go with their wishlists through ON DELETE CASCADE
+            cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            users = defaultdict(int)
+            for _, user_id in rows:
+                users[user_id] -= 1
+            Stats.add(db.session, users,
+                      {product_id: -count for product_id, count in products},
+                      {"wishlists": -len(ids), "items": -items})
+            Change.record(db.session, [
+                change_event("wishlist", wishlist_id, wishlist_id, user_id,
+                             "archived") for wishlist_id, user_id in rows])
+            db.session.commit()
+            archived_wishlists += len(ids)
+            archived_items += items
+
+    @classmethod
+    def restore(cls, wishlist_id: int):
+        """Moves an archived Wishlist and its items back to the hot tables
+
+        :param wishlist_id: the id of the archived Wishlist
+        :type wishlist_id: int
+
+        :return: True if it was restored, False if it is not archived
+        :rtype: bool
+
+        """
+        cls.logger.info("Restoring archived wishlist %s", wishlist_id)
+        archived = db.session.query(ArchivedWishlist.user_id) \
+            .filter(ArchivedWishlist.id == wishlist_id).with_for_update() \
+            .first()
+        if archived is None:
+            db.session.rollback()
+            return False
+        connection = db.session.connection()
+        # a restored wishlist is fresh, so it is not archived again at once
+        _copy_wishlists(connection, ArchivedWishlist, ArchivedItem, cls, Item,
+                        [wishlist_id], updated_at=db.literal(
+                            datetime.utcnow(), db.DateTime))
+        items = db.session.query(ArchivedItem.id, ArchivedItem.product_id) \
+            .filter(ArchivedItem.wishlist_id == wishlist_id).all()
+        products = defaultdict(int)
+        for _, product_id in items:
+            products[product_id] += 1
+        ArchivedWishlist.query.filter(ArchivedWishlist.id == wishlist_id) \
+            .delete(synchronize_session=False)
+        Stats.add(db.session, {archived.user_id: 1}, products,
+                  {"wishlists": 1, "items": len(items)})
+        # the items get events too, so consumers read them back
+        Change.record(db.session, [change_event(
+            "wishlist", wishlist_id, wishlist_id, archived.user_id,
+            "restored")] + [change_event(
+                "item", item_id, wishlist_id, archived.user_id, "restored")
+                            for item_id, _ in items])
+        db.session.commit()
+        return True
+
+
+##################################################
+# ARCHIVE MODELS
+##################################################
+class ArchivedItem(db.Model):
+    """ An Item of an archived Wishlist """
+
+    __tablename__ = 'item_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    wishlist_id = db.Column(db.Integer,
+                            db.ForeignKey('wishlist_archive.id',
+                                          ondelete='CASCADE'),
+                            nullable=False, index=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    position = db.Column(POSITION_TYPE, nullable=False)
+
+    _product_name = None
+    product_name = Item.product_name
+    serialize = Item.serialize
+
+
+class ArchivedWishlist(db.Model, PersistentBase):
+    """
+    A Wishlist moved out of the hot tables because it was disabled or had
+    not been updated for a long time
+
+    Archived Wishlists are read by id and by explicitly asking list
+    queries for them; Wishlist.restore() brings one back.
+    """
+
+    __tablename__ = 'wishlist_archive'
+
+    logger = logging.getLogger(__name__)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(63), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.Boolean, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+    items = db.relationship('ArchivedItem', cascade="all,delete",
+                            passive_deletes=True, lazy=True,
+                            order_by=[ArchivedItem.position, ArchivedItem.id])
+
+    serialize = Wishlist.serialize
+    find_many = classmethod(Wishlist.find_many.__func__)
+
+    def delete(self):
+        """ Removes an archived Wishlist and its items for good """
+        # record_changes only writes the events of the hot tables
+        Change.record(db.session, [change_event(
+            "wishlist", self.id, self.id, self.user_id, "deleted")])
+        super().delete()
+
+    @classmethod
+    def find_by_filters(cls, user_id: int = None, name: str = None,
+                        status: bool = None, product_id: int = None,
+                        min_items: int = None, max_items: int = None):
+        """ Returns the archived Wishlists matching Wishlist.find_by_filters """
+        cls.logger.info("Processing archived filter query user_id=%s ...",
+                        user_id)
+        return _filter_wishlists(cls, ArchivedItem, user_id, name, status,
+                                 product_id, min_items, max_items)
+
+
+def serialize_items(items, names: dict = None):
+    """ Serializes Items, reading the names they need in one query """
+    items = list(items)
+    if names is None:
+        names = product_names.get_many({item.product_id for item in items
+                                        if item._product_name is None})
+    return [item.serialize(names) for item in items]
+
+
+def serialize_wishlists(wishlists):
+    """ Serializes Wishlists, reading the names of all their items at once """
+    wishlists = list(wishlists)
+    names = product_names.get_many({
+        item.product_id for wishlist in wishlists for item in wishlist.items
+        if item._product_name is None})
+    return [wishlist.serialize(names) for wishlist in wishlists]
+
+
+def _filter_wishlists(wishlist, item, user_id, name, status, product_id,
+                      min_items, max_items):
+    """ Builds the query of Wishlist.find_by_filters on a pair of models """
+    # pylint: disable=too-many-arguments
+    query = wishlist.query
+    if user_id is not None:
+        query = query.filter(wishlist.user_id == user_id)
+    if name is not None:
+        query = query.filter(wishlist.name == name)
+    if status is not None:
+        query = query.filter(wishlist.status == status)
+    if product_id is not None:
+        query = query.filter(wishlist.items.any(item.product_id == product_id))
+    if min_items is not None or max_items is not None:
+        item_count = db.session.query(db.func.count(item.id)) \
+            .filter(item.wishlist_id == wishlist.id) \
+            .correlate(wishlist).as_scalar()
+        if min_items is not None:
+            query = query.filter(item_count >= min_items)
+        if max_items is not None:
+            query = query.filter(item_count <= max_items)
+    return query.order_by(wishlist.id)
+
+
+def _copy_wishlists(connection, wishlist, item, wishlist_copy, item_copy,
+                    ids: list, **values):
+    """Copies Wishlists and their items between tables of the same shape
+
+    :param values: SQL expressions for columns of the copy that the
+        source does not have or whose value changes
+    """
+    # pylint: disable=too-many-arguments
+    for source, target, key in ((wishlist, wishlist_copy, wishlist.id),
+                                (item, item_copy, item.wishlist_id)):
+        source_columns = source.__table__.c
+        names = [column.name for column in target.__table__.c
+                 if column.name in values or column.name in source_columns]
+        columns = [values.get(name, source_columns.get(name)) for name in names]
+        connection.execute(target.__table__.insert().from_select(
+            names, select(columns).where(key.in_(ids))))
+
+
+##################################################
+# STATISTICS MODELS
+##################################################
+class UserStats(db.Model):
+    """ Number of wishlists each user owns """
+
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    wishlist_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ProductStats(db.Model):
+    """ Number of wishlist items referencing each product """
+
+    __tablename__ = 'product_stats'
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class TotalStats(db.Model):
+    """
+    Service wide totals such as the number of wishlists and items
+
+    Each total is spread over several stripes that writers pick at random
+    and readers add up, so concurrent writers rarely wait for the same row.
+    """
+
+    __tablename__ = 'total_stats'
+
+    name = db.Column(db.String(63), primary_key=True)
+    stripe = db.Column(db.Integer, primary_key=True, autoincrement=False,
+                       default=0)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Stats():
+    """
+    Aggregate statistics over Wishlists and Items
+
+    The counters are kept up to date inside the transactions that change
+    them, so reading them never scans the wishlist or item tables. The
+    deltas of a transaction are added up as it goes and written once when
+    it commits, users before products before totals and each in key order,
+    so the counter rows are locked briefly and always in the same order.
+    """
+
+    logger = logging.getLogger(__name__)
+    # the rows each total is spread over
+    stripes = 8
+
+    @classmethod
+    def summary(cls):
+        """ Returns the total number of wishlists and items """
+        cls.logger.info("Processing stats summary")
+        totals = dict(db.session.query(TotalStats.name,
+                                       db.func.sum(TotalStats.value))
+                      .group_by(TotalStats.name))
+        wishlists = totals.get("wishlists", 0)
+        items = totals.get("items", 0)
+        return {
+            "wishlists": wishlists,
+            "items": items,
+            "items_per_wishlist": items / wishlists if wishlists else 0.0
+        }
+
+    @classmethod
+    def for_user(cls, user_id: int):
+        """ Returns the number of wishlists owned by a user """
+        cls.logger.info("Processing stats for user %s", user_id)
+        stats = UserStats.query.get(user_id)
+        return {
+            "user_id": user_id,
+            "wishlists": stats.wishlist_count if stats else 0
+        }
+
+    @classmethod
+    def top_products(cls, limit: int):
+        """ Returns the products found in the most wishlist items """
+        cls.logger.info("Processing top %s products", limit)
+        query = ProductStats.query.filter(ProductStats.item_count > 0) \
+            .order_by(ProductStats.item_count.desc(),
+                      ProductStats.product_id) \
+            .limit(limit)
+        return [{"product_id": stats.product_id, "items": stats.item_count}
+                for stats in query]
+
+    @classmethod
+    def product_counts(cls, product_ids: list):
+        """ Returns the item counts of some products keyed by product id """
+        return dict(db.session.query(ProductStats.product_id,
+                                     ProductStats.item_count)
+                    .filter(ProductStats.product_id.in_(product_ids)))
+
+    @classmethod
+    def add(cls, session, users: dict, products: dict, totals: dict):
+        """Adds deltas to the counters when the session commits
+
+        :param users: wishlist count deltas keyed by user id
+        :param products: item count deltas keyed by product id
+        :param totals: deltas of the totals keyed by name
+        """
+        pending = session.info.setdefault(
+            "stats", (defaultdict(int), defaultdict(int), defaultdict(int)))
+        for counts, deltas in zip(pending, (users, products, totals)):
+            for key, delta in deltas.items():
+                counts[key] += delta
+
+    @classmethod
+    def apply(cls, connection, users: dict, products: dict, totals: dict):
+        """Adds deltas to the counters using the given connection
+
+        Callers outside of a session apply the deltas of a transaction at
+        once, like Stats.add does on commit.
+
+        :param users: wishlist count deltas keyed by user id
+        :param products: item count deltas keyed by product id
+        :param totals: deltas of the totals keyed by name
+        """
+        # sorted keys keep the row lock order stable across transactions
+        for user_id in sorted(users):
+            cls._add(connection, UserStats.__table__, "user_id", user_id,
+                     "wishlist_count", users[user_id])
+        for product_id in sorted(products):
+            cls._add(connection, ProductStats.__table__, "product_id",
+                     product_id, "item_count", products[product_id])
+        stripe = random.randrange(cls.stripes)
+        for name in sorted(totals):
+            cls._add(connection, TotalStats.__table__, ("name", "stripe"),
+                     (name, stripe), "value", totals[name])
+
+    @classmethod
+    def rebuild(cls):
+        """ Recomputes every counter from the wishlist and item tables """
+        cls.logger.info("Rebuilding stats")
+        for model in (UserStats, ProductStats, TotalStats):
+            model.query.delete()
+        users = db.session.query(Wishlist.user_id, db.func.count(Wishlist.id)) \
+            .group_by(Wishlist.user_id)
+        products = db.session.query(Item.product_id, db.func.count(Item.id)) \
+            .group_by(Item.product_id)
+        db.session.add_all(UserStats(user_id=user_id, wishlist_count=count)
+                           for user_id, count in users)
+        db.session.add_all(ProductStats(product_id=product_id, item_count=count)
+                           for product_id, count in products)
+        db.session.add(TotalStats(name="wishlists",
+                                  value=Wishlist.query.count()))
+        db.session.add(TotalStats(name="items", value=Item.query.count()))
+        db.session.commit()
+
+    @staticmethod
+    def _add(connection, table, key_name, key, column_name, delta):
+        """Adds delta to one counter row, creating the row if needed
+
+        key_name and key are tuples for tables with a composite key.
+        """
+        if delta == 0:
+            return
+        if not isinstance(key_name, tuple):
+            key_name, key = (key_name,), (key,)
+        values = dict(zip(key_name, key))
+        column = table.c[column_name]
+        if connection.dialect.name == "postgresql":
+            statement = postgresql.insert(table).values(
+                dict(values, **{column_name: delta}))
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[table.c[name] for name in key_name],
+                set_={column_name: column + delta}))
+            return
+        result = connection.execute(
+            table.update()
+            .where(db.and_(*[table.c[name] == value
+                             for name, value in values.items()]))
+            .values({column_name: column + delta}))
+        if result.rowcount == 0:
+            connection.execute(table.insert()
+                               .values(dict(values, **{column_name: delta})))
+
+
+##################################################
+# SHARD DIRECTORY MODEL
+##################################################
+class UserShard(db.Model):
+    """
+    The shard of a user who does not live on their hashed home shard
+
+    Users are pinned here while they are being moved or rebalanced; the
+    directory always lives on shard 0. A move goes through three states,
+    so an interrupted one can be finished by running it again:
+
+    - "copying": requests still go to shard, the rows are being copied to
+      move_shard
+    - "deleting": requests go to shard, the rows left on move_shard are
+      copied if missing and deleted
+    - "pinned": requests go to shard and no move is under way
+    """
+
+    __tablename__ = 'user_shard'
+    __table_args__ = {'info': {'unsharded': True}}
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.Integer, nullable=False)
+    state = db.Column(db.String(15), nullable=False, default="pinned")
+    move_shard = db.Column(db.Integer, nullable=True)
+
+
+class WishlistShard(db.Model):
+    """
+    The shard of a wishlist that was moved out of its id's range
+
+    Shard k hands out ids from k times SHARD_ID_SPACE, so a wishlist is
+    found from its id unless its user was moved; a move records where
+    each of their wishlists went. The directory lives on shard 0.
+    """
+
+    __tablename__ = 'wishlist_shard'
+    __table_args__ = {'info': {'unsharded': True}}
+
+    wishlist_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.Integer, nullable=False)
+
+
+##################################################
+# IDEMPOTENCY KEY MODEL
+##################################################
+class IdempotencyKey(db.Model):
+    """
+    A request sent with an Idempotency-Key header and the response it got
+
+    Keys belong to a client and a path; the response is None while the
+    first request is running. Keys live on shard 0.
+    """
+
+    __tablename__ = 'idempotency_key'
+    __table_args__ = {'info': {'unsharded': True}}
+
+    client = db.Column(db.String(255), primary_key=True)
+    path = db.Column(db.String(255), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    response = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+##################################################
+# CHANGE FEED MODEL
+##################################################
+class Change(db.Model):
+    """
+    An outbox event for a Wishlist or Item that was created, updated or
+    deleted
+
+    Events are written in the transaction of the change itself, so the feed
+    holds exactly the committed changes. Writers never wait for each other:
+    each event keeps the id of the transaction that wrote it (txid, 0 on
+    sqlite, where transactions write one at a time anyway) and the feed is
+    ordered by txid and then id. Readers only see the events of the
+    transactions older than every transaction still running (the xmin of
+    their snapshot), and no transaction that ends later can add an event
+    before those, so a reader that has seen an event has seen every event
+    before it.
+    """
+
+    logger = logging.getLogger(__name__)
+    # woken on every commit that wrote events, for long-polling readers
+    committed = threading.Condition()
+
+    __table_args__ = (db.Index("ix_change_txid_id", "txid", "id"),
+                      {'sqlite_autoincrement': True})
+
+    id = db.Column(db.Integer, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, default=0)
+    entity = db.Column(db.String(15), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    wishlist_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    op = db.Column(db.String(15), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, index=True)
+
+    def serialize(self):
+        """ Serializes a Change into a dictionary """
+        return {
+            "cursor": self.id,
+            "entity": self.entity,
+            "id": self.entity_id,
+            "wishlist_id": self.wishlist_id,
+            "user_id": self.user_id,
+            "op": self.op,
+            "created_at": self.created_at.isoformat()
+        }
+
+    @classmethod
+    def record(cls, session, events: list):
+        """Writes events in the current transaction of a session
+
+        :param events: dictionaries with the entity, entity_id, wishlist_id,
+            user_id and op of each change
+        """
+        if not events:
+            return
+        cls.insert(session.connection(), events)
+        session.info["changes_recorded"] = True
+
+    @classmethod
+    def insert(cls, connection, events: list):
+        """ Writes events on a connection, tagged with its transaction id """
+        txid = 0
+        if connection.dialect.name == "postgresql":
+            txid = connection.execute(select([db.func.txid_current()])).scalar()
+        connection.execute(cls.__table__.insert(),
+                           [dict(event, txid=txid) for event in events])
+
+    @classmethod
+    def _committed(cls):
+        """ Returns a query of the events no running transaction can precede """
+        query = cls.query
+        if db.session.connection().dialect.name == "postgresql":
+            query = query.filter(cls.txid < db.func.txid_snapshot_xmin(
+                db.func.txid_current_snapshot()))
+        return query
+
+    @classmethod
+    def since(cls, cursor: int, limit: int, user_id: int = None,
+              wishlist_id: int = None):
+        """Returns the events after a cursor
+
+        :param cursor: only events with a greater id are returned
+        :type cursor: int
+        :param limit: the maximum number of events to return
+        :type limit: int
+        :param user_id: only return events of this user's wishlists
+        :type user_id: int
+        :param wishlist_id: only return events of this wishlist
+        :type wishlist_id: int
+
+        :return: the events in the order of the feed
+        :rtype: list
+
+        """
+        cls.logger.info("Processing changes since %s ...", cursor)
+        query = cls._committed()
+        txid = db.session.query(cls.txid).filter(cls.id == cursor).scalar() \
+            if cursor else None
+        if txid is None:
+            # the start of the feed, or a cursor whose event was pruned
+            query = query.filter(cls.id > cursor)
+        else:
+            query = query.filter(db.or_(
+                cls.txid > txid, db.and_(cls.txid == txid, cls.id > cursor)))
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        if wishlist_id is not None:
+            query = query.filter(cls.wishlist_id == wishlist_id)
+        query = query.order_by(cls.txid, cls.id).limit(limit)
+        return [change.serialize() for change in query]
+
+    @classmethod
+    def latest(cls):
+        """ Returns the cursor of the last event, 0 if there is none """
+        last = cls._committed().with_entities(cls.id) \
+            .order_by(cls.txid.desc(), cls.id.desc()).first()
+        return last[0] if last else 0
+
+    @classmethod
+    def wait(cls, cursor: int, limit: int, timeout: float, interval: float,
+             since=None, **filters):
+        """Returns the events after a cursor, waiting for some if there are none
+
+        Commits in this process wake the waiting readers at once; the table
+        is also read again every interval for commits in other processes.
+        No connection is held between reads.
+
+        :param timeout: the longest to wait for an event, in seconds
+        :param interval: the longest between two reads, in seconds
+        :param since: reads the events after cursor, Change.since by default
+        :param filters: the user_id or wishlist_id filters of since()
+
+        :return: the events, empty if none came within the timeout
+        :rtype: list
+
+        """
+        since = since or cls.since
+        deadline = time.monotonic() + timeout
+        while True:
+            changes = since(cursor, limit, **filters)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                return changes
+            db.session.rollback()  # give the connection back while waiting
+            with cls.committed:
+                cls.committed.wait(min(interval, remaining))
+
+    @classmethod
+    def prune(cls, before: datetime):
+        """ Deletes the events written before a time and returns how many """
+        cls.logger.info("Pruning changes before %s", before)
+        count = cls.query.filter(cls.created_at < before) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+def change_event(entity, entity_id, wishlist_id, user_id, op):
+    """ Builds the outbox event of one change """
+    return {"entity": entity, "entity_id": entity_id,
+            "wishlist_id": wishlist_id, "user_id": user_id, "op": op}
+
+
+def _changed_values(obj, attribute):
+    """ Returns the old and new values of an attribute changed in a flush """
+    history = inspect(obj).attrs[attribute].history
+    return history.deleted, history.added
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """ Makes sqlite enforce foreign keys so that ON DELETE CASCADE works """
+    # pylint: disable=unused-argument
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+@event.listens_for(Session, "before_flush")
+def count_cascaded_items(session, flush_context, instances):
+    """ Counts the unloaded items the database will delete with wishlists """
+    # pylint: disable=unused-argument
+    wishlist_ids = [obj.id for obj in session.deleted
+                    if isinstance(obj, Wishlist)]
+    if not wishlist_ids:
+        return
+    # loaded items are deleted by the flush itself and counted from it
+    loaded_ids = [obj.id for obj in session.deleted if isinstance(obj, Item)]
+    with session.no_autoflush:
+        query = session.query(Item.product_id, db.func.count(Item.id)) \
+            .filter(Item.wishlist_id.in_(wishlist_ids))
+        if loaded_ids:
+            query = query.filter(~Item.id.in_(loaded_ids))
+        session.info["cascaded_products"] = \
+            query.group_by(Item.product_id).all()
+
+
+@event.listens_for(Session, "before_flush")
+def register_products(session, flush_context, instances):
+    """ Adds the products of written items missing from the catalog """
+    # pylint: disable=unused-argument,protected-access
+    names = {}
+    pending = []
+    for objects in (session.new, session.identity_map.values()):
+        for obj in objects:
+            if isinstance(obj, Item) and obj._product_name_pending:
+                obj._product_name_pending = False
+                if obj._product_name is not None:
+                    names.setdefault(obj.product_id, obj._product_name)
+                    pending.append(obj)
+    if names:
+        # the catalog names win over the names given to the items
+        catalog = Product.register(session, names)
+        for obj in pending:
+            obj._product_name = catalog.get(obj.product_id,
+                                            obj._product_name)
+
+
+@event.listens_for(Session, "before_flush")
+def assign_positions(session, flush_context, instances):
+    """ Ranks new items after the last item of their wishlists """
+    # pylint: disable=unused-argument
+    pending = [obj for obj in session.new
+               if isinstance(obj, Item) and obj.position is None]
+    if not pending:
+        return
+    groups = OrderedDict()
+    for obj in pending:
+        # the wishlist the item was appended to, without loading it
+        wishlist = obj.__dict__.get("wishlist")
+        if wishlist is not None:
+            groups.setdefault(("wishlist", id(wishlist)),
+                              (wishlist.id, wishlist, []))
+        else:
+            groups.setdefault(("id", obj.wishlist_id),
+                              (obj.wishlist_id, None, []))[2].append(obj)
+    wishlist_ids = {wishlist_id for wishlist_id, _, _ in groups.values()
+                    if wishlist_id is not None}
+    last = {}
+    if wishlist_ids:
+        with session.no_autoflush:
+            last = dict(session.query(Item.wishlist_id,
+                                      db.func.max(Item.position))
+                        .filter(Item.wishlist_id.in_(wishlist_ids))
+                        .group_by(Item.wishlist_id))
+    for wishlist_id, wishlist, items in groups.values():
+        if wishlist is not None:
+            # in the order they were appended to the wishlist
+            with session.no_autoflush:
+                items = [item for item in wishlist.items
+                         if item.position is None]
+        position = last.get(wishlist_id)
+        for item in items:
+            position = rank_between(position)
+            item.position = position
+
+
+@event.listens_for(Product.__table__, "after_drop")
+def forget_product_names(target, connection, **kwargs):
+    """ Drops the cached names of a catalog that no longer exists """
+    # pylint: disable=unused-argument
+    product_names.clear()
+
+
+@event.listens_for(Session, "after_flush")
+def track_stats(session, flush_context):
+    """ Adds the wishlists and items written by a flush to the stats """
+    # pylint: disable=unused-argument
+    users = defaultdict(int)
+    products = defaultdict(int)
+    totals = defaultdict(int)
+    for product_id, count in session.info.pop("cascaded_products", []):
+        products[product_id] -= count
+        totals["items"] -= count
+    for objects, delta in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if isinstance(obj, Wishlist):
+                users[obj.user_id] += delta
+                totals["wishlists"] += delta
+            elif isinstance(obj, Item):
+                products[obj.product_id] += delta
+                totals["items"] += delta
+    for obj in session.dirty:
+        if isinstance(obj, Wishlist):
+            counts, attribute = users, "user_id"
+        elif isinstance(obj, Item):
+            counts, attribute = products, "product_id"
+        else:
+            continue
+        old_values, new_values = _changed_values(obj, attribute)
+        for value in old_values:
+            if value is not None:
+                counts[value] -= 1
+        for value in new_values:
+            counts[value] += 1
+    if users or products or totals:
+        Stats.add(session, users, products, totals)
+
+
+@event.listens_for(Session, "after_flush")
+def record_changes(session, flush_context):
+    """ Writes an outbox event for each wishlist and item a flush wrote """
+    # pylint: disable=unused-argument
+    owners = {}
+    changed = []
+    for objects, op in ((session.new, "created"), (session.dirty, "updated"),
+                        (session.deleted, "deleted")):
+        for obj in objects:
+            if not isinstance(obj, (Wishlist, Item)) or (
+                    op == "updated" and
+                    not session.is_modified(obj, include_collections=False)):
+                continue
+            if isinstance(obj, Wishlist):
+                owners[obj.id] = obj.user_id
+            changed.append((obj, op))
+    missing = {obj.wishlist_id for obj, _ in changed
+               if isinstance(obj, Item) and obj.wishlist_id not in owners}
+    if missing:
+        with session.no_autoflush:
+            owners.update(session.query(Wishlist.id, Wishlist.user_id)
+                          .filter(Wishlist.id.in_(missing)))
+    Change.record(session, [
+        change_event("wishlist", obj.id, obj.id, owners[obj.id], op)
+        if isinstance(obj, Wishlist) else
+        change_event("item", obj.id, obj.wishlist_id,
+                     owners.get(obj.wishlist_id), op)
+        for obj, op in changed])
+
+
+@event.listens_for(Session, "after_flush")
+def touch_wishlists(session, flush_context):
+    """ Marks the wishlists whose items a flush wrote as updated """
+    # pylint: disable=unused-argument
+    written = set()
+    wishlist_ids = set()
+    for objects, dirty in ((session.new, False), (session.dirty, True),
+                           (session.deleted, False)):
+        for obj in objects:
+            if isinstance(obj, Wishlist) and not dirty:
+                written.add(obj.id)
+            elif isinstance(obj, Item) and (not dirty or session.is_modified(
+                    obj, include_collections=False)):
+                wishlist_ids.add(obj.wishlist_id)
+    wishlist_ids -= written
+    if wishlist_ids:
+        table = Wishlist.__table__
+        session.connection().execute(
+            table.update().where(table.c.id.in_(wishlist_ids))
+            .values(updated_at=datetime.utcnow()))
+
+
+@event.listens_for(Session, "before_commit")
+def apply_stats(session):
+    """ Writes the stats deltas of a transaction just before it commits """
+    # the commit would flush after this, too late for its deltas
+    session.flush()
+    deltas = session.info.pop("stats", None)
+    if deltas:
+        Stats.apply(session.connection(), *deltas)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_stats(session):
+    """ Drops the stats deltas of a rolled back transaction """
+    session.info.pop("stats", None)
+
+
+@event.listens_for(Session, "after_commit")
+def notify_changes(session):
+    """ Wakes the readers waiting for the events a commit wrote """
+    if session.info.pop("changes_recorded", False):
+        with Change.committed:
+            Change.committed.notify_all()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_changes(session):
+    """ Drops the mark of events that were rolled back """
+    session.info.pop("changes_recorded", None)
+
+
+@event.listens_for(Session, "after_commit")
+def cache_written_products(session):
+    """ Caches the product names a commit wrote """
+    product_names.put(session.info.pop("products_written", {}))
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_written_products(session):
+    """ Drops names cached while a rolled back transaction wrote them """
+    product_names.forget(session.info.pop("products_written", {}))
@@ -0,0 +1,139 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Patch documents for PATCH requests
+
+JSON Merge Patch (RFC 7386) and JSON Patch (RFC 6902) are applied to the
+serialized form of a resource and return the patched copy. Turning that
+copy into database changes is left to the models.
+"""
+import copy
+from service.models import DataValidationError
+
+MERGE_PATCH = "application/merge-patch+json"
+JSON_PATCH = "application/json-patch+json"
+
+
+def apply_merge_patch(target, patch):
+    """Applies a JSON Merge Patch
+
+    :param target: the document to patch, it is left unchanged
+    :param patch: the merge patch; null members remove keys
+
+    :return: the patched document
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+def apply_json_patch(document, operations):
+    """Applies a JSON Patch
+
+    The add, remove, replace and test operations are supported. The root
+    path "" refers to the whole document; it can be added, replaced and
+    tested but not removed.
+
+    :param document: the document to patch, it is left unchanged
+    :param operations: the list of patch operations
+
+    :return: the patched document
+    """
+    if not isinstance(operations, list):
+        raise DataValidationError(
+            "Invalid JSON Patch: body should be a list of operations")
+    document = copy.deepcopy(document)
+    for operation in operations:
+        try:
+            op = operation["op"]
+            path = operation["path"]
+        except (KeyError, TypeError):
+            raise DataValidationError(
+                "Invalid JSON Patch: operations need an op and a path")
+        if op not in ("add", "remove", "replace", "test"):
+            raise DataValidationError(
+                "Invalid JSON Patch: unsupported op '{}'".format(op))
+        if op != "remove" and "value" not in operation:
+            raise DataValidationError(
+                "Invalid JSON Patch: '{}' needs a value".format(op))
+        if path == "":
+            document = _patch_root(document, op, operation.get("value"))
+            continue
+        parent, key = _resolve(document, path, op == "add")
+        if op == "add":
+            if isinstance(parent, list):
+                parent.insert(key, copy.deepcopy(operation["value"]))
+            else:
+                parent[key] = copy.deepcopy(operation["value"])
+        elif op == "remove":
+            del parent[key]
+        elif op == "replace":
+            parent[key] = copy.deepcopy(operation["value"])
+        elif parent[key] != operation["value"]:
+            raise DataValidationError(
+                "Invalid JSON Patch: test of '{}' failed".format(path))
+    return document
+
+
+def _patch_root(document, op, value):
+    """ Applies an operation on the whole document """
+    if op == "remove":
+        raise DataValidationError(
+            "Invalid JSON Patch: the whole document cannot be removed")
+    if op == "test":
+        if document != value:
+            raise DataValidationError("Invalid JSON Patch: test of '' failed")
+        return document
+    return copy.deepcopy(value)
+
+
+def _resolve(document, path, adding):
+    """ Returns the container and key a JSON Pointer refers to """
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise DataValidationError(
+            "Invalid JSON Patch: bad path '{}'".format(path))
+    tokens = [token.replace("~1", "/").replace("~0", "~")
+              for token in path[1:].split("/")]
+    parent = document
+    try:
+        for token in tokens[:-1]:
+            parent = parent[_key(parent, token, False)]
+        key = _key(parent, tokens[-1], adding)
+        if not adding:
+            parent[key]  # pylint: disable=pointless-statement
+    except (KeyError, IndexError, TypeError):
+        raise DataValidationError(
+            "Invalid JSON Patch: path '{}' does not exist".format(path))
+    return parent, key
+
+
+def _key(container, token, adding):
+    """ Converts a JSON Pointer token to a dict key or list index """
+    if not isinstance(container, list):
+        return token
+    if adding and token == "-":
+        return len(container)
+    if not token.isdigit():
+        raise IndexError(token)
+    index = int(token)
+    if index > len(container) or (index == len(container) and not adding):
+        raise IndexError(token)
+    return index
@@ -0,0 +1,162 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Item Positions
+
+Items are ordered by fractional ranks: strings of base 36 digits compared
+byte by byte, like the digits after a decimal point. There is always a rank
+between two others, so moving an item rewrites that item alone. Ranks get
+longer as items are squeezed into the same gap; a background thread then
+spreads the ranks of the wishlist evenly again.
+"""
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("flask.app")
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+BASE = len(DIGITS)
+
+
+def rank_between(before: str = None, after: str = None):
+    """Returns a rank that sorts strictly between two ranks
+
+    Ranks never end with the digit 0, so there is always room before them.
+
+    :param before: the rank to sort after, None for the start of the list
+    :param after: the rank to sort before, None for the end of the list
+
+    :return: the new rank
+    :rtype: str
+    """
+    if after is None:
+        return _increment(before) if before else DIGITS[BASE // 2]
+    if not before:
+        return _decrement(after)
+    rank = ""
+    index = 0
+    while True:
+        low = DIGITS.index(before[index]) if index < len(before) else 0
+        high = DIGITS.index(after[index]) if after is not None and \
+            index < len(after) else BASE
+        if high - low > 1:
+            return rank + DIGITS[(low + high) // 2]
+        rank += DIGITS[low]
+        if high > low:
+            after = None  # the rank sorts before after from here on
+        index += 1
+
+
+def _increment(rank):
+    """ Returns the next rank of the same length, or a longer one """
+    digits = [DIGITS.index(digit) for digit in rank]
+    while True:
+        position = len(digits) - 1
+        while position >= 0 and digits[position] == BASE - 1:
+            digits[position] = 0
+            position -= 1
+        if position < 0:
+            # out of room at this length: doubling it keeps appends to
+            # ranks of logarithmic length
+            return rank + "0" * (len(rank) - 1) + DIGITS[1]
+        digits[position] += 1
+        if digits[-1]:
+            return "".join(DIGITS[digit] for digit in digits)
+
+
+def _decrement(rank):
+    """ Returns the previous rank of the same length, or a longer one """
+    digits = [DIGITS.index(digit) for digit in rank]
+    while True:
+        position = len(digits) - 1
+        while position >= 0 and digits[position] == 0:
+            digits[position] = BASE - 1
+            position -= 1
+        if position < 0:
+            break
+        digits[position] -= 1
+        if not any(digits):
+            break
+        if digits[-1]:
+            return "".join(DIGITS[digit] for digit in digits)
+    # out of room at this length, as for _increment
+    return "0" * len(rank) + DIGITS[-1] * len(rank)
+
+
+def spread_ranks(count: int):
+    """ Returns count ascending ranks of one length, evenly spaced """
+    length = 1
+    while BASE ** length < (count + 1) * BASE // 2:
+        length += 1
+    ranks = []
+    for number in range(1, count + 1):
+        value = number * BASE ** length // (count + 1)
+        digits = []
+        for _ in range(length):
+            value, digit = divmod(value, BASE)
+            digits.append(DIGITS[digit])
+        ranks.append("".join(reversed(digits)).rstrip("0"))
+    return ranks
+
+
+class PositionRebalancer():
+    """
+    Spreads the ranks of wishlists in a background thread
+
+    :param app: the Flask app whose context the rebalancing runs in
+    :param spread: called with a wishlist id, rewrites its ranks in a
+        transaction of its own
+    """
+
+    def __init__(self, app, spread):
+        self.app = app
+        self.spread = spread
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self, wishlist_id: int):
+        """ Queues a wishlist unless it is waiting to be rebalanced already """
+        with self._lock:
+            if wishlist_id in self._queued:
+                return
+            self._queued.add(wishlist_id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="rebalance-positions",
+                                                daemon=True)
+                self._thread.start()
+        self._queue.put(wishlist_id)
+
+    def join(self):
+        """ Waits until every queued wishlist has been rebalanced """
+        self._queue.join()
+
+    def _run(self):
+        """ Rebalances the queued wishlists for as long as the process lives """
+        while True:
+            wishlist_id = self._queue.get()
+            with self._lock:
+                self._queued.discard(wishlist_id)
+            try:
+                with self.app.app_context():
+                    self.spread(wishlist_id)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Rebalancing positions of wishlist %s failed: %s",
+                             wishlist_id, error)
+            finally:
+                self._queue.task_done()
@@ -17,43 +17,135 @@ Wishlist Service
 
 Paths:
 ------
-GET /wishlists - returns a list all of the wishlists
-GET /wishlists/{wishlist_id} - returns the wishlist with a given id number
+GET /metrics - returns the admission control counters
+GET /wishlists - returns a list all of the wishlists, optionally filtered by
+                 any combination of user_id, name, status, product_id,
+                 min_items and max_items; archived wishlists are only
+                 listed with include_archived=true
+GET /wishlists?ids=1,2,3 - returns the wishlists with the given ids, in order
+POST /wishlists/lookup - returns the wishlists with the ids in the posted body
+GET /wishlists/explain - returns the SQL and query plan of a filtered list
+                         (admin only)
+GET /wishlists/{wishlist_id} - returns the wishlist with a given id number,
+                              archived or not
 POST /wishlists - creates a new wishlist record in the database
 PUT /wishlists/{wishlist_id} - updates a wishlist record in the database
+PATCH /wishlists/{wishlist_id} - applies a JSON Merge Patch or JSON Patch to a
+                                 wishlist and its items
 DELETE /wishlists/{wishlist_id} - deletes a wishlist record in the database
 PUT /wishlists/{wishlist_id}/enabled - enables a wishlist record in the database
 PUT /wishlists/{wishlist_id}/disabled - disables a wishlist record in the database
+GET /wishlists/autocomplete - returns the names of a user's wishlists that
+                              start with the given prefix
 GET /wishlists/{wishlist_id}/items - returns a list all the items of the given wishlist
 POST /wishlists/{wishlist_id}/items - creates an item in the given wishlist
 GET /wishlists/{wishlist_id}/items/{item_id} - returns an item with item id
                                                 in the given wishlist
 DELETE /wishlists/{wishlist_id}/items/{item_id} - deletes an item with item id
                                                     in the given wishlist
+PUT /wishlists/{wishlist_id}/items/{item_id}/position - moves an item after
+                                                         another one
+PUT /users/{user_id}/wishlists/enabled - enables all the wishlists of a user
+PUT /users/{user_id}/wishlists/disabled - disables all the wishlists of a user
+DELETE /users/{user_id}/wishlists - deletes all the wishlists of a user
+GET /products/{product_id} - returns the catalog entry of a product
+PUT /products/{product_id} - renames a product for every item holding it
+GET /products/{product_id}/wishlists - returns a page of the wishlists
+                                       holding the product
+GET /stats - returns the total number of wishlists and items
+GET /stats/users/{user_id} - returns the number of wishlists of a user
+GET /stats/products - returns the products in the most wishlist items
+GET /changes?since={cursor} - returns the wishlist and item changes after
+                              a cursor, waiting for some if asked to
+GET /changes/stream - streams the changes of a user or wishlist as
+                      Server-Sent Events
+POST /admin/exports - starts an export of all wishlists and items to files
+GET /admin/exports/{job_id} - returns the progress and report of an export
+GET /analytics - returns the size of the in-memory analytics snapshot
+GET /analytics/item-counts - returns how many wishlists hold each number
+                             of items
+GET /analytics/top-products - returns the products in the most items of a
+                              cohort of users
+GET /analytics/top-users - returns the users with the most items
+
+Every request has a deadline (REQUEST_DEADLINE_MS, per route in
+ROUTE_DEADLINES_MS); requests and queries running past it answer 504.
+
+With SHARD_URIS set, requests for a user or a wishlist run on its shard and
+the others gather their results from every shard.
 """
 
-from flask import jsonify, request, abort
+import hmac
+import json
+import time
+from datetime import datetime, timedelta
+import click
+from flask import Response, jsonify, request, abort, stream_with_context
 from flask_api import status  # HTTP Status Codes
-from flask_restplus import Api, Resource, fields, reqparse
+from flask_restplus import Api, Resource, fields, reqparse, inputs
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest
+from werkzeug.urls import url_encode
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
-from service.models import Wishlist, Item, DataValidationError
+from service.models import (Wishlist, ArchivedWishlist, Item, Product, Stats,
+                            Change, DataValidationError, serialize_items,
+                            serialize_wishlists)
+from service.patch import (MERGE_PATCH, JSON_PATCH, apply_merge_patch,
+                           apply_json_patch)
+from service.batching import GroupCommitter
+from service.idempotency import IdempotencyStore, idempotent
+from service.admission import AdmissionControl, ConcurrencyLimiter
+from service.deadlines import Deadlines
+from service.export import FORMATS, ExportJobs, export_snapshot
+from service.analytics import AnalyticsSnapshot
+from service.sharding import ShardRouter
+from service.positions import PositionRebalancer
+from service.assets import StaticAssets
+from service.apidocs import ApiSpec
 
 # Import Flask application
 from . import app
 
 
+# throttles and sheds requests before they reach the routes below
+admission = AdmissionControl(app)
+# bounds every request and its database statements by a per-route deadline
+deadlines = Deadlines(app)
+# moves the database session of each request to its user's shard
+shards = ShardRouter(app)
+# serves the UI files under content-hashed URLs that are cached for good
+assets = StaticAssets(app)
+
+
+@app.route('/metrics')
+def metrics():
+    """ Returns the service counters for monitoring """
+    return jsonify(admission=admission.metrics())
+
+
+@app.after_request
+def add_etag(response):
+    """ Tags JSON GET responses so clients can revalidate them for a 304 """
+    if request.method == "GET" and response.status_code == 200 and \
+            response.mimetype == "application/json" and \
+            not response.is_streamed and "ETag" not in response.headers:
+        response.add_etag()
+        response = response.make_conditional(request)
+    return response
+
+
 @app.route('/items.html')
 def items():
     """ Loads the items.html page """
-    return app.send_static_file('items.html')
+    return assets.send_page('items.html')
 
 
 @app.route('/')
 def homepage():
     """ Loads the homepage (wishlist) page """
-    return app.send_static_file('index.html')
+    return assets.send_page('index.html')
 
 
 ######################################################################
@@ -68,6 +160,9 @@ api = Api(app,
           doc='/apidocs/index.html',  # default also could use doc='/apidocs/index.html'
           )
 
+# serves swagger.json from bytes built once instead of on every request
+api_spec = ApiSpec(app, api)
+
 # Define the model so that the docs reflect what can be sent
 item_model = api.model('Item', {
     'id': fields.Integer(readOnly=True,
@@ -77,7 +172,9 @@ item_model = api.model('Item', {
     'product_id': fields.Integer(required=True,
                                  description='Id of the item'),
     'product_name': fields.String(required=True,
-                                  description='Name of the item')
+                                  description='Name of the item'),
+    'position': fields.String(readOnly=True,
+                              description='Rank of the item in its wishlist')
 })
 
 wishlist_model = api.model('Wishlist', {
@@ -94,6 +191,16 @@ wishlist_model = api.model('Wishlist', {
                          description='List of items in the wishlist')
 })
 
+# a Wishlist, or an id with an error in the results of a multi-get
+lookup_result_model = api.clone('WishlistResult', wishlist_model, {
+    # read with get(), or a dict's own items method would be marshalled
+    'items': fields.List(fields.Nested(item_model),
+                         attribute=lambda wishlist: wishlist.get("items"),
+                         description='List of items in the wishlist'),
+    'error': fields.String(readOnly=True,
+                           description='Not Found for an id without a Wishlist')
+})
+
 create_model = api.model('Wishlist', {
     'name': fields.String(required=True,
                           description='The name of the Wishlist'),
@@ -104,6 +211,16 @@ create_model = api.model('Wishlist', {
                          description='List of items in the wishlist')
 })
 
+export_model = api.model('Export', {
+    'format': fields.String(required=True, enum=list(FORMATS),
+                            description='The file format of the export')
+})
+
+lookup_model = api.model('WishlistLookup', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The ids of the Wishlists to fetch')
+})
+
 create_item_model = api.model('Item', {
     'wishlist_id': fields.Integer(required=True,
                                   description='Wishlist id of the item'),
@@ -113,10 +230,72 @@ create_item_model = api.model('Item', {
                                   description='Name of the item')
 })
 
+position_model = api.model('ItemPosition', {
+    'after': fields.Integer(required=False,
+                            description='The item to follow, null or missing '
+                                        'for the first place')
+})
+
+product_model = api.model('Product', {
+    'id': fields.Integer(readOnly=True,
+                         description='The product identifier'),
+    'name': fields.String(required=True,
+                          description='The name shown for every item of the product')
+})
+
+# caps the change streams and long polls waiting at once, so they leave
+# threads for the other requests
+change_waiters = ConcurrencyLimiter(app.config["CHANGES_MAX_WAITERS"], 0, 0)
+
+# commits item additions from concurrent requests together when enabled
+item_committer = GroupCommitter(app, shards.create_items,
+                                app.config["GROUP_COMMIT_MAX_BATCH"],
+                                app.config["GROUP_COMMIT_MAX_DELAY_MS"] / 1000)
+
+# spreads the item ranks of wishlists whose ranks got too long
+position_rebalancer = PositionRebalancer(app, shards.spread_positions)
+
+# remembers the responses of POSTs sent with an Idempotency-Key header
+idempotency_store = IdempotencyStore(app.config["IDEMPOTENCY_TTL"],
+                                     app.config["IDEMPOTENCY_CLAIM_TIMEOUT"])
+
+# runs the exports started through the admin API
+export_jobs = ExportJobs(app, app.config["EXPORT_DIR"],
+                         app.config["EXPORT_CHUNK_SIZE"],
+                         app.config["EXPORT_MAX_JOBS"], shards.engines)
+
+# columnar copy of the tables behind the /analytics endpoints
+analytics = AnalyticsSnapshot(app.config["ANALYTICS_MAX_AGE"],
+                              app.config["ANALYTICS_MAX_DELTA"], shards)
+
 # query string arguments
 wishlist_args = reqparse.RequestParser()
 wishlist_args.add_argument('name', type=str, required=False, help='List wishlists by name')
 wishlist_args.add_argument('user_id', type=int, required=False, help='List wishlists by user_id')
+wishlist_args.add_argument('ids', type=str, required=False,
+                           help='Comma separated wishlist ids to fetch in one request')
+wishlist_args.add_argument('status', type=inputs.boolean, required=False,
+                           help='List enabled (true) or disabled (false) wishlists')
+wishlist_args.add_argument('product_id', type=int, required=False,
+                           help='List wishlists containing the product')
+wishlist_args.add_argument('min_items', type=int, required=False,
+                           help='List wishlists with at least this many items')
+wishlist_args.add_argument('max_items', type=int, required=False,
+                           help='List wishlists with at most this many items')
+wishlist_args.add_argument('include_archived', type=inputs.boolean, required=False,
+                           help='Also list the archived wishlists when true')
+wishlist_args.add_argument('after', type=int, required=False,
+                           help='Only list wishlists with a greater id (the next cursor)')
+wishlist_args.add_argument('limit', type=int, required=False,
+                           help='List at most this many wishlists, with a Link to the next page')
+
+autocomplete_args = reqparse.RequestParser()
+autocomplete_args.add_argument('user_id', type=int, required=True,
+                               help='Owner of the wishlists')
+autocomplete_args.add_argument('prefix', type=str, required=False,
+                               help='Leading characters of the wishlist name')
+autocomplete_args.add_argument('limit', type=int, required=False,
+                               help='Maximum number of names to return')
 
 
 ######################################################################
@@ -170,6 +349,20 @@ def method_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """ Handles conflicting requests with 409_CONFLICT """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_409_CONFLICT,
+            error="Conflict",
+            message=str(error),
+        ),
+        status.HTTP_409_CONFLICT,
+    )
+
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -184,6 +377,35 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """ Handles requests the service has no room for with 503_SERVICE_UNAVAILABLE """
+    app.logger.warning(str(error))
+    # a full response, so resources can also return it themselves
+    response = jsonify(
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        error="Service Unavailable",
+        message=str(error),
+    )
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.errorhandler(status.HTTP_504_GATEWAY_TIMEOUT)
+def gateway_timeout(error):
+    """ Handles requests that ran past their deadline with 504_GATEWAY_TIMEOUT """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_504_GATEWAY_TIMEOUT,
+            error="Gateway Timeout",
+            message=str(error),
+        ),
+        status.HTTP_504_GATEWAY_TIMEOUT,
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -224,7 +446,8 @@ class WishlistResource(Resource):
         This endpoint will return a Wishlist based on its id
         """
         app.logger.info("Request for wishlist with id: %s", wishlist_id)
-        wishlist = Wishlist.find(wishlist_id)
+        wishlist = Wishlist.find(wishlist_id) or \
+            ArchivedWishlist.find(wishlist_id)
         if not wishlist:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Wishlist with id '{}' was not found.".format(wishlist_id))
@@ -245,16 +468,70 @@ class WishlistResource(Resource):
         """
         app.logger.info("Request to update wishlist with id: %s", wishlist_id)
         check_content_type("application/json")
-        wishlist = Wishlist.find(wishlist_id)
+        try:
+            app.logger.debug('Payload = %s', api.payload)
+            data = Wishlist().deserialize(api.payload)
+        except (DataValidationError, BadRequest):
+            # a missing wishlist is reported before a bad body
+            if not (Wishlist.find(wishlist_id) or
+                    ArchivedWishlist.find(wishlist_id)):
+                api.abort(status.HTTP_404_NOT_FOUND,
+                          "Wishlist with id '{}' was not found.".format(wishlist_id))
+            raise
+        shards.check_owner(data.user_id)
+        values = {"name": data.name, "user_id": data.user_id}
+        wishlist = Wishlist.update_by_id(wishlist_id, values)
+        # an archived wishlist is brought back to be changed
+        if not wishlist and Wishlist.restore(wishlist_id):
+            wishlist = Wishlist.update_by_id(wishlist_id, values)
         if not wishlist:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Wishlist with id '{}' was not found.".format(wishlist_id))
-        app.logger.debug('Payload = %s', api.payload)
-        data = api.payload
-        wishlist.deserialize(data)
-        wishlist.id = wishlist_id
-        wishlist.save()
-        return wishlist.serialize(), status.HTTP_200_OK
+        return wishlist, status.HTTP_200_OK
+
+    ######################################################################
+    # PATCH A WISHLIST
+    ######################################################################
+    @api.doc('patch_wishlists')
+    @api.response(404, 'Wishlist not found')
+    @api.response(400, 'The patch was not valid')
+    @api.response(409, 'Two items would hold the same product')
+    @api.response(415, 'Unsupported patch format')
+    @api.marshal_with(wishlist_model)
+    def patch(self, wishlist_id):
+        """
+        Patch a Wishlist
+        This endpoint will apply a JSON Merge Patch (application/json or
+        application/merge-patch+json) or a JSON Patch
+        (application/json-patch+json) to the Wishlist and its items
+        """
+        app.logger.info("Request to patch wishlist with id: %s", wishlist_id)
+        content_type = request.headers.get("Content-Type")
+        if content_type not in ("application/json", MERGE_PATCH, JSON_PATCH):
+            abort(415, "Content-Type must be {} or {}"
+                  .format(MERGE_PATCH, JSON_PATCH))
+        wishlist = Wishlist.find_many([wishlist_id]).get(wishlist_id)
+        if not wishlist and Wishlist.restore(wishlist_id):
+            wishlist = Wishlist.find_many([wishlist_id]).get(wishlist_id)
+        if not wishlist:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Wishlist with id '{}' was not found.".format(wishlist_id))
+        patch = request.get_json(force=True)
+        app.logger.debug('Patch = %s', patch)
+        if content_type == JSON_PATCH:
+            document = apply_json_patch(wishlist.serialize(), patch)
+        else:
+            document = apply_merge_patch(wishlist.serialize(), patch)
+        if isinstance(document, dict):
+            shards.check_owner(document.get("user_id"))
+        try:
+            return wishlist.update_from(document), status.HTTP_200_OK
+        except IntegrityError:
+            # stored items are updated one by one, so even swapping two
+            # products collides on the unique (product_id, wishlist_id)
+            api.abort(status.HTTP_409_CONFLICT,
+                      "Wishlist with id '{}' cannot hold a product twice, "
+                      "move products through new items.".format(wishlist_id))
 
     ######################################################################
     # DELETE A WISHLIST
@@ -267,7 +544,8 @@ class WishlistResource(Resource):
         This endpoint will delete a Wishlist based the id specified in the path
         """
         app.logger.info("Request to delete wishlist with id: %s", wishlist_id)
-        wishlist = Wishlist.find(wishlist_id)
+        wishlist = Wishlist.find(wishlist_id) or \
+            ArchivedWishlist.find(wishlist_id)
         if wishlist:
             wishlist.delete()
 
@@ -287,31 +565,53 @@ class WishlistCollection(Resource):
     ######################################################################
     @api.doc('list_wishlists')
     @api.expect(wishlist_args, validate=True)
-    @api.marshal_list_with(wishlist_model)
+    @api.marshal_list_with(lookup_result_model, skip_none=True)
     def get(self):
         """ Returns all of the Wishlists """
         app.logger.info("Request for wishlist list")
-        if request.args:
-            user_id = request.args.get("user_id")
-            name = request.args.get("name")
-            if user_id:
-                try:
-                    user_id = int(user_id)
-                except ValueError:
-                    raise DataValidationError("user_id should be an integer")
-                wishlists = Wishlist.find_by_user_id(user_id)
-            elif name:
-                name = name.strip("\"\'")
-                wishlists = Wishlist.find_by_name(name)
-            else:
-                raise DataValidationError("query parameter does not exist")
-        else:
-            wishlists = Wishlist.all()
-
-        results = [wishlist.serialize() for wishlist in wishlists]
+        if "ids" in request.args:
+            if len(request.args) > 1:
+                raise DataValidationError("ids cannot be combined with other "
+                                          "query parameters")
+            ids = request.args.get("ids").split(",")
+            try:
+                ids = [int(wishlist_id) for wishlist_id in ids]
+            except ValueError:
+                raise DataValidationError("ids should be comma separated integers")
+            return lookup_wishlists(ids), status.HTTP_200_OK
+
+        filters = wishlist_filters()
+        filtered = any(value is not None for value in filters.values())
+        archived = bool_arg("include_archived", False)
+        after = int_arg("after", 0)
+        limit = int_arg("limit")
+        if limit is not None:
+            if limit < 1:
+                raise DataValidationError("limit should be a positive integer")
+            limit = min(limit, app.config["WISHLISTS_MAX_LIMIT"])
+
+        def read():
+            query = Wishlist.find_by_filters(**filters) if filtered \
+                else Wishlist.query.order_by(Wishlist.id)
+            wishlists = page(Wishlist, query, after, limit)
+            results = serialize_wishlists(wishlists)
+            if archived:
+                results.extend(serialize_wishlists(page(
+                    ArchivedWishlist,
+                    ArchivedWishlist.find_by_filters(**filters), after, limit)))
+                results.sort(key=lambda wishlist: wishlist["id"])
+            return results[:limit]
+
+        results = shards.collect(read)[:limit]
         app.logger.info("Returning %d wishlists", len(results))
         app.logger.debug("Results :%s", results)
-        return results, status.HTTP_200_OK
+        headers = {}
+        if limit is not None and len(results) == limit:
+            args = request.args.copy()
+            args["after"] = results[-1]["id"]
+            headers["Link"] = '<{}?{}>; rel="next"'.format(request.base_url,
+                                                           url_encode(args))
+        return results, status.HTTP_200_OK, headers
 
     ######################################################################
     # ADD A NEW WISHLIST
@@ -321,6 +621,9 @@ class WishlistCollection(Resource):
     @api.response(400, 'The posted data was not valid')
     @api.response(201, 'Wishlist created successfully')
     @api.marshal_with(wishlist_model, code=201)
+    @api.param('Idempotency-Key', 'Retries with the same key get the first response',
+               _in='header')
+    @idempotent(idempotency_store)
     def post(self):
         """
         Creates a Wishlist
@@ -335,11 +638,12 @@ class WishlistCollection(Resource):
         data = api.payload
 
         try:
-            items = []
+            items = {}
             for item in data["items"]:
-                new_item = Item()
-                items.append(new_item.deserialize(item))
-            wishlist.items = items
+                new_item = Item().deserialize(item)
+                # a product is in a wishlist once, the first one is kept
+                items.setdefault(new_item.product_id, new_item)
+            wishlist.items = list(items.values())
         except KeyError as error:
             raise DataValidationError("Invalid Wishlist: missing " +
                                       error.args[0])
@@ -354,6 +658,90 @@ class WishlistCollection(Resource):
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /wishlists/lookup
+######################################################################
+@api.route('/wishlists/lookup', strict_slashes=False)
+class LookupResource(Resource):
+    """ Fetches many Wishlists by id in one request """
+
+    @api.doc('lookup_wishlists')
+    @api.expect(lookup_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.marshal_list_with(lookup_result_model, skip_none=True)
+    def post(self):
+        """
+        Fetch many Wishlists
+        This endpoint will return the Wishlists with the posted ids in the
+        same order, with a not found marker for each id that does not exist
+        """
+        check_content_type("application/json")
+        data = api.payload
+        try:
+            ids = [int(wishlist_id) for wishlist_id in data["ids"]]
+        except KeyError:
+            raise DataValidationError("Invalid lookup: missing ids")
+        except (TypeError, ValueError):
+            raise DataValidationError("Invalid lookup: ids should be a list "
+                                      "of integers")
+        return lookup_wishlists(ids), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /wishlists/explain
+######################################################################
+@api.route('/wishlists/explain', strict_slashes=False)
+class ExplainResource(Resource):
+    """ Shows how the database runs a filtered list of Wishlists """
+
+    @api.doc('explain_list_wishlists')
+    @api.expect(wishlist_args)
+    @api.response(400, 'The query arguments were not valid')
+    @api.response(401, 'The admin token is missing or wrong')
+    @api.response(403, 'The admin API is disabled')
+    def get(self):
+        """
+        Explain a Wishlist query
+        This endpoint will return the SQL and the execution plan used for
+        GET /wishlists with the same query arguments. It needs the admin
+        token.
+        """
+        app.logger.info("Request to explain wishlist list")
+        check_admin()
+        query = Wishlist.find_by_filters(**wishlist_filters())
+        return Wishlist.explain(query), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /wishlists/autocomplete
+######################################################################
+@api.route('/wishlists/autocomplete', strict_slashes=False)
+class AutocompleteResource(Resource):
+    """ Suggests wishlist names for a user while they type """
+
+    @api.doc('autocomplete_wishlist_names')
+    @api.expect(autocomplete_args)
+    @api.response(400, 'The query arguments were not valid')
+    def get(self):
+        """
+        Autocomplete Wishlist names
+        This endpoint will return the names of a user's Wishlists that
+        start with the given prefix
+        """
+        user_id = int_arg("user_id")
+        if user_id is None:
+            raise DataValidationError("user_id is required")
+        prefix = request.args.get("prefix", "").strip("\"\'")
+        limit = int_arg("limit", app.config["AUTOCOMPLETE_LIMIT"])
+        if limit < 1:
+            raise DataValidationError("limit should be a positive integer")
+        limit = min(limit, app.config["AUTOCOMPLETE_MAX_LIMIT"])
+        app.logger.info("Request for names of user %s starting with '%s'",
+                        user_id, prefix)
+        names = Wishlist.find_names_by_prefix(user_id, prefix, limit)
+        return names, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /wishlists/{wishlist_id}/items
 ######################################################################
@@ -371,8 +759,11 @@ class ItemCollection(Resource):
     def get(self, wishlist_id):
         """ Returns all of the items in a Wishlist """
         app.logger.info("Request for items in the wishlist with id %s...", wishlist_id)
-        wishlist = Wishlist.find_or_404(wishlist_id)
-        results = [item.serialize() for item in wishlist.items]
+        wishlist = Wishlist.find(wishlist_id) or \
+            ArchivedWishlist.find(wishlist_id)
+        if not wishlist:
+            abort(404, "Wishlist '{}' was not found.".format(wishlist_id))
+        results = serialize_items(wishlist.items)
         return results, status.HTTP_200_OK
 
     ######################################################################
@@ -383,7 +774,11 @@ class ItemCollection(Resource):
     @api.response(400, 'The posted data was not valid')
     @api.response(404, 'Wishlist not found')
     @api.response(201, 'Add item to wishlist successfully')
+    @api.response(200, 'The product was in the wishlist already')
     @api.marshal_with(item_model, code=201)
+    @api.param('Idempotency-Key', 'Retries with the same key get the first response',
+               _in='header')
+    @idempotent(idempotency_store)
     def post(self, wishlist_id):
         """
         Adds items to a Wishlist
@@ -401,16 +796,20 @@ class ItemCollection(Resource):
                                       "wishlist_id in the url {}"
                                       .format(new_item.wishlist_id, wishlist_id))
 
-        wishlist = Wishlist.find_or_404(wishlist_id)
-        wishlist.items.append(new_item)
-
-        wishlist.save()
-        message = new_item.serialize()
+        result = add_item(new_item)
+        if result is None and Wishlist.restore(wishlist_id):
+            result = add_item(new_item)
+        if result is None:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Wishlist '{}' was not found.".format(wishlist_id))
+        message, created = result
         location_url = api.url_for(ItemResource,
-                                   wishlist_id=wishlist.id,
-                                   item_id=new_item.id,
+                                   wishlist_id=wishlist_id,
+                                   item_id=message["id"],
                                    _external=True)
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+        # adding a product already in the wishlist returns its item
+        code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        return message, code, {"Location": location_url}
 
 
 ######################################################################
@@ -440,7 +839,10 @@ class ItemResource(Resource):
         """
         app.logger.info("Request to get an item from a wishlist")
 
-        wishlist = Wishlist.find_or_404(wishlist_id)
+        wishlist = Wishlist.find(wishlist_id) or \
+            ArchivedWishlist.find(wishlist_id)
+        if not wishlist:
+            abort(404, "Wishlist '{}' was not found.".format(wishlist_id))
 
         get_item = None
 
@@ -467,6 +869,8 @@ class ItemResource(Resource):
         """
         app.logger.info("Request to delete an item from a wishlist")
         wishlist = Wishlist.find(wishlist_id)
+        if not wishlist and Wishlist.restore(wishlist_id):
+            wishlist = Wishlist.find(wishlist_id)
         if wishlist:
             get_item = None
             for item in wishlist.items:
@@ -481,6 +885,50 @@ class ItemResource(Resource):
         return '', status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+# PATH: /wishlists/<wishlist_id>/items/<item_id>/position
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/items/<int:item_id>/position',
+           strict_slashes=False)
+@api.param('wishlist_id', 'The wishlist identifier')
+@api.param('item_id', 'The wishlist item identifier')
+class ItemPositionResource(Resource):
+    """ The place of an Item in its Wishlist """
+
+    @api.doc('move_item')
+    @api.expect(position_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(404, 'Item or wishlist not found')
+    @api.marshal_with(item_model)
+    def put(self, wishlist_id, item_id):
+        """
+        Moves an item
+        This endpoint will put the Item right after the item given as
+        "after", or first when "after" is null, rewriting that Item only
+        """
+        app.logger.info("Request to move item %s of wishlist %s",
+                        item_id, wishlist_id)
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid position: body should be an "
+                                      "object")
+        after_id = data.get("after")
+        if after_id is not None and (not isinstance(after_id, int) or
+                                     isinstance(after_id, bool)):
+            raise DataValidationError("Invalid position: after should be an "
+                                      "item id or null")
+        message = Item.move(wishlist_id, item_id, after_id)
+        if message is None and Wishlist.restore(wishlist_id):
+            message = Item.move(wishlist_id, item_id, after_id)
+        if message is None:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Item with id '{}' was not found.".format(item_id))
+        if len(message["position"]) > app.config["POSITION_REBALANCE_LENGTH"]:
+            position_rebalancer.request(wishlist_id)
+        return message, status.HTTP_200_OK
+
+
 ######################################################################
 # PATH: /wishlists/{wishlist_id}/enabled
 ######################################################################
@@ -497,11 +945,12 @@ class EnableResource(Resource):
         This endpoint will enable a Wishlist based the id specified in the path
         """
         app.logger.info("Request to enable wishlist with id: %s", wishlist_id)
-        wishlist = Wishlist.find_or_404(wishlist_id)
-        wishlist.id = wishlist_id
-        wishlist.status = True
-        wishlist.save()
-        message = wishlist.serialize()
+        message = Wishlist.update_by_id(wishlist_id, {"status": True})
+        if not message and Wishlist.restore(wishlist_id):
+            message = Wishlist.update_by_id(wishlist_id, {"status": True})
+        if not message:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Wishlist '{}' was not found.".format(wishlist_id))
         app.logger.info("Wishlist with ID [%s] enabled.", wishlist_id)
         return message, status.HTTP_200_OK
 
@@ -522,15 +971,557 @@ class DisableResource(Resource):
         This endpoint will disable a Wishlist based the id specified in the path
         """
         app.logger.info("Request to disable wishlist with id: %s", wishlist_id)
-        wishlist = Wishlist.find_or_404(wishlist_id)
-        wishlist.id = wishlist_id
-        wishlist.status = False
-        wishlist.save()
-        message = wishlist.serialize()
+        message = Wishlist.update_by_id(wishlist_id, {"status": False})
+        if not message and Wishlist.restore(wishlist_id):
+            message = Wishlist.update_by_id(wishlist_id, {"status": False})
+        if not message:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Wishlist '{}' was not found.".format(wishlist_id))
         app.logger.info("Wishlist with ID [%s] disabled.", wishlist_id)
         return message, status.HTTP_200_OK
 
 
+######################################################################
+# PATH: /users/{user_id}/wishlists
+######################################################################
+@api.route('/users/<int:user_id>/wishlists', strict_slashes=False)
+@api.param('user_id', 'The user identifier')
+class UserWishlistsResource(Resource):
+    """ Actions on all of the Wishlists of a user """
+
+    @api.doc('delete_user_wishlists')
+    @api.response(200, 'Wishlists deleted')
+    def delete(self, user_id):
+        """
+        Delete all Wishlists of a user
+        This endpoint will delete every Wishlist of the user and their items
+        and return how many were deleted
+        """
+        app.logger.info("Request to delete wishlists of user %s", user_id)
+        wishlists, items = Wishlist.delete_by_user(
+            user_id, app.config["BULK_CHUNK_SIZE"])
+        app.logger.info("Deleted %s wishlists and %s items of user %s",
+                        wishlists, items, user_id)
+        return {"user_id": user_id, "wishlists": wishlists, "items": items}, \
+            status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /users/{user_id}/wishlists/enabled
+######################################################################
+@api.route('/users/<int:user_id>/wishlists/enabled', strict_slashes=False)
+@api.param('user_id', 'The user identifier')
+class UserEnableResource(Resource):
+    """ Enable all of the Wishlists of a user """
+
+    @api.doc('enable_user_wishlists')
+    def put(self, user_id):
+        """
+        Enable all Wishlists of a user
+        This endpoint will enable every Wishlist of the user and return how
+        many were changed
+        """
+        app.logger.info("Request to enable wishlists of user %s", user_id)
+        changed = Wishlist.set_status_by_user(
+            user_id, True, app.config["BULK_CHUNK_SIZE"])
+        return {"user_id": user_id, "wishlists": changed}, status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /users/{user_id}/wishlists/disabled
+######################################################################
+@api.route('/users/<int:user_id>/wishlists/disabled', strict_slashes=False)
+@api.param('user_id', 'The user identifier')
+class UserDisableResource(Resource):
+    """ Disable all of the Wishlists of a user """
+
+    @api.doc('disable_user_wishlists')
+    def put(self, user_id):
+        """
+        Disable all Wishlists of a user
+        This endpoint will disable every Wishlist of the user and return how
+        many were changed
+        """
+        app.logger.info("Request to disable wishlists of user %s", user_id)
+        changed = Wishlist.set_status_by_user(
+            user_id, False, app.config["BULK_CHUNK_SIZE"])
+        return {"user_id": user_id, "wishlists": changed}, status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /products/{product_id}/wishlists
+######################################################################
+@api.route('/products/<int:product_id>/wishlists', strict_slashes=False)
+@api.param('product_id', 'The product identifier')
+class ProductWishlistsResource(Resource):
+    """ The Wishlists a product has been added to """
+
+    @api.doc('list_product_wishlists')
+    @api.param('after', 'Only return wishlists with a greater id (the next cursor)')
+    @api.param('limit', 'Maximum number of wishlists to return')
+    @api.param('count', 'Only return the number of wishlists when true')
+    @api.response(400, 'The query arguments were not valid')
+    def get(self, product_id):
+        """
+        Returns the Wishlists holding a product
+        This endpoint will return a page of the wishlists and their users
+        that contain the product, with a cursor to the next page
+        """
+        app.logger.info("Request for wishlists holding product %s", product_id)
+        if bool_arg("count", False):
+            count = sum(shards.gather(
+                lambda: Wishlist.count_by_product(product_id)))
+            return {"product_id": product_id, "count": count}, status.HTTP_200_OK
+
+        after = int_arg("after", 0)
+        limit = int_arg("limit", app.config["PRODUCT_WISHLISTS_LIMIT"])
+        if limit < 1:
+            raise DataValidationError("limit should be a positive integer")
+        limit = min(limit, app.config["PRODUCT_WISHLISTS_MAX_LIMIT"])
+        wishlists = shards.collect(
+            lambda: Wishlist.find_by_product(product_id, after, limit))[:limit]
+        next_cursor = wishlists[-1]["id"] if len(wishlists) == limit else None
+        return {
+            "product_id": product_id,
+            "wishlists": wishlists,
+            "next": next_cursor
+        }, status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /products/{product_id}
+######################################################################
+@api.route('/products/<int:product_id>', strict_slashes=False)
+@api.param('product_id', 'The product identifier')
+class ProductResource(Resource):
+    """ The catalog entry of a product """
+
+    @api.doc('get_product')
+    @api.response(404, 'Product not found')
+    @api.marshal_with(product_model)
+    def get(self, product_id):
+        """
+        Returns a product
+        This endpoint will return the name shown for the items of a product
+        """
+        app.logger.info("Request for product %s", product_id)
+        product = Product.query.get(product_id)
+        if product is None:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Product '{}' was not found.".format(product_id))
+        return product.serialize(), status.HTTP_200_OK
+
+    @api.doc('rename_product')
+    @api.expect(product_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(404, 'Product not found')
+    @api.marshal_with(product_model)
+    def put(self, product_id):
+        """
+        Renames a product
+        This endpoint will change the name of every item of the product
+        with a single update of the catalog
+        """
+        app.logger.info("Request to rename product %s", product_id)
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, dict) or "name" not in data:
+            raise DataValidationError("Invalid Product: missing name")
+        product = Product.rename(product_id, data["name"])
+        if product is None:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Product '{}' was not found.".format(product_id))
+        return product, status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /stats
+######################################################################
+@api.route('/stats', strict_slashes=False)
+class StatsResource(Resource):
+    """ Totals over all Wishlists """
+
+    @api.doc('get_stats')
+    def get(self):
+        """
+        Returns Wishlist totals
+        This endpoint will return the number of wishlists and items
+        """
+        app.logger.info("Request for stats summary")
+        return shards.summary(), status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /stats/users/{user_id}
+######################################################################
+@api.route('/stats/users/<int:user_id>', strict_slashes=False)
+@api.param('user_id', 'The user identifier')
+class UserStatsResource(Resource):
+    """ Totals over the Wishlists of one user """
+
+    @api.doc('get_user_stats')
+    def get(self, user_id):
+        """
+        Returns the Wishlist totals of a user
+        This endpoint will return the number of wishlists the user owns
+        """
+        app.logger.info("Request for stats of user %s", user_id)
+        return Stats.for_user(user_id), status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /stats/products
+######################################################################
+@api.route('/stats/products', strict_slashes=False)
+class ProductStatsResource(Resource):
+    """ The most wishlisted products """
+
+    @api.doc('get_product_stats')
+    @api.param('limit', 'Maximum number of products to return')
+    @api.response(400, 'The query arguments were not valid')
+    def get(self):
+        """
+        Returns the most wishlisted products
+        This endpoint will return the products found in the most wishlist
+        items, most popular first
+        """
+        limit = int_arg("limit", app.config["STATS_PRODUCTS_LIMIT"])
+        if limit < 1:
+            raise DataValidationError("limit should be a positive integer")
+        limit = min(limit, app.config["STATS_PRODUCTS_MAX_LIMIT"])
+        app.logger.info("Request for top %s products", limit)
+        return shards.top_products(limit), status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /changes
+######################################################################
+@api.route('/changes', strict_slashes=False)
+class ChangeCollection(Resource):
+    """ The feed of changes to Wishlists and Items """
+
+    @api.doc('list_changes')
+    @api.param('since', 'Only return changes after this cursor (the next cursor)')
+    @api.param('limit', 'Maximum number of changes to return')
+    @api.param('wait', 'Seconds to wait for a change when there is none yet')
+    @api.param('user_id', 'Only return changes to the wishlists of this user')
+    @api.param('wishlist_id', 'Only return changes to this wishlist')
+    @api.response(400, 'The query arguments were not valid')
+    def get(self):
+        """
+        Returns the changes after a cursor
+        This endpoint will return the wishlists and items that were created,
+        updated or deleted after the cursor, in order, with the cursor to
+        ask for next. With wait it holds the request until a change arrives.
+        """
+        since = shards.parse_cursor(request.args.get("since") or 0)
+        limit = int_arg("limit", app.config["CHANGES_LIMIT"])
+        wait = int_arg("wait", 0)
+        if limit < 1:
+            raise DataValidationError("limit should be a positive integer")
+        if wait < 0:
+            raise DataValidationError("wait should not be negative")
+        limit = min(limit, app.config["CHANGES_MAX_LIMIT"])
+        wait = min(wait, app.config["CHANGES_MAX_WAIT"])
+        app.logger.info("Request for changes since %s", since)
+        filters = change_filters()
+        # with too many readers waiting already, a long poll answers at once
+        if wait and change_waiters.acquire():
+            # it keeps its thread but not a slot of the running requests
+            admission.release()
+            try:
+                changes = shards.wait_for_changes(
+                    since, limit, wait,
+                    app.config["CHANGES_POLL_INTERVAL_MS"] / 1000, **filters)
+            finally:
+                change_waiters.release()
+        else:
+            changes = shards.changes_since(since, limit, **filters)
+        next_cursor = changes[-1]["cursor"] if changes \
+            else shards.format_cursor(since)
+        return {"changes": changes, "next": next_cursor}, status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /changes/stream
+######################################################################
+@api.route('/changes/stream', strict_slashes=False)
+class ChangeStreamResource(Resource):
+    """ The feed of changes pushed as Server-Sent Events """
+
+    @api.doc('stream_changes')
+    @api.produces(['text/event-stream'])
+    @api.param('user_id', 'Only stream changes to the wishlists of this user')
+    @api.param('wishlist_id', 'Only stream changes to this wishlist')
+    @api.param('since', 'Start after this cursor instead of at the latest change')
+    @api.response(400, 'The query arguments were not valid')
+    @api.response(503, 'Too many change streams are open')
+    def get(self):
+        """
+        Streams the changes of a user or a wishlist
+        This endpoint will push every change after the cursor as a "change"
+        event whose id is its cursor. The stream ends after a while and
+        clients resume from the Last-Event-ID header when they reconnect.
+        """
+        filters = change_filters()
+        if not filters:
+            raise DataValidationError("user_id or wishlist_id is required")
+        cursor = request.headers.get("Last-Event-ID") or request.args.get("since")
+        if cursor is None:
+            cursor = shards.latest_cursor()
+        else:
+            cursor = shards.parse_cursor(cursor)
+        app.logger.info("Request to stream changes %s since %s", filters, cursor)
+        if not change_waiters.acquire():
+            return service_unavailable("Too many change streams are open")
+        # it keeps its thread but not a slot of the running requests
+        admission.release()
+        response = Response(stream_with_context(change_events(cursor, filters)),
+                            mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache",
+                                     "X-Accel-Buffering": "no"})
+        response.call_on_close(change_waiters.release)
+        return response
+
+
+######################################################################
+# PATH: /admin/exports
+######################################################################
+@api.route('/admin/exports', strict_slashes=False)
+class ExportCollection(Resource):
+    """ Exports of all Wishlists and Items to files """
+
+    @api.doc('start_export')
+    @api.expect(export_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(401, 'The admin token is missing or wrong')
+    @api.response(403, 'The admin API is disabled')
+    @api.response(409, 'Another export is running')
+    @api.response(202, 'Export started')
+    def post(self):
+        """
+        Starts an export
+        This endpoint will start writing a snapshot of all the wishlists and
+        items to CSV or Parquet files and return the job to poll
+        """
+        check_admin()
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid Export: body should be an object")
+        fmt = data.get("format", "csv")
+        job = export_jobs.start(fmt)
+        app.logger.info("Started %s export %s", fmt, job["id"])
+        location_url = api.url_for(ExportResource, job_id=job["id"],
+                                   _external=True)
+        return job, status.HTTP_202_ACCEPTED, {'Location': location_url}
+
+
+######################################################################
+# PATH: /admin/exports/{job_id}
+######################################################################
+@api.route('/admin/exports/<job_id>', strict_slashes=False)
+@api.param('job_id', 'The export job identifier')
+class ExportResource(Resource):
+    """ One export job """
+
+    @api.doc('get_export')
+    @api.response(401, 'The admin token is missing or wrong')
+    @api.response(403, 'The admin API is disabled')
+    @api.response(404, 'Export not found')
+    def get(self, job_id):
+        """
+        Returns an export job
+        This endpoint will return the status of the export and, once it is
+        done, the files written with their row counts and rows per second
+        """
+        check_admin()
+        job = export_jobs.get(job_id)
+        if job is None:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Export '{}' was not found.".format(job_id))
+        return job, status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /analytics
+######################################################################
+@api.route('/analytics', strict_slashes=False)
+class AnalyticsResource(Resource):
+    """ The in-memory analytics snapshot """
+
+    @api.doc('get_analytics')
+    @api.response(501, 'Analytics are not installed')
+    def get(self):
+        """
+        Returns the analytics snapshot size
+        This endpoint will return the number of wishlists, items, users and
+        products in the snapshot and the change cursor it is current to
+        """
+        check_analytics()
+        return analytics.summary(), status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /analytics/item-counts
+######################################################################
+@api.route('/analytics/item-counts', strict_slashes=False)
+class ItemCountsResource(Resource):
+    """ The distribution of the number of items per Wishlist """
+
+    @api.doc('get_item_counts')
+    @api.param('status', 'Only count enabled (true) or disabled (false) wishlists')
+    @api.response(400, 'The query arguments were not valid')
+    @api.response(501, 'Analytics are not installed')
+    def get(self):
+        """
+        Returns the item count histogram
+        This endpoint will return how many wishlists hold each number of items
+        """
+        check_analytics()
+        return analytics.item_count_histogram(bool_arg("status")), \
+            status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /analytics/top-products
+######################################################################
+@api.route('/analytics/top-products', strict_slashes=False)
+class TopProductsResource(Resource):
+    """ The most wishlisted products of a cohort of users """
+
+    @api.doc('get_top_products')
+    @api.param('limit', 'Maximum number of products to return')
+    @api.param('min_user_id', 'The lowest user id of the cohort')
+    @api.param('max_user_id', 'The highest user id of the cohort')
+    @api.param('status', 'Only count enabled (true) or disabled (false) wishlists')
+    @api.response(400, 'The query arguments were not valid')
+    @api.response(501, 'Analytics are not installed')
+    def get(self):
+        """
+        Returns the top products of a cohort
+        This endpoint will return the products found in the most items of
+        the wishlists of the users in the cohort, most popular first
+        """
+        check_analytics()
+        return analytics.top_products(analytics_limit(),
+                                      int_arg("min_user_id"),
+                                      int_arg("max_user_id"),
+                                      bool_arg("status")), status.HTTP_200_OK
+
+
+######################################################################
+# PATH: /analytics/top-users
+######################################################################
+@api.route('/analytics/top-users', strict_slashes=False)
+class TopUsersResource(Resource):
+    """ The users with the most wishlisted items """
+
+    @api.doc('get_top_users')
+    @api.param('limit', 'Maximum number of users to return')
+    @api.response(400, 'The query arguments were not valid')
+    @api.response(501, 'Analytics are not installed')
+    def get(self):
+        """
+        Returns the top users
+        This endpoint will return the users with the most items across their
+        wishlists and how many wishlists they own
+        """
+        check_analytics()
+        return analytics.top_users(analytics_limit()), status.HTTP_200_OK
+
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+@app.cli.command("rebuild-stats")
+def rebuild_stats():
+    """ Recomputes the wishlist statistics from the wishlist tables """
+    shards.every(Stats.rebuild)
+
+
+@app.cli.command("apidocs")
+@click.option("--output", default=None,
+              help="Also write the Swagger document to this file")
+def apidocs(output):
+    """ Checks that the Swagger document covers every API route """
+    problems = api_spec.check()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException("The API document is out of sync with "
+                                   "the routes")
+    if output:
+        with open(output, "wb") as document:
+            document.write(api_spec.body)
+    click.echo("{} paths documented".format(len(api_spec.schema["paths"])))
+
+
+@app.cli.command("export")
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="csv",
+              help="The file format to write")
+@click.option("--output", default=None,
+              help="The directory to write to (EXPORT_DIR by default)")
+def export(fmt, output):
+    """ Exports a snapshot of all wishlists and items to files """
+    report = export_snapshot(output or app.config["EXPORT_DIR"], fmt,
+                             app.config["EXPORT_CHUNK_SIZE"], shards.engines())
+    for table, exported in report["files"].items():
+        click.echo("{}: {} rows to {}".format(table, exported["rows"],
+                                             exported["path"]))
+    click.echo("{} rows in {}s ({} rows/s)".format(
+        report["rows"], report["seconds"], report["rows_per_second"]))
+
+
+@app.cli.command("prune-changes")
+def prune_changes():
+    """ Deletes the change feed events older than the retention period """
+    days = app.config["CHANGES_RETENTION_DAYS"]
+    before = datetime.utcnow() - timedelta(days=days)
+    count = sum(shards.every(lambda: Change.prune(before)))
+    app.logger.info("Pruned %d changes older than %d days", count, days)
+
+
+@app.cli.command("prune-idempotency-keys")
+def prune_idempotency_keys():
+    """ Deletes the idempotency keys that expired """
+    count = idempotency_store.prune()
+    app.logger.info("Pruned %d expired idempotency keys", count)
+
+
+@app.cli.command("archive-wishlists")
+def archive_wishlists():
+    """ Moves disabled and stale wishlists to the archive tables """
+    days = app.config["ARCHIVE_AFTER_DAYS"]
+    before = datetime.utcnow() - timedelta(days=days)
+    counts = shards.every(lambda: Wishlist.archive(
+        before, app.config["BULK_CHUNK_SIZE"]))
+    click.echo("Archived {} wishlists and {} items".format(
+        sum(wishlists for wishlists, _ in counts),
+        sum(items for _, items in counts)))
+
+
+@app.cli.command("move-user")
+@click.argument("user_id", type=int)
+@click.argument("shard", type=int)
+def move_user(user_id, shard):
+    """ Moves the wishlists of a user to another shard """
+    if not 0 <= shard < shards.count:
+        raise click.BadParameter("there are {} shards".format(shards.count))
+    moved = shards.move_user(user_id, shard)
+    click.echo("Moved {} wishlists of user {} to shard {}".format(
+        moved, user_id, shard))
+
+
+@app.cli.command("rebalance")
+@click.option("--pin", is_flag=True,
+              help="Only pin the users who are not on their home shard")
+def rebalance(pin):
+    """ Moves every user to the shard they hash to """
+    count = shards.rebalance(pin)
+    click.echo("{} {} users".format("Pinned" if pin else "Moved", count))
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -538,6 +1529,140 @@ def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Wishlist.init_db(app)
+    shards.init_shards()
+
+
+def lookup_wishlists(ids):
+    """ Returns the Wishlists with the ids and a marker for missing ones """
+    ids = list(dict.fromkeys(ids))  # drop duplicates but keep the order
+    if len(ids) > app.config["MULTIGET_MAX_IDS"]:
+        raise DataValidationError("at most {} ids can be fetched at once"
+                                  .format(app.config["MULTIGET_MAX_IDS"]))
+    app.logger.info("Request for %d wishlists by id", len(ids))
+    found = {}
+    for shard_found in shards.gather(lambda: {
+            wishlist["id"]: wishlist for wishlist
+            in serialize_wishlists(Wishlist.find_many(ids).values())}):
+        found.update(shard_found)
+    # the rest may be archived, which GET /wishlists/{id} also returns
+    missing = [wishlist_id for wishlist_id in ids if wishlist_id not in found]
+    if missing:
+        for shard_found in shards.gather(lambda: {
+                wishlist["id"]: wishlist for wishlist in serialize_wishlists(
+                    ArchivedWishlist.find_many(missing).values())}):
+            found.update(shard_found)
+    return [found.get(wishlist_id, {"id": wishlist_id, "error": "Not Found"})
+            for wishlist_id in ids]
+
+
+def add_item(item):
+    """ Adds an Item, in a group commit when enabled, or None if no wishlist """
+    if app.config["GROUP_COMMIT_ENABLED"]:
+        return item_committer.submit(item, deadlines.remaining())
+    return Item.create_many([item])[0]
+
+
+def int_arg(name, default=None):
+    """ Returns an integer query string argument or the default if absent """
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise DataValidationError("{} should be an integer".format(name))
+
+
+def bool_arg(name, default=None):
+    """ Returns a boolean query string argument or the default if absent """
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise DataValidationError("{} should be true or false".format(name))
+
+
+def wishlist_filters():
+    """ Returns the Wishlist filter criteria given in the query string """
+    known = ("user_id", "name", "status", "product_id",
+             "min_items", "max_items", "include_archived", "after", "limit")
+    if any(arg not in known for arg in request.args):
+        raise DataValidationError("query parameter does not exist")
+    name = request.args.get("name", "").strip("\"\'")
+    return {
+        "user_id": int_arg("user_id"),
+        "name": name or None,
+        "status": bool_arg("status"),
+        "product_id": int_arg("product_id"),
+        "min_items": int_arg("min_items"),
+        "max_items": int_arg("max_items")
+    }
+
+
+def page(model, query, after, limit):
+    """ Returns the page of a query by id after a cursor, at most limit rows """
+    if after:
+        query = query.filter(model.id > after)
+    return query if limit is None else query.limit(limit)
+
+
+def check_analytics():
+    """ Answers 501 when the analytics dependencies are not installed """
+    if not analytics.available():
+        api.abort(status.HTTP_501_NOT_IMPLEMENTED,
+                  "Analytics need the numpy package")
+
+
+def analytics_limit():
+    """ Returns the limit argument of the analytics top lists """
+    limit = int_arg("limit", app.config["ANALYTICS_LIMIT"])
+    if limit < 1:
+        raise DataValidationError("limit should be a positive integer")
+    return min(limit, app.config["ANALYTICS_MAX_LIMIT"])
+
+
+def change_filters():
+    """ Returns the user_id and wishlist_id change filters of the query string """
+    filters = {"user_id": int_arg("user_id"),
+               "wishlist_id": int_arg("wishlist_id")}
+    return {name: value for name, value in filters.items() if value is not None}
+
+
+def change_events(cursor, filters):
+    """ Generates the Server-Sent Events of the changes after a cursor """
+    ends = time.monotonic() + app.config["CHANGES_STREAM_SECONDS"]
+    interval = app.config["CHANGES_POLL_INTERVAL_MS"] / 1000
+    yield "retry: {}\n\n".format(app.config["CHANGES_POLL_INTERVAL_MS"])
+    while True:
+        remaining = ends - time.monotonic()
+        if remaining <= 0:
+            return
+        changes = shards.wait_for_changes(
+            cursor, app.config["CHANGES_MAX_LIMIT"],
+            min(remaining, app.config["CHANGES_HEARTBEAT_SECONDS"]),
+            interval, **filters)
+        if not changes:
+            yield ": keepalive\n\n"
+        for change in changes:
+            yield "id: {}\nevent: change\ndata: {}\n\n".format(
+                change["cursor"], json.dumps(change))
+            cursor = shards.parse_cursor(change["cursor"])
+
+
+def check_admin():
+    """ Lets only requests bearing the ADMIN_TOKEN through """
+    token = app.config["ADMIN_TOKEN"]
+    if not token:
+        api.abort(status.HTTP_403_FORBIDDEN, "The admin API is disabled, set "
+                  "ADMIN_TOKEN or use the flask commands")
+    given = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(given.encode(),
+                               "Bearer {}".format(token).encode()):
+        api.abort(status.HTTP_401_UNAUTHORIZED, "A valid admin token is "
+                  "required")
 
 
 def check_content_type(content_type):
@@ -0,0 +1,603 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sharding
+
+Spreads the wishlists, their items, stats and change events over several
+databases by user_id. A user lives on the shard with the highest
+rendezvous hash of their id, so adding a shard only moves the users who
+now hash to it, unless the shard directory on shard 0 pins them elsewhere.
+Requests for one user or one wishlist are routed to its shard before they
+run; the others are scattered over every shard and their results merged.
+Users are moved online by copying their rows to the new shard, switching
+the directory and then deleting the old rows, recording each step in the
+directory so an interrupted move can be finished. With one database
+nothing changes.
+"""
+import hashlib
+import heapq
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import select, text, union_all
+from service.models import (db, shard_bind, change_event, Wishlist,
+                            ArchivedWishlist, Item, ArchivedItem, Change,
+                            Stats, UserShard, WishlistShard,
+                            DataValidationError)
+
+logger = logging.getLogger("flask.app")
+
+# stay below the bound parameter limit of sqlite
+CHUNK_SIZE = 500
+
+
+class ShardRouter():
+    """ Routes the database session of each request to a shard """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.uris = []
+        self.id_space = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Registers the shards of the app config and hooks the app """
+        self.app = app
+        self.id_space = app.config["SHARD_ID_SPACE"]
+        self.configure(app.config["SHARD_URIS"])
+        app.before_request(self.route)
+        app.teardown_request(self.release)
+
+    def configure(self, uris: list):
+        """ Sets the URIs of the shards after shard 0 """
+        self.uris = list(uris)
+        binds = dict(self.app.config.get("SQLALCHEMY_BINDS") or {})
+        for key in [key for key in binds if str(key).startswith("shard")]:
+            del binds[key]
+        binds.update((shard_bind(shard), uri)
+                     for shard, uri in enumerate(self.uris, 1))
+        self.app.config["SQLALCHEMY_BINDS"] = binds or None
+
+    @property
+    def count(self):
+        """ The number of shards """
+        return 1 + len(self.uris)
+
+    def engine(self, shard: int):
+        """ Returns the engine of a shard """
+        return db.get_engine(self.app, bind=shard_bind(shard))
+
+    def engines(self):
+        """ Returns the engines of every shard """
+        return [self.engine(shard) for shard in range(self.count)]
+
+    def init_shards(self):
+        """ Creates the tables of every shard and starts their id ranges """
+        tables = [table for table in db.Model.metadata.sorted_tables
+                  if not table.info.get("unsharded")]
+        for shard in range(1, self.count):
+            engine = self.engine(shard)
+            db.Model.metadata.create_all(bind=engine, tables=tables)
+            with engine.begin() as connection:
+                for table in (Wishlist.__table__, Item.__table__,
+                              Change.__table__):
+                    _start_ids(connection, table.name, shard * self.id_space)
+
+    ##################################################
+    # ROUTING
+    ##################################################
+
+    def current(self):
+        """ Returns the shard the session is on """
+        return db.session.info.get("shard", 0)
+
+    def use(self, shard: int):
+        """ Moves the session to a shard, closing it if it was elsewhere """
+        if self.current() != shard:
+            # objects of one shard must not be mistaken for another's
+            db.session.close()
+            db.session.info["shard"] = shard
+
+    @contextmanager
+    def using(self, shard: int):
+        """ Runs a block on a shard and moves the session back after it """
+        previous = self.current()
+        self.use(shard)
+        try:
+            yield
+        finally:
+            self.use(previous)
+
+    def route(self):
+        """ Runs before each request and moves the session to its shard """
+        if self.count == 1:
+            return
+        shard = self._request_shard()
+        if shard is not None:
+            g.shard = shard
+        self.use(shard or 0)
+
+    def release(self, exception=None):
+        """ Runs after each request and moves the session back to shard 0 """
+        # pylint: disable=unused-argument
+        g.pop("shard", None)
+        if self.count > 1:
+            self.use(0)
+
+    def _request_shard(self):
+        """ Returns the shard of a request's wishlist or user, if it has one """
+        view_args = request.view_args or {}
+        if "wishlist_id" in view_args:
+            return self.shard_for_wishlist(view_args["wishlist_id"])
+        user_id = view_args.get("user_id", request.args.get("user_id"))
+        if user_id is None and request.method == "POST":
+            body = request.get_json(silent=True)
+            if isinstance(body, dict):
+                user_id = body.get("user_id")
+        try:
+            return self.shard_for_user(int(user_id))
+        except (TypeError, ValueError):
+            return None
+
+    def home_shard(self, user_id: int):
+        """ Returns the shard a user hashes to """
+        def weight(shard):
+            key = "{}:{}".format(shard, user_id).encode()
+            return int.from_bytes(hashlib.md5(key).digest()[:8], "big")
+        return max(range(self.count), key=weight)
+
+    def shard_for_user(self, user_id: int):
+        """ Returns the shard a user lives on """
+        if self.count == 1:
+            return 0
+        pinned = db.session.query(UserShard.shard) \
+            .filter(UserShard.user_id == user_id).scalar()
+        if pinned is not None and pinned < self.count:
+            return pinned
+        return self.home_shard(user_id)
+
+    def shard_for_wishlist(self, wishlist_id: int):
+        """Returns the shard a wishlist is on, its id's range if none
+
+        The id's range names the shard the wishlist was created on and the
+        wishlist_shard directory the shard it was moved to. The other
+        shards are only probed for ids found in neither, such as sqlite
+        ids that ran past their range.
+        """
+        if self.count == 1:
+            return 0
+        origin = wishlist_id // self.id_space
+        if not 0 <= origin < self.count:
+            origin = 0
+        query = union_all(*[select([table.c.id]).where(table.c.id == wishlist_id)
+                            for table in (Wishlist.__table__,
+                                          ArchivedWishlist.__table__)])
+        if db.session.execute(query, bind=self.engine(origin)).first():
+            return origin
+        moved = db.session.query(WishlistShard.shard) \
+            .filter(WishlistShard.wishlist_id == wishlist_id).scalar()
+        if moved is not None and moved < self.count:
+            return moved
+        for shard in range(self.count):
+            if shard != origin and db.session.execute(
+                    query, bind=self.engine(shard)).first():
+                return shard
+        return origin
+
+    def check_owner(self, user_id):
+        """ Refuses to give a wishlist to a user who lives on another shard """
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return  # left to the validation of the wishlist
+        if self.count > 1 and self.shard_for_user(user_id) != self.current():
+            raise DataValidationError(
+                "user_id {} is on another shard, wishlists cannot be given to "
+                "them".format(user_id))
+
+    ##################################################
+    # SCATTER-GATHER
+    ##################################################
+
+    def every(self, function):
+        """ Runs function on every shard and returns its results in order """
+        if self.count == 1:
+            return [function()]
+        results = []
+        for shard in range(self.count):
+            with self.using(shard):
+                results.append(function())
+        return results
+
+    def gather(self, function):
+        """ Runs function on the request's shard, or every shard if unrouted """
+        if "shard" in g:
+            return [function()]
+        return self.every(function)
+
+    def collect(self, function, key="id"):
+        """ Gathers lists of rows and merges them by key """
+        results = self.gather(function)
+        if len(results) == 1:
+            return results[0]
+        return sorted((row for rows in results for row in rows),
+                      key=lambda row: row[key])
+
+    def summary(self):
+        """ Returns the totals of Stats.summary() over every shard """
+        summaries = self.gather(Stats.summary)
+        wishlists = sum(summary["wishlists"] for summary in summaries)
+        items = sum(summary["items"] for summary in summaries)
+        return {
+            "wishlists": wishlists,
+            "items": items,
+            "items_per_wishlist": items / wishlists if wishlists else 0.0
+        }
+
+    def top_products(self, limit: int):
+        """Returns the products in the most items over every shard
+
+        Each round asks every shard for its top products and then for their
+        exact counts everywhere. A product missing from every list cannot
+        have more items than the sum of the smallest counts listed, so the
+        round is final once the limit-th product reaches that sum;
+        otherwise the next round asks for twice as many.
+        """
+        if self.count == 1:
+            return Stats.top_products(limit)
+        fetch = limit
+        while True:
+            tops = self.every(lambda: Stats.top_products(fetch))
+            candidates = sorted({entry["product_id"]
+                                 for top in tops for entry in top})
+            counts = defaultdict(int)
+            for shard_counts in self.every(
+                    lambda: Stats.product_counts(candidates)):
+                for product_id, count in shard_counts.items():
+                    counts[product_id] += count
+            ranked = sorted(counts.items(), key=lambda entry: (-entry[1],
+                                                               entry[0]))
+            unseen = sum(top[-1]["items"] for top in tops if len(top) == fetch)
+            if not unseen or (len(ranked) >= limit and
+                              ranked[limit - 1][1] >= unseen):
+                return [{"product_id": product_id, "items": count}
+                        for product_id, count in ranked[:limit]]
+            fetch *= 2
+
+    def create_items(self, items: list):
+        """ Runs Item.create_many on the shards of the items' wishlists """
+        if self.count == 1:
+            return Item.create_many(items)
+        by_shard = defaultdict(list)
+        for index, item in enumerate(items):
+            by_shard[self.shard_for_wishlist(item.wishlist_id)].append(index)
+        results = [None] * len(items)
+        for shard, indexes in by_shard.items():
+            with self.using(shard):
+                created = Item.create_many([items[index] for index in indexes])
+            for index, result in zip(indexes, created):
+                results[index] = result
+        return results
+
+    def spread_positions(self, wishlist_id: int):
+        """ Runs Item.spread_positions on the shard of a wishlist """
+        with self.using(self.shard_for_wishlist(wishlist_id)):
+            return Item.spread_positions(wishlist_id)
+
+    ##################################################
+    # CHANGE FEED
+    ##################################################
+
+    def parse_cursor(self, text):
+        """Reads a change feed cursor into its position on each shard
+
+        With one shard the cursor is the event id, otherwise the positions
+        joined with dots; 0 is the start of the feed either way.
+        """
+        try:
+            positions = [int(part) for part in str(text).split(".")]
+        except ValueError:
+            raise DataValidationError("since should be a change cursor")
+        if positions == [0]:
+            return [0] * self.count
+        if len(positions) != self.count:
+            raise DataValidationError("since should be a change cursor of {} "
+                                      "shards".format(self.count))
+        return positions
+
+    def format_cursor(self, positions: list):
+        """ Writes the positions of a cursor as parse_cursor() reads them """
+        if self.count == 1:
+            return positions[0]
+        return ".".join(str(position) for position in positions)
+
+    def latest_cursor(self):
+        """ Returns the positions of the last event of every shard """
+        return self.every(Change.latest)
+
+    def changes_since(self, cursor: list, limit: int, **filters):
+        """Returns the events of every shard after a cursor
+
+        The events of each shard keep their order and the shards are merged
+        by time. The cursor of each event is the cursor to resume after it.
+        """
+        if self.count == 1:
+            return Change.since(cursor[0], limit, **filters)
+        shard_changes = [
+            [(shard, change) for change in changes]
+            for shard, changes in enumerate(self.every(
+                lambda: Change.since(cursor[self.current()], limit,
+                                     **filters)))]
+        positions = list(cursor)
+        merged = []
+        for shard, change in heapq.merge(
+                *shard_changes, key=lambda entry: entry[1]["created_at"]):
+            if len(merged) == limit:
+                break
+            positions[shard] = change["cursor"]
+            change["cursor"] = self.format_cursor(positions)
+            merged.append(change)
+        return merged
+
+    def wait_for_changes(self, cursor: list, limit: int, timeout: float,
+                         interval: float, **filters):
+        """ Returns the events after a cursor, waiting for some as Change.wait """
+        return Change.wait(cursor, limit, timeout, interval,
+                           since=self.changes_since, **filters)
+
+    ##################################################
+    # REBALANCING
+    ##################################################
+
+    def move_user(self, user_id: int, target: int):
+        """Moves the wishlists of a user to another shard while online
+
+        A move of the user that was interrupted is finished first.
+
+        :return: the number of wishlists moved
+        :rtype: int
+        """
+        moved = self._resume(user_id)
+        source = self.shard_for_user(user_id)
+        db.session.commit()
+        return moved + self._move(user_id, source, target)
+
+    def rebalance(self, pin: bool = False):
+        """Moves every user who is not on their home shard back to it
+
+        Run it with pin first, before deploying a new list of shards: every
+        user whose home changes is pinned where they are, so the new list
+        routes them correctly until they are moved. Interrupted moves are
+        finished before anyone else is moved, and left alone by pin.
+
+        :return: the number of users pinned or moved
+        :rtype: int
+        """
+        table = UserShard.__table__
+        with self.engine(0).connect() as connection:
+            moving = {user_id for (user_id,) in connection.execute(
+                select([table.c.user_id]).where(table.c.state != "pinned"))}
+        if not pin:
+            for user_id in sorted(moving):
+                self._resume(user_id)
+        misplaced = []
+        for shard in range(self.count):
+            with self.engine(shard).connect() as connection:
+                users = connection.execute(union_all(*[
+                    select([wishlists.c.user_id]) for wishlists
+                    in (Wishlist.__table__, ArchivedWishlist.__table__)])
+                                           ).fetchall()
+            misplaced.extend((user_id, shard) for user_id
+                             in sorted({user_id for (user_id,) in users})
+                             if self.home_shard(user_id) != shard and
+                             not (pin and user_id in moving))
+        for user_id, shard in misplaced:
+            if pin:
+                self._pin(user_id, shard)
+            else:
+                self._move(user_id, shard, self.home_shard(user_id))
+        if pin:
+            moving = set()
+        return len(moving | {user_id for user_id, _ in misplaced})
+
+    def _resume(self, user_id):
+        """ Finishes an interrupted move of a user, if there is one """
+        table = UserShard.__table__
+        with self.engine(0).connect() as connection:
+            pin = connection.execute(table.select().where(
+                table.c.user_id == user_id)).first()
+        if pin is None or pin.state == "pinned":
+            return 0
+        logger.info("Resuming the move of user %s", user_id)
+        if pin.state == "copying":
+            return self._move(user_id, pin.shard, pin.move_shard)
+        return self._move(user_id, pin.move_shard, pin.shard)
+
+    def _move(self, user_id, source, target):
+        """Copies, switches and deletes until the source has no wishlists
+
+        The state of the move is kept in the directory: while "copying",
+        nothing reads the user's rows on the target, so rows there are
+        left from an earlier try and are deleted before the copy starts.
+        Once "deleting", the target has the current rows and only the ids
+        it is missing are copied. The archived wishlists move along.
+        """
+        logger.info("Moving user %s from shard %s to %s",
+                    user_id, source, target)
+        moved = 0
+        if source == target:
+            return moved
+        table = UserShard.__table__
+        with self.engine(0).connect() as connection:
+            state = connection.scalar(select([table.c.state]).where(
+                table.c.user_id == user_id))
+        if state != "deleting":
+            self._pin(user_id, source, "copying", target)
+            with self.engine(target).begin() as connection:
+                _delete_user(connection, user_id, *_read_user(connection,
+                                                               user_id))
+        while True:
+            with self.engine(source).connect() as connection, \
+                    connection.begin():
+                # writes to the user's wishlists wait until they are gone
+                rows = _read_user(connection, user_id)
+                wishlists = len(rows[0]) + len(rows[2])
+                if not wishlists:
+                    break
+                self._copy(target, user_id, *rows)
+                self._locate([row.id for row in rows[0] + rows[2]], target)
+                self._pin(user_id, target, "deleting", source)
+                _delete_user(connection, user_id, *rows)
+            moved += wishlists
+        self._pin(user_id, target)
+        return moved
+
+    def _copy(self, shard, user_id, rows, item_rows, archived_rows,
+              archived_item_rows):
+        """ Writes the wishlists and items a shard does not have yet """
+        # pylint: disable=too-many-arguments
+        with self.engine(shard).begin() as connection:
+            existing = set()
+            for table in (Wishlist.__table__, ArchivedWishlist.__table__):
+                existing.update(wishlist_id for (wishlist_id,) in _read_chunks(
+                    connection, lambda chunk, table=table: select(
+                        [table.c.id]).where(table.c.id.in_(chunk)),
+                    [row.id for row in rows + archived_rows]))
+            rows = [row for row in rows if row.id not in existing]
+            item_rows = [row for row in item_rows
+                         if row.wishlist_id not in existing]
+            archived_rows = [row for row in archived_rows
+                             if row.id not in existing]
+            archived_item_rows = [row for row in archived_item_rows
+                                  if row.wishlist_id not in existing]
+            for table, table_rows in (
+                    (Wishlist.__table__, rows), (Item.__table__, item_rows),
+                    (ArchivedWishlist.__table__, archived_rows),
+                    (ArchivedItem.__table__, archived_item_rows)):
+                if table_rows:
+                    connection.execute(table.insert(),
+                                       [dict(row) for row in table_rows])
+            # the stats and the change feed only follow the hot tables
+            products = defaultdict(int)
+            for row in item_rows:
+                products[row.product_id] += 1
+            Stats.apply(connection, {user_id: len(rows)}, products,
+                        {"wishlists": len(rows), "items": len(item_rows)})
+            events = [
+                change_event("wishlist", row.id, row.id, user_id, "created")
+                for row in rows] + [
+                change_event("item", row.id, row.wishlist_id, user_id,
+                             "created") for row in item_rows]
+            if events:
+                Change.insert(connection, events)
+
+    def _locate(self, wishlist_ids, shard):
+        """ Records the shard of wishlists, or forgets it for their range """
+        table = WishlistShard.__table__
+        moved = [{"wishlist_id": wishlist_id, "shard": shard}
+                 for wishlist_id in wishlist_ids
+                 if wishlist_id // self.id_space != shard]
+        with self.engine(0).begin() as connection:
+            for start in range(0, len(wishlist_ids), CHUNK_SIZE):
+                connection.execute(table.delete().where(
+                    table.c.wishlist_id.in_(
+                        wishlist_ids[start:start + CHUNK_SIZE])))
+            if moved:
+                connection.execute(table.insert(), moved)
+
+    def _pin(self, user_id, shard, state="pinned", move_shard=None):
+        """ Records the shard of a user, or forgets it for their home shard """
+        table = UserShard.__table__
+        with self.engine(0).begin() as connection:
+            connection.execute(table.delete().where(table.c.user_id == user_id))
+            if state != "pinned" or shard != self.home_shard(user_id):
+                connection.execute(table.insert().values(
+                    user_id=user_id, shard=shard, state=state,
+                    move_shard=move_shard))
+
+
+def _read_user(connection, user_id):
+    """Reads and locks the wishlists and items of a user on a shard
+
+    :return: the wishlist and item rows, then the archived ones
+    :rtype: tuple
+    """
+    rows = []
+    for wishlists, items in ((Wishlist.__table__, Item.__table__),
+                             (ArchivedWishlist.__table__,
+                              ArchivedItem.__table__)):
+        wishlist_rows = connection.execute(
+            wishlists.select().where(wishlists.c.user_id == user_id)
+            .order_by(wishlists.c.id).with_for_update()).fetchall()
+        rows.append(wishlist_rows)
+        rows.append(_read_chunks(
+            connection, lambda chunk, items=items: items.select()
+            .where(items.c.wishlist_id.in_(chunk)),
+            [row.id for row in wishlist_rows]))
+    return tuple(rows)
+
+
+def _delete_user(connection, user_id, rows, item_rows, archived_rows,
+                 archived_item_rows):
+    """ Deletes wishlists read by _read_user, their items going by cascade """
+    # pylint: disable=too-many-arguments,unused-argument
+    for table, table_rows in ((Wishlist.__table__, rows),
+                              (ArchivedWishlist.__table__, archived_rows)):
+        ids = [row.id for row in table_rows]
+        for start in range(0, len(ids), CHUNK_SIZE):
+            connection.execute(table.delete().where(
+                table.c.id.in_(ids[start:start + CHUNK_SIZE])))
+    if not rows:
+        return
+    products = defaultdict(int)
+    for row in item_rows:
+        products[row.product_id] -= 1
+    Stats.apply(connection, {user_id: -len(rows)}, products,
+                {"wishlists": -len(rows), "items": -len(item_rows)})
+    Change.insert(connection, [
+        change_event("wishlist", row.id, row.id, user_id, "deleted")
+        for row in rows])
+
+
+def _read_chunks(connection, query, ids):
+    """ Runs query for each chunk of ids and returns all of the rows """
+    rows = []
+    for start in range(0, len(ids), CHUNK_SIZE):
+        rows.extend(connection.execute(query(ids[start:start + CHUNK_SIZE])))
+    return rows
+
+
+def _start_ids(connection, table, start):
+    """ Makes the ids of a table continue from start unless they are past it """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "SELECT setval(CAST(pg_get_serial_sequence(:table, 'id') "
+            "AS regclass), :start) WHERE coalesce(pg_sequence_last_value("
+            "CAST(pg_get_serial_sequence(:table, 'id') AS regclass)), 0) "
+            "< :start").bindparams(table=table, start=start))
+    elif connection.dialect.name == "sqlite":
+        # sqlite continues after the highest id of a table even when it is
+        # in another shard's range, so only Postgres keeps the ranges apart
+        # after users move to lower shards
+        current = connection.scalar(
+            "SELECT seq FROM sqlite_sequence WHERE name = ?", table)
+        if current is None:
+            connection.execute("INSERT INTO sqlite_sequence (name, seq) "
+                               "VALUES (?, ?)", table, start)
+        elif current < start:
+            connection.execute("UPDATE sqlite_sequence SET seq = ? "
+                               "WHERE name = ?", start, table)
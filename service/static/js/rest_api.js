@@ -46,6 +46,27 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // Builds the search results row of a Wishlist
+    function wishlist_row(wishlist) {
+        return '<tr id="wishlist-row-' + wishlist.id + '"><td>'+wishlist.id+"</td><td>"+wishlist.name+"</td><td>"+ wishlist.user_id +"</td><td>" +
+            (wishlist.status ? "enabled" : "disabled") + "</td></tr>";
+    }
+
+    // Builds the search results row of an Item
+    function item_row(item) {
+        return '<tr id="item-row-' + item.id + '" data-wishlist-id="' + item.wishlist_id + '"><td>'+item.id+"</td><td>"+ item.wishlist_id +"</td><td>"+item.product_name+"</td><td>"+ item.product_id +"</td></tr>";
+    }
+
+    // Replaces the row with the same id or adds it to the end of a table
+    function upsert_row(divID, row) {
+        var existing = $("#" + $(row).attr("id"));
+        if (existing.length) {
+            existing.replaceWith(row);
+        } else {
+            $("#" + divID).append(row);
+        }
+    }
+
     // ****************************************
     // Create a Wishlist
     // ****************************************
@@ -299,12 +320,13 @@ $(function () {
             data: JSON.stringify(data),
         });
 
-        ajax.done(function(res){
+        ajax.done(function(res, text_status, xhr){
             update_item_form_data(res)
 
             $("#search_results").empty();
 
-            flash_message("Success")
+            // 200 instead of 201: the product was in the wishlist already
+            flash_message(xhr.status == 200 ? "Already in the wishlist" : "Success")
         });
 
         ajax.fail(function(res){
@@ -319,6 +341,7 @@ $(function () {
     $("#clear-btn").click(function () {
         $("#wishlist_id").val("");
         clear_wishlist_form_data()
+        watch_changes(null, "")
     });
 
     // ****************************************
@@ -330,89 +353,267 @@ $(function () {
         clear_item_form_data()
     });
 
+    // ****************************************
+    // Cached GET requests
+    // ****************************************
+
+    // how many recent GET responses are kept, by URL
+    var CACHE_SIZE = 20;
+    var response_cache = {};
+    var cached_urls = [];
+
+    // GETs a URL, sending the ETag of the cached response so an unchanged
+    // one comes back as an empty 304 and is answered from the cache
+    function cached_get(url, done) {
+        var cached = response_cache[url];
+        var ajax = $.ajax({
+            type: "GET",
+            url: url,
+            headers: cached ? {"If-None-Match": cached.etag} : {}
+        });
+
+        ajax.done(function(res, text_status, xhr){
+            if (xhr.status === 304 && cached) {
+                done(cached.data, cached.link);
+                return ;
+            }
+            var link = xhr.getResponseHeader("Link");
+            var etag = xhr.getResponseHeader("ETag");
+            if (etag) {
+                remember(url, {"etag": etag, "data": res, "link": link});
+            }
+            done(res, link);
+        });
+
+        return ajax;
+    }
+
+    // Keeps a response, dropping the least recently stored beyond CACHE_SIZE
+    function remember(url, entry) {
+        var index = cached_urls.indexOf(url);
+        if (index >= 0) {
+            cached_urls.splice(index, 1);
+        }
+        cached_urls.push(url);
+        response_cache[url] = entry;
+        if (cached_urls.length > CACHE_SIZE) {
+            delete response_cache[cached_urls.shift()];
+        }
+    }
+
+    // Returns the URL of the next page named by a Link header, or null
+    function next_link(link) {
+        var match = /<([^>]+)>;\s*rel="next"/.exec(link || "");
+        return match ? match[1] : null;
+    }
+
     // ******************************************
     // Search for a Wishlist (list all wishlists)
     // ******************************************
 
+    // wishlists fetched per page; more are fetched while scrolling down
+    var PAGE_SIZE = 50;
+    // clicks closer together than this (ms) make a single search
+    var SEARCH_DELAY = 250;
+    var search_timer = null;
+    var search_request = null;
+    var next_page = null;
+
     $("#search-btn").click(function () {
+        clearTimeout(search_timer);
+        search_timer = setTimeout(search_wishlists, SEARCH_DELAY);
+    });
+
+    function search_wishlists() {
 
         var name = $("#wishlist_name").val();
         var user_id = $("#wishlist_user_id").val();
 
-        var queryString = ""
+        var query = {"limit": PAGE_SIZE};
 
         if (name) {
-            queryString += 'name=' + name
+            query.name = name;
         }
 
         if (user_id) {
-            if (queryString.length > 0) {
-                queryString += '&user_id=' + user_id
-            } else {
-                queryString += 'user_id=' + user_id
-            }
+            query.user_id = user_id;
         }
 
-        if(queryString.length > 0)
-            queryString = "?" + queryString;
+        $("#search_results").empty();
+        $("#search_results").append('<h4>Wishlists</h4>');
+        $("#search_results").append('<table class="table-striped" cellpadding="10">');
+        var header = '<tr>'
+        header += '<th style="width:20%">ID</th>'
+        header += '<th style="width:20%">Name</th>'
+        header += '<th style="width:20%">UserID</th>'
+        header += '<th style="width:20%">Status</th></tr>'
+        $("#search_results").append(header);
+        $("#search_results_items").empty();
+        addItemsHeader("search_results_items")
 
-        var ajax = $.ajax({
-            type: "GET",
-            url: "/wishlists" + queryString
-        })
+        load_page("/wishlists?" + $.param(query), true)
 
-        ajax.done(function(res){
+        // keep the results current instead of searching again
+        watch_changes(user_id, name)
+    }
 
-            $("#search_results").empty();
-            $("#search_results").append('<h4>Wishlists</h4>');
-            $("#search_results").append('<table class="table-striped" cellpadding="10">');
-            var header = '<tr>'
-            header += '<th style="width:20%">ID</th>'
-            header += '<th style="width:20%">Name</th>'
-            header += '<th style="width:20%">UserID</th>'
-            header += '<th style="width:20%">Status</th></tr>'
-            $("#search_results").append(header);
-            var firstWishlist = "";
-            var items = []
+    // Fetches a page of search results and appends it to the tables; a
+    // newer search cancels the page still being fetched
+    function load_page(url, first) {
+
+        if (search_request !== null) {
+            search_request.abort();
+        }
+        next_page = null;
+
+        search_request = cached_get(url, function(res, link){
+            search_request = null;
+            next_page = next_link(link);
 
             for(var i = 0; i < res.length; i++) {
                 var wishlist = res[i];
-                var row = "<tr><td>"+wishlist.id+"</td><td>"+wishlist.name+"</td><td>"+ wishlist.user_id +"</td><td>" +
-                    (wishlist.status ? "enabled" : "disabled") + "</td></tr>";
-
-                $("#search_results").append(row);
+                upsert_row("search_results", wishlist_row(wishlist));
 
                 for(var j = 0; j < wishlist.items.length; j++){
-                    items.push(wishlist.items[j]);
+                    upsert_row("search_results_items", item_row(wishlist.items[j]));
                 }
+            }
 
-                if (i === 0) {
-                    firstWishlist = wishlist;
+            if (first) {
+                // copy the first result to the form
+                if (res.length > 0) {
+                    update_wishlist_form_data(res[0])
+                    if (res[0].items.length > 0) {
+                        update_item_form_data(res[0].items[0])
+                    }
                 }
+                flash_message("Success")
             }
 
-            $("#search_results").append('</table>');
+            load_more()
+        });
 
-            // copy the first result to the form
-            if (firstWishlist != "") {
-                update_wishlist_form_data(firstWishlist)
+        search_request.fail(function(res, text_status){
+            search_request = null;
+            if (text_status !== "abort") {
+                flash_message(res.responseJSON.message)
             }
+        });
+    }
+
+    // Fetches the next page once the end of the results is in view
+    function load_more() {
+        if (next_page === null || search_request !== null) {
+            return ;
+        }
+        var bottom = $(window).scrollTop() + $(window).height();
+        if (bottom >= $(document).height() - 200) {
+            load_page(next_page, false)
+        }
+    }
 
-            addItemsTable(items, "search_results_items")
+    $(window).on("scroll resize", load_more);
 
-            flash_message("Success")
+    // ****************************************
+    // Live updates of the search results
+    // ****************************************
+
+    var change_stream = null;
+    var watched_name = "";
+
+    // Follows the changes to a user's wishlists while they are listed
+    function watch_changes(user_id, name) {
+        if (change_stream !== null) {
+            change_stream.close();
+            change_stream = null;
+        }
+        watched_name = name;
+        if (!window.EventSource || user_id == null || user_id.trim() === "") {
+            return ;
+        }
+        change_stream = new EventSource("/changes/stream?user_id=" +
+                                        encodeURIComponent(user_id.trim()));
+        change_stream.addEventListener("change", function (event) {
+            apply_change(JSON.parse(event.data));
         });
+    }
 
-        ajax.fail(function(res){
-            flash_message(res.responseJSON.message)
+    // Applies one change to the rendered tables, fetching only what changed
+    function apply_change(change) {
+        if (change.entity === "wishlist") {
+            if (change.op === "deleted" || change.op === "archived") {
+                $("#wishlist-row-" + change.id).remove();
+                $("#search_results_items tr[data-wishlist-id='" + change.id + "']").remove();
+                return ;
+            }
+            $.ajax({
+                type: "GET",
+                url: "/wishlists/" + change.id
+            }).done(function(res){
+                if (watched_name && res.name !== watched_name) {
+                    $("#wishlist-row-" + res.id).remove();
+                } else {
+                    upsert_row("search_results", wishlist_row(res));
+                }
+            });
+            return ;
+        }
+        if (change.op === "deleted") {
+            $("#item-row-" + change.id).remove();
+            return ;
+        }
+        if (!$("#wishlist-row-" + change.wishlist_id).length) {
+            return ;
+        }
+        $.ajax({
+            type: "GET",
+            url: "/wishlists/" + change.wishlist_id + "/items/" + change.id
+        }).done(function(res){
+            upsert_row("search_results_items", item_row(res));
         });
+    }
+
+    // ****************************************
+    // Autocomplete Wishlist names for a user
+    // ****************************************
+
+    var autocomplete_request = null;
+
+    $("#wishlist_name").on("input", function () {
+
+        var prefix = $("#wishlist_name").val();
+        var user_id = $("#wishlist_user_id").val();
+
+        if (user_id == null || user_id.trim() === "" || prefix === "") {
+            $("#wishlist_name_suggestions").empty();
+            return ;
+        }
 
+        // only the latest keystroke matters
+        if (autocomplete_request !== null) {
+            autocomplete_request.abort();
+        }
+
+        autocomplete_request = $.ajax({
+            type: "GET",
+            url: "/wishlists/autocomplete",
+            data: {"user_id": user_id.trim(), "prefix": prefix}
+        });
+
+        autocomplete_request.done(function(res){
+            $("#wishlist_name_suggestions").empty();
+            for(var i = 0; i < res.length; i++) {
+                $("#wishlist_name_suggestions").append($("<option>").val(res[i]));
+            }
+        });
     });
 
     // ***********************************************
     // Search for Wishlist Items (list wishlist items)
     // ***********************************************
 
+    var item_request = null;
+
     $("#search-item-btn").click(function () {
 
         var wishlist_id = $("#item_wishlist_id").val();
@@ -424,32 +625,35 @@ $(function () {
             return ;
         }
 
-        var ajax = item_id == null || item_id.trim() === "" ? $.ajax({
-            type: "GET",
-            url: "/wishlists/" + wishlist_id + "/items"
-        }) : $.ajax({
-            type: "GET",
-            url: "/wishlists/" + wishlist_id + "/items/" + item_id
-        });
+        var url = "/wishlists/" + wishlist_id + "/items";
+        if (item_id != null && item_id.trim() !== "") {
+            url += "/" + item_id;
+        }
 
+        // only the latest search matters
+        if (item_request !== null) {
+            item_request.abort();
+        }
 
-        ajax.done(function(res){
+        item_request = cached_get(url, function(res){
+            item_request = null;
 
             addItemsTable(res, "search_results")
 
             flash_message("Success")
         });
 
-        ajax.fail(function(res){
-            flash_message(res.responseJSON.message)
+        item_request.fail(function(res, text_status){
+            item_request = null;
+            if (text_status !== "abort") {
+                flash_message(res.responseJSON.message)
+            }
         });
 
     });
 
-    function addItemsTable(res, divID){
-
-        $("#" + divID + "").empty();
-        $("#search_results").append('<h4>Items</h4>');
+    // Starts an items table with its header
+    function addItemsHeader(divID){
         $("#" + divID + "").append('<table class="table-striped" cellpadding="10">');
         var header = '<tr>'
         header += '<th style="width:20%">ID</th>'
@@ -457,6 +661,13 @@ $(function () {
         header += '<th style="width:20%">Product Name</th>'
         header += '<th style="width:20%">Product ID</th></tr>'
         $("#" + divID + "").append(header);
+    }
+
+    function addItemsTable(res, divID){
+
+        $("#" + divID + "").empty();
+        $("#search_results").append('<h4>Items</h4>');
+        addItemsHeader(divID)
         var firstItem = "";
 
         // When a single item is returned
@@ -468,8 +679,7 @@ $(function () {
 
         for(var i = 0; i < res.length; i++) {
             var item = res[i];
-            var row = "<tr><td>"+item.id+"</td><td>"+ item.wishlist_id +"</td><td>"+item.product_name+"</td><td>"+ item.product_id +"</td></tr>";
-            $("#" + divID + "").append(row);
+            $("#" + divID + "").append(item_row(item));
             if (i === 0) {
                 firstItem = item;
             }
@@ -27,4 +27,5 @@ class ItemFactory(factory.Factory):
 
     id = factory.Sequence(lambda n: n)
     product_name = FuzzyChoice(choices=["samsung mobile", "wire", "other"])
-    product_id = FuzzyInteger(0, 1000)
+    # distinct, as a product is in a wishlist at most once
+    product_id = factory.Sequence(lambda n: n)
@@ -0,0 +1,134 @@
+"""
+Admission Control Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import threading
+import unittest
+from unittest.mock import patch
+from flask import Flask
+from flask_api import status
+from service.admission import (AdmissionControl, RateLimiter,
+                               ConcurrencyLimiter)
+
+
+######################################################################
+#  A D M I S S I O N   T E S T   C A S E S
+######################################################################
+class TestAdmission(unittest.TestCase):
+    """ Tests for token buckets, concurrency limits and the middleware """
+
+    @patch("service.admission.time.monotonic")
+    def test_token_bucket(self, monotonic):
+        """ A bucket allows a burst and then refills at its rate """
+        monotonic.return_value = 0
+        limiter = RateLimiter(rate=2, burst=2, max_keys=10)
+        self.assertEqual(limiter.acquire("a"), 0)
+        self.assertEqual(limiter.acquire("a"), 0)
+        self.assertAlmostEqual(limiter.acquire("a"), 0.5)
+        self.assertEqual(limiter.acquire("b"), 0)
+        monotonic.return_value = 0.5
+        self.assertEqual(limiter.acquire("a"), 0)
+
+    @patch("service.admission.time.monotonic")
+    def test_refund(self, monotonic):
+        """ A refunded token can be taken again, up to the burst """
+        monotonic.return_value = 0
+        limiter = RateLimiter(rate=1, burst=1, max_keys=10)
+        self.assertEqual(limiter.acquire("a"), 0)
+        limiter.refund("a")
+        self.assertEqual(limiter.acquire("a"), 0)
+        self.assertGreater(limiter.acquire("a"), 0)
+        limiter.refund("b")  # unknown buckets are full already
+        self.assertEqual(limiter.acquire("b"), 0)
+
+    def test_concurrency_limit(self):
+        """ Requests over the limit wait briefly and are then shed """
+        limiter = ConcurrencyLimiter(limit=1, max_queue=0, timeout=0.01)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+
+    def test_queued_request_gets_freed_slot(self):
+        """ A queued request runs when a running one finishes """
+        limiter = ConcurrencyLimiter(limit=1, max_queue=1, timeout=5)
+        self.assertTrue(limiter.acquire())
+        timer = threading.Timer(0.05, limiter.release)
+        timer.start()
+        self.assertTrue(limiter.acquire())
+        timer.join()
+
+    def test_middleware(self):
+        """ Rejected requests get 429 or 503 with Retry-After """
+        app = Flask(__name__)
+        app.config.update(ADMISSION_ENABLED=True, ADMISSION_IP_RATE=1,
+                          ADMISSION_IP_BURST=10, ADMISSION_USER_RATE=1,
+                          ADMISSION_USER_BURST=1, ADMISSION_MAX_KEYS=10,
+                          ADMISSION_MAX_CONCURRENT=1, ADMISSION_MAX_QUEUE=0,
+                          ADMISSION_QUEUE_TIMEOUT_MS=10,
+                          ADMISSION_EXEMPT_PATHS=["/metrics"],
+                          TRUSTED_PROXY_HOPS=0)
+        admission = AdmissionControl(app)
+
+        @app.route("/work")
+        def work():
+            return "ok"
+
+        client = app.test_client()
+        self.assertEqual(client.get("/work?user_id=1").status_code,
+                         status.HTTP_200_OK)
+        resp = client.get("/work?user_id=1")
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        self.assertEqual(client.get("/work?user_id=2").status_code,
+                         status.HTTP_200_OK)
+        # requests the user bucket turned away cost the IP nothing
+        for _ in range(10):
+            resp = client.get("/work", headers={"X-User-Id": "1"})
+            self.assertEqual(resp.status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(client.get("/work?user_id=3").status_code,
+                         status.HTTP_200_OK)
+
+        admission.concurrency.acquire()  # the service is now saturated
+        resp = client.get("/work")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", resp.headers)
+        admission.concurrency.release()
+
+        self.assertEqual(admission.metrics()["admitted"], 3)
+        self.assertEqual(admission.metrics()["rate_limited"], 11)
+        self.assertEqual(admission.metrics()["shed"], 1)
+        self.assertEqual(admission.metrics()["running"], 0)
+
+    def test_client_behind_proxy(self):
+        """ Clients behind a trusted proxy get buckets of their own """
+        app = Flask(__name__)
+        app.config.update(ADMISSION_ENABLED=True, ADMISSION_IP_RATE=1,
+                          ADMISSION_IP_BURST=1, ADMISSION_USER_RATE=1,
+                          ADMISSION_USER_BURST=1, ADMISSION_MAX_KEYS=10,
+                          ADMISSION_MAX_CONCURRENT=1, ADMISSION_MAX_QUEUE=0,
+                          ADMISSION_QUEUE_TIMEOUT_MS=10,
+                          ADMISSION_EXEMPT_PATHS=[], TRUSTED_PROXY_HOPS=1)
+        AdmissionControl(app)
+
+        @app.route("/work")
+        def work():
+            return "ok"
+
+        client = app.test_client()
+        first = {"X-Forwarded-For": "10.0.0.1"}
+        resp = client.get("/work", headers=first)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = client.get("/work", headers=first)
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # the router's own address is not what is throttled
+        resp = client.get("/work", headers={"X-Forwarded-For": "10.0.0.2"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # an address the client adds before the proxy's is not trusted
+        resp = client.get("/work",
+                          headers={"X-Forwarded-For": "10.0.0.3, 10.0.0.1"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
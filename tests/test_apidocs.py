@@ -0,0 +1,94 @@
+"""
+API Documentation Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import gzip
+import json
+import unittest
+from flask import Flask
+from flask_api import status
+from flask_restplus import Api, Resource
+from service.apidocs import ApiSpec
+from service.service import app, api_spec
+
+
+######################################################################
+#  A P I   D O C U M E N T A T I O N   T E S T   C A S E S
+######################################################################
+class TestApiSpec(unittest.TestCase):
+    """ Tests for the precomputed Swagger document """
+
+    @classmethod
+    def setUpClass(cls):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['ADMISSION_ENABLED'] = False
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_in_sync_with_routes(self):
+        """ Every API route is documented with its methods """
+        self.assertEqual(api_spec.check(), [])
+        paths = api_spec.schema["paths"]
+        self.assertIn("/wishlists/{wishlist_id}/items/{item_id}/position",
+                      paths)
+        self.assertEqual(sorted(paths["/wishlists"]), ["get", "post"])
+        document = json.loads(api_spec.body)
+        listed = document["paths"]["/wishlists"]["get"]["responses"]["200"] \
+            ["schema"]
+        self.assertEqual(listed["items"]["$ref"],
+                         "#/definitions/WishlistResult")
+
+    def test_send_document(self):
+        """ The document is sent compressed when accepted and revalidated """
+        resp = self.app.get("/swagger.json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(resp.data, api_spec.body)
+        resp = self.app.get("/swagger.json",
+                            headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp.data), api_spec.body)
+        self.assertEqual(sorted(json.loads(api_spec.body)["paths"]),
+                         sorted(api_spec.schema["paths"]))
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/swagger.json", headers={
+            "Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get("/swagger.json", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_check_finds_stale_document(self):
+        """ Routes added after the document was built are reported """
+        other = Flask(__name__)
+        api = Api(other)
+
+        @api.route("/things")
+        class Things(Resource):
+            """ A documented resource """
+            def get(self):
+                """ Lists things """
+                return []
+
+        spec = ApiSpec(other, api)
+        spec.build()
+        self.assertEqual(spec.check(), [])
+
+        @api.route("/things/<int:thing_id>")
+        class Thing(Resource):
+            """ A resource added after the build """
+            def delete(self, thing_id):
+                """ Deletes a thing """
+                # pylint: disable=unused-argument
+                return "", 204
+
+        self.assertEqual(spec.check(), [
+            "/things/{thing_id} is routed for ['DELETE'] but documented "
+            "for []"])
+        spec.build()
+        self.assertEqual(spec.check(), [])
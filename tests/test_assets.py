@@ -0,0 +1,89 @@
+"""
+Static Assets Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from flask_api import status
+from service.assets import StaticAssets
+from service.service import app, assets
+
+
+######################################################################
+#  S T A T I C   A S S E T S   T E S T   C A S E S
+######################################################################
+class TestStaticAssets(unittest.TestCase):
+    """ Tests for content-hashed static files and cached pages """
+
+    @classmethod
+    def setUpClass(cls):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['ADMISSION_ENABLED'] = False
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_pages_use_hashed_urls(self):
+        """ Pages point at the hashed names of every static file they use """
+        for page in ("/", "/items.html"):
+            resp = self.app.get(page)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+            html = resp.get_data(as_text=True)
+            self.assertNotIn('"static/', html)
+            urls = re.findall(r'(?:href|src)\s*=\s*"(assets/[^"]+)"', html)
+            self.assertEqual(urls, [
+                assets.url("css/blue_bootstrap.min.css"),
+                assets.url("js/jquery-3.1.1.min.js"),
+                assets.url("js/rest_api.js")])
+            resp = self.app.get(page,
+                                headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(resp.data, b"")
+
+    def test_immutable_assets(self):
+        """ Hashed files are cached for good, unhashed names are not served """
+        url = assets.url("js/rest_api.js")
+        self.assertRegex(url, r"^assets/js/rest_api\.[0-9a-f]{12}\.js$")
+        resp = self.app.get("/" + url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=31536000, immutable")
+        with open(os.path.join(app.static_folder, "js", "rest_api.js"),
+                  "rb") as script:
+            self.assertEqual(resp.data, script.read())
+        resp.close()
+        resp = self.app.get("/assets/js/rest_api.js")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(assets.url("js/missing.js"), "static/js/missing.js")
+
+    def test_hash_follows_content(self):
+        """ A changed file gets a new name and its pages a new ETag """
+        folder = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(folder, "app.js"), "w") as script:
+                script.write("var a = 1;")
+            with open(os.path.join(folder, "page.html"), "w") as page:
+                page.write('<script src="static/app.js"></script>')
+            other = Flask(__name__, static_folder=folder)
+            other.config["ASSETS_MAX_AGE"] = 60
+            static = StaticAssets(other)
+            first, etag = static.url("app.js"), static.pages["page.html"][1]
+            with open(os.path.join(folder, "app.js"), "w") as script:
+                script.write("var a = 2;")
+            static.build()
+            self.assertNotEqual(static.url("app.js"), first)
+            self.assertNotEqual(static.pages["page.html"][1], etag)
+            self.assertEqual(static.pages["page.html"][0].decode(),
+                             '<script src="{}"></script>'
+                             .format(static.url("app.js")))
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,107 @@
+"""
+Group Commit Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import threading
+import unittest
+from unittest.mock import patch
+from flask import Flask
+from service import batching
+from service.batching import GroupCommitter, CommitterStopped
+from service.deadlines import DeadlineExceeded
+
+
+class _Crash(BaseException):
+    """ Kills the committing thread, as nothing in it catches it """
+
+
+######################################################################
+#  G R O U P   C O M M I T   T E S T   C A S E S
+######################################################################
+class TestGroupCommitter(unittest.TestCase):
+    """ Tests for coalescing writes into batches """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.app = Flask(__name__)
+        self.batches = []
+
+    def _write_batch(self, writes):
+        """ Records each batch and fails any batch holding a bad write """
+        self.batches.append(list(writes))
+        if "bad" in writes:
+            raise ValueError("bad write")
+        return [write.upper() for write in writes]
+
+    def _submit_concurrently(self, committer, writes):
+        """ Submits every write from its own thread """
+        results = {}
+
+        def submit(write):
+            try:
+                results[write] = committer.submit(write)
+            except ValueError as error:
+                results[write] = error
+
+        threads = [threading.Thread(target=submit, args=(write,))
+                   for write in writes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_writes_share_a_batch(self):
+        """ Writes arriving together are committed together """
+        committer = GroupCommitter(self.app, self._write_batch, 10, 0.5)
+        results = self._submit_concurrently(committer, ["a", "b", "c"])
+        self.assertEqual(results, {"a": "A", "b": "B", "c": "C"})
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(sorted(self.batches[0]), ["a", "b", "c"])
+
+    def test_batches_are_bounded(self):
+        """ No batch holds more than the maximum number of writes """
+        committer = GroupCommitter(self.app, self._write_batch, 2, 0.5)
+        results = self._submit_concurrently(committer, ["a", "b", "c", "d"])
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+
+    def test_failed_write_does_not_fail_others(self):
+        """ A failing batch is retried one write at a time """
+        committer = GroupCommitter(self.app, self._write_batch, 10, 0.5)
+        results = self._submit_concurrently(committer, ["a", "bad"])
+        self.assertEqual(results["a"], "A")
+        self.assertIsInstance(results["bad"], ValueError)
+
+    def test_write_past_its_deadline_is_dropped(self):
+        """ A write still queued at its deadline fails and is not written """
+        release = threading.Event()
+
+        def write_batch(writes):
+            release.wait(5)
+            return self._write_batch(writes)
+
+        committer = GroupCommitter(self.app, write_batch, 1, 0)
+        first = threading.Thread(target=committer.submit, args=("a",))
+        first.start()
+        self.assertRaises(DeadlineExceeded, committer.submit, "b", 0.1)
+        release.set()
+        first.join()
+        self.assertEqual(committer.submit("c", 5), "C")
+        self.assertEqual(self.batches, [["a"], ["c"]])
+
+    def test_dead_thread_fails_its_writes(self):
+        """ Writes lost with the committing thread fail, later ones run """
+        def write_batch(writes):
+            if "crash" in writes:
+                raise _Crash()
+            return self._write_batch(writes)
+
+        committer = GroupCommitter(self.app, write_batch, 10, 0)
+        with patch.object(batching, "THREAD_CHECK_INTERVAL", 0.05), \
+                patch.object(threading, "excepthook", lambda args: None):
+            self.assertRaises(CommitterStopped, committer.submit, "crash", 5)
+            self.assertEqual(committer.submit("a", 5), "A")
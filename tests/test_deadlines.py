@@ -0,0 +1,82 @@
+"""
+Request Deadline Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import time
+import unittest
+from unittest.mock import patch
+from flask import g
+from flask_api import status
+from sqlalchemy import create_engine
+from service import app
+from service.deadlines import DeadlineExceeded
+from service.models import db
+
+# a query that keeps sqlite busy for far longer than any test deadline
+SLOW_QUERY = """
+WITH RECURSIVE counter(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM counter)
+SELECT count(*) FROM (SELECT n FROM counter LIMIT 100000000)
+"""
+
+
+######################################################################
+#  D E A D L I N E   T E S T   C A S E S
+######################################################################
+class TestDeadlines(unittest.TestCase):
+    """ Tests for request deadlines and statement cancellation """
+
+    @classmethod
+    def setUpClass(cls):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['ADMISSION_ENABLED'] = False
+
+    def setUp(self):
+        db.create_all()
+        self.engine = create_engine("sqlite://")
+        self.deadlines = app.config['ROUTE_DEADLINES_MS']
+
+    def tearDown(self):
+        app.config['ROUTE_DEADLINES_MS'] = self.deadlines
+        self.engine.dispose()
+        db.session.remove()
+
+    def test_no_deadline_outside_requests(self):
+        """ Statements outside of a request are not bounded """
+        self.assertEqual(self.engine.scalar("SELECT 1"), 1)
+
+    def test_statement_after_deadline_is_refused(self):
+        """ No statement is started once the deadline has passed """
+        with app.test_request_context():
+            g.deadline = time.monotonic() - 1
+            self.assertRaises(DeadlineExceeded, self.engine.scalar, "SELECT 1")
+
+    def test_slow_statement_is_cancelled(self):
+        """ A statement still running at the deadline is interrupted """
+        with app.test_request_context():
+            g.deadline = time.monotonic() + 0.05
+            started = time.monotonic()
+            self.assertRaises(DeadlineExceeded, self.engine.scalar, SLOW_QUERY)
+            self.assertLess(time.monotonic() - started, 5)
+            # the connection is usable again by the next request
+            del g.deadline
+            self.assertEqual(self.engine.scalar("SELECT 1"), 1)
+
+    @patch("service.deadlines.time.monotonic")
+    def test_route_deadline_answers_504(self, monotonic):
+        """ A request whose route deadline expires gets 504 """
+        app.config['ROUTE_DEADLINES_MS'] = {"stats_resource": 100}
+        clock = iter([0.0] + [1.0] * 100)
+        monotonic.side_effect = lambda: next(clock)
+        resp = app.test_client().get("/stats")
+        self.assertEqual(resp.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertIn("deadline", resp.get_json()["message"])
+
+    def test_route_without_deadline(self):
+        """ A route with a deadline of 0 is not bounded """
+        app.config['ROUTE_DEADLINES_MS'] = {"stats_resource": 0}
+        resp = app.test_client().get("/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
@@ -8,10 +8,17 @@ Test cases can be run with the following:
   codecov --token=$CODECOV_TOKEN
 """
 
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta
 import logging
 import os
-from service.models import Item, Wishlist, db, DataValidationError
+from unittest.mock import patch
+from sqlalchemy import event
+from service.models import (Item, Wishlist, ArchivedWishlist, Product, Stats,
+                            Change, db, DataValidationError, product_names,
+                            change_event, serialize_wishlists)
 from service.service import app, init_db
 from tests.factories import WishlistFactory, ItemFactory
 
@@ -160,6 +167,30 @@ class TestModel(unittest.TestCase):
         wishlist = Wishlist.find_or_404(wishlist.id)
         self.assertEqual(wishlist.id, 1)
 
+    def test_find_many(self):
+        """ Find many wishlists and their items in a constant number of queries """
+        for user_id in range(1, 6):
+            Wishlist(name="tech", user_id=user_id, items=[
+                Item(product_name="laptop", product_id=user_id)]).create()
+        db.session.expunge_all()
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            found = Wishlist.find_many([5, 1, 3, 99])
+            serialized = [wishlist.serialize() for wishlist in found.values()]
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+
+        self.assertEqual(sorted(found), [1, 3, 5])
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(found[5].items[0].product_id, 5)
+        self.assertEqual(len(serialized), 3)
+
     def test_find_by_name(self):
         """ Find by name """
         wishlist = self._create_wishlist()
@@ -180,6 +211,92 @@ class TestModel(unittest.TestCase):
         self.assertEqual(same_wishlist.id, wishlist.id)
         self.assertEqual(same_wishlist.user_id, wishlist.user_id)
 
+    def test_find_names_by_prefix(self):
+        """ Find a user's wishlist names by prefix """
+        for name, user_id in [("birthday", 1), ("birthday", 1), ("books", 1),
+                              ("bikes", 2), ("100%_fun", 1), ("100 fun", 1)]:
+            Wishlist(name=name, user_id=user_id).create()
+
+        self.assertEqual(Wishlist.find_names_by_prefix(1, "b", 10),
+                         ["birthday", "books"])
+        self.assertEqual(Wishlist.find_names_by_prefix(1, "b", 1),
+                         ["birthday"])
+        self.assertEqual(Wishlist.find_names_by_prefix(2, "bi", 10),
+                         ["bikes"])
+        # wildcards in the prefix are matched literally
+        self.assertEqual(Wishlist.find_names_by_prefix(1, "100%", 10),
+                         ["100%_fun"])
+        self.assertEqual(Wishlist.find_names_by_prefix(1, "x", 10), [])
+        # names come in byte order, as the index keeps them, in any locale
+        for name in ("ba", "bB", "b-b"):
+            Wishlist(name=name, user_id=3).create()
+        self.assertEqual(Wishlist.find_names_by_prefix(3, "b", 10),
+                         ["b-b", "bB", "ba"])
+
+    def test_find_by_filters(self):
+        """ Find wishlists by a combination of criteria """
+        Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10),
+            Item(product_name="phone", product_id=11)]).create()
+        Wishlist(name="tech", user_id=2, status=False, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+        Wishlist(name="books", user_id=1).create()
+
+        self.assertEqual(Wishlist.find_by_filters().count(), 3)
+        found = Wishlist.find_by_filters(user_id=1, name="tech").all()
+        self.assertEqual([w.id for w in found], [1])
+        found = Wishlist.find_by_filters(status=False).all()
+        self.assertEqual([w.id for w in found], [2])
+        found = Wishlist.find_by_filters(product_id=10).all()
+        self.assertEqual([w.id for w in found], [1, 2])
+        found = Wishlist.find_by_filters(product_id=10, status=True).all()
+        self.assertEqual([w.id for w in found], [1])
+        found = Wishlist.find_by_filters(min_items=1, max_items=1).all()
+        self.assertEqual([w.id for w in found], [2])
+        found = Wishlist.find_by_filters(user_id=1, max_items=0).all()
+        self.assertEqual([w.id for w in found], [3])
+
+    def test_find_by_product(self):
+        """ Find the wishlists holding a product page by page """
+        for user_id in range(1, 6):
+            Wishlist(name="tech", user_id=user_id, items=[
+                Item(product_name="laptop", product_id=10),
+                Item(product_name="phone", product_id=11)]).create()
+        Wishlist(name="books", user_id=9, items=[
+            Item(product_name="novel", product_id=20)]).create()
+
+        self.assertEqual(Wishlist.count_by_product(10), 5)
+        page = Wishlist.find_by_product(10, 0, 2)
+        self.assertEqual([w["id"] for w in page], [1, 2])
+        self.assertEqual([w["user_id"] for w in page], [1, 2])
+        page = Wishlist.find_by_product(10, 2, 2)
+        self.assertEqual([w["id"] for w in page], [3, 4])
+        page = Wishlist.find_by_product(10, 4, 2)
+        self.assertEqual([w["id"] for w in page], [5])
+        self.assertEqual(Wishlist.find_by_product(30, 0, 2), [])
+
+    def test_explain_query(self):
+        """ Explain a filtered wishlist query """
+        query = Wishlist.find_by_filters(user_id=1, name="50% off'")
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            explained = Wishlist.explain(query)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record_statement)
+        self.assertIn("WHERE", explained["sql"])
+        self.assertTrue(explained["plan"])
+        statement, parameters = statements[-1]
+        self.assertTrue(statement.startswith("EXPLAIN"))
+        self.assertNotIn("50%", statement)
+        if isinstance(parameters, dict):
+            parameters = parameters.values()
+        self.assertIn("50% off'", list(parameters))
+
     def test_delete_a_wishlist(self):
         """ Delete a Wishlist """
         item = Item(product_name='laptop', product_id=1, wishlist_id=1)
@@ -192,6 +309,495 @@ class TestModel(unittest.TestCase):
         wishlist = Wishlist.find(wishlist_id=1)
         self.assertEqual(wishlist, None)
 
+    def test_stats_follow_changes(self):
+        """ Stats are updated on create, item add/delete and delete """
+        self.assertEqual(Stats.summary()["wishlists"], 0)
+        wishlist = Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10),
+            Item(product_name="phone", product_id=11)])
+        wishlist.create()
+        Wishlist(name="more tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+        self.assertEqual(Stats.summary(), {"wishlists": 2, "items": 3,
+                                           "items_per_wishlist": 1.5})
+        self.assertEqual(Stats.for_user(1)["wishlists"], 2)
+        self.assertEqual(Stats.top_products(1),
+                         [{"product_id": 10, "items": 2}])
+
+        wishlist.items.append(Item(product_name="cable", product_id=12))
+        wishlist.save()
+        wishlist.items[0].delete()
+        self.assertEqual(Stats.top_products(5),
+                         [{"product_id": 10, "items": 1},
+                          {"product_id": 11, "items": 1},
+                          {"product_id": 12, "items": 1}])
+
+        wishlist.user_id = 2
+        wishlist.save()
+        self.assertEqual(Stats.for_user(1)["wishlists"], 1)
+        self.assertEqual(Stats.for_user(2)["wishlists"], 1)
+
+        wishlist.delete()
+        self.assertEqual(Stats.summary()["items"], 1)
+        self.assertEqual(Stats.for_user(2)["wishlists"], 0)
+        self.assertEqual(Stats.top_products(5),
+                         [{"product_id": 10, "items": 1}])
+
+    def test_stats_written_once_at_commit(self):
+        """ The counters of a transaction are written last, in key order """
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            wishlist = Wishlist(name="tech", user_id=2, items=[
+                Item(product_name="phone", product_id=11)])
+            db.session.add(wishlist)
+            db.session.flush()
+            wishlist.items.append(Item(product_name="laptop", product_id=10))
+            db.session.add(Wishlist(name="gifts", user_id=1))
+            db.session.flush()
+            db.session.commit()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record_statement)
+
+        tables = [sql.split()[1 if sql.startswith("UPDATE") else 2]
+                  for sql in statements
+                  if sql.startswith(("UPDATE", "INSERT INTO"))]
+        # sqlite updates each counter and inserts those that were missing
+        stats = [sql.split()[1] for sql in statements
+                 if sql.startswith("UPDATE") and "_stats" in sql.split()[1]]
+        self.assertEqual(stats, ["user_stats"] * 2 + ["product_stats"] * 2 +
+                         ["total_stats"] * 2)
+        self.assertTrue(all(table.endswith("_stats")
+                            for table in tables[tables.index("user_stats"):]))
+        self.assertEqual(Stats.summary()["items"], 2)
+        self.assertEqual(Stats.for_user(1)["wishlists"], 1)
+
+    def test_rebuild_stats(self):
+        """ Rebuild the stats from the wishlist tables """
+        Wishlist(name="tech", user_id=3, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+        db.session.execute("DELETE FROM user_stats")
+        db.session.commit()
+        self.assertEqual(Stats.for_user(3)["wishlists"], 0)
+        Stats.rebuild()
+        self.assertEqual(Stats.for_user(3)["wishlists"], 1)
+        self.assertEqual(Stats.summary()["items"], 1)
+
+    def test_update_by_id(self):
+        """ Update a wishlist without loading it """
+        Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+
+        wishlist = Wishlist.update_by_id(1, {"status": False})
+        self.assertEqual(wishlist["status"], False)
+        self.assertEqual(wishlist["name"], "tech")
+        self.assertEqual(wishlist["items"][0]["product_id"], 10)
+        self.assertEqual(Wishlist.find(1).status, False)
+
+        wishlist = Wishlist.update_by_id(1, {"name": "gear", "user_id": 2})
+        self.assertEqual(wishlist["name"], "gear")
+        self.assertEqual(wishlist["user_id"], 2)
+        self.assertEqual(Stats.for_user(1)["wishlists"], 0)
+        self.assertEqual(Stats.for_user(2)["wishlists"], 1)
+
+        self.assertIsNone(Wishlist.update_by_id(5, {"status": True}))
+
+    def test_set_status_by_user(self):
+        """ Disable and enable all wishlists of a user in chunks """
+        for _ in range(5):
+            Wishlist(name="tech", user_id=1).create()
+        Wishlist(name="tech", user_id=2).create()
+
+        self.assertEqual(Wishlist.set_status_by_user(1, False, 2), 5)
+        self.assertEqual(Wishlist.find_by_filters(status=False).count(), 5)
+        self.assertTrue(Wishlist.find_by_user_id(2)[0].status)
+        self.assertEqual(Wishlist.set_status_by_user(1, False, 2), 0)
+        self.assertEqual(Wishlist.set_status_by_user(1, True, 10), 5)
+
+        # archived wishlists change where they are
+        Wishlist.update_by_id(1, {"status": False})
+        Wishlist.archive(datetime.utcnow() - timedelta(days=1), 10)
+        self.assertEqual(Wishlist.set_status_by_user(1, True, 2), 1)
+        self.assertTrue(ArchivedWishlist.query.get(1).status)
+        self.assertEqual(Wishlist.set_status_by_user(1, False, 2), 5)
+        self.assertFalse(ArchivedWishlist.query.get(1).status)
+
+    def test_delete_by_user(self):
+        """ Delete all wishlists of a user in chunks """
+        for _ in range(3):
+            Wishlist(name="tech", user_id=1, items=[
+                Item(product_name="laptop", product_id=10),
+                Item(product_name="phone", product_id=11)]).create()
+        Wishlist(name="tech", user_id=2, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+
+        self.assertEqual(Wishlist.delete_by_user(1, 2), (3, 6))
+        self.assertEqual(Wishlist.find_by_user_id(1).count(), 0)
+        self.assertEqual(Item.query.count(), 1)
+        self.assertEqual(Stats.for_user(1)["wishlists"], 0)
+        self.assertEqual(Stats.summary()["items"], 1)
+        self.assertEqual(Stats.top_products(5),
+                         [{"product_id": 10, "items": 1}])
+        self.assertEqual(Wishlist.delete_by_user(1, 2), (0, 0))
+
+    def test_delete_cascades_in_database(self):
+        """ Deleting a wishlist removes its items in a single statement """
+        Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10),
+            Item(product_name="phone", product_id=11),
+            Item(product_name="cable", product_id=12)]).create()
+        Wishlist(name="more tech", user_id=1, items=[
+            Item(product_name="phone", product_id=11)]).create()
+        db.session.expunge_all()
+        wishlist = Wishlist.find(1)
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            wishlist.delete()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record_statement)
+
+        deletes = [sql for sql in statements if sql.startswith("DELETE")]
+        self.assertEqual(len(deletes), 1)
+        self.assertTrue(deletes[0].startswith("DELETE FROM wishlist "))
+        self.assertEqual(Item.query.count(), 1)
+        self.assertEqual(Stats.summary()["items"], 1)
+        self.assertEqual(Stats.top_products(5),
+                         [{"product_id": 11, "items": 1}])
+
+    def test_changes_are_recorded(self):
+        """ Every write of a wishlist or item adds events to the outbox """
+        wishlist = Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10)])
+        wishlist.create()
+        item = Item(product_name="phone", product_id=11)
+        wishlist.items.append(item)
+        wishlist.save()
+        wishlist.name = "gear"
+        wishlist.save()
+        wishlist.save()  # nothing changed, nothing recorded
+        item.delete()
+        wishlist.delete()
+
+        changes = [(change["entity"], change["id"], change["user_id"],
+                    change["op"]) for change in Change.since(0, 100)]
+        self.assertEqual(changes, [
+            ("wishlist", 1, 1, "created"),
+            ("item", 1, 1, "created"),
+            ("item", 2, 1, "created"),
+            ("wishlist", 1, 1, "updated"),
+            ("item", 2, 1, "deleted"),
+            ("wishlist", 1, 1, "deleted"),
+        ])
+        self.assertEqual(len(Change.since(4, 100)), 2)
+        self.assertEqual(len(Change.since(0, 2)), 2)
+
+    def test_bulk_changes_are_recorded(self):
+        """ Bulk updates and deletes add events to the outbox """
+        for _ in range(3):
+            Wishlist(name="tech", user_id=1).create()
+        Wishlist.update_by_id(1, {"status": False})
+        Wishlist.set_status_by_user(1, False, 2)
+        Wishlist.delete_by_user(1, 2)
+
+        changes = [(change["id"], change["op"])
+                   for change in Change.since(3, 100)]
+        self.assertEqual(changes, [
+            (1, "updated"), (2, "updated"), (3, "updated"),
+            (1, "deleted"), (2, "deleted"), (3, "deleted"),
+        ])
+
+    def test_rolled_back_changes_are_not_recorded(self):
+        """ Events of a rolled back transaction disappear with it """
+        db.session.add(Wishlist(name="tech", user_id=1))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(Change.since(0, 100), [])
+
+    def test_wait_for_changes(self):
+        """ A waiting reader is woken by a commit """
+        event = {"cursor": 1}
+        with patch.object(Change, "since", side_effect=[[], [event]]):
+            timer = threading.Timer(0.05, self._notify_commit)
+            timer.start()
+            started = time.monotonic()
+            self.assertEqual(Change.wait(0, 10, 10, 10), [event])
+            self.assertLess(time.monotonic() - started, 5)
+            timer.join()
+        self.assertEqual(Change.wait(0, 10, 0.01, 0.01), [])
+
+    def test_changes_follow_transactions(self):
+        """ The feed is ordered by transaction, so cursors never skip """
+        table = Change.__table__
+        # a later transaction took the first id
+        db.session.execute(table.insert(), [
+            dict(change_event("wishlist", 1, 1, 1, "created"), id=1, txid=8),
+            dict(change_event("wishlist", 2, 2, 1, "created"), id=2, txid=7),
+            dict(change_event("wishlist", 3, 3, 1, "created"), id=3, txid=8)])
+        db.session.commit()
+        self.assertEqual([change["id"] for change in Change.since(0, 100)],
+                         [2, 1, 3])
+        self.assertEqual([change["id"] for change in Change.since(2, 100)],
+                         [1, 3])
+        self.assertEqual([change["id"] for change in Change.since(1, 100)],
+                         [3])
+        self.assertEqual(Change.since(3, 100), [])
+        self.assertEqual(Change.latest(), 3)
+
+    def test_prune_changes(self):
+        """ Old events are pruned """
+        Wishlist(name="tech", user_id=1).create()
+        self.assertEqual(Change.prune(datetime.utcnow() - timedelta(days=1)), 0)
+        self.assertEqual(Change.prune(datetime.utcnow() + timedelta(days=1)), 1)
+        self.assertEqual(Change.since(0, 100), [])
+
+    def test_serialize_wishlists_reads_names_once(self):
+        """ A page of wishlists reads its product names in one query """
+        for product_id in range(10, 15):
+            Wishlist(name="tech", user_id=1, items=[
+                Item(product_name="product", product_id=product_id)]).create()
+        db.session.expunge_all()
+        product_names.clear()
+        wishlists = Wishlist.find_many(list(range(1, 6))).values()
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            serialized = serialize_wishlists(wishlists)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record_statement)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([wishlist["items"][0]["product_name"]
+                          for wishlist in serialized], ["product"] * 5)
+
+    def test_product_catalog(self):
+        """ Product names are stored once and renamed with one update """
+        Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10),
+            Item(product_name="phone", product_id=11)]).create()
+        Wishlist(name="gifts", user_id=2, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+        self.assertEqual(sorted(db.session.query(Product.id, Product.name)),
+                         [(10, "laptop"), (11, "phone")])
+        self.assertNotIn("product_name", Item.__table__.c)
+
+        self.assertEqual(Product.rename(10, "notebook"),
+                         {"id": 10, "name": "notebook"})
+        self.assertIsNone(Product.rename(99, "nothing"))
+        self.assertRaises(DataValidationError, Product.rename, 11, "")
+        db.session.expunge_all()
+        names = [item["product_name"] for wishlist in Wishlist.all()
+                 for item in wishlist.serialize()["items"]]
+        self.assertEqual(names, ["notebook", "phone", "notebook"])
+
+        # names given to items only name new products
+        results = Item.create_many([
+            Item(wishlist_id=2, product_name="laptop", product_id=10),
+            Item(wishlist_id=2, product_name="tablet", product_id=12)])
+        self.assertEqual([result[0]["product_name"] for result in results],
+                         ["notebook", "tablet"])
+        wishlist = Wishlist.find(2)
+        wishlist.items.append(Item(product_name="mobile", product_id=11))
+        wishlist.items.append(Item(product_name="pen", product_id=13))
+        wishlist.save()
+        self.assertEqual(sorted(db.session.query(Product.id, Product.name)),
+                         [(10, "notebook"), (11, "phone"), (12, "tablet"),
+                          (13, "pen")])
+
+    def test_add_existing_product(self):
+        """ Adding a product twice to a wishlist returns the first item """
+        Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+        results = Item.create_many([
+            Item(wishlist_id=1, product_name="laptop", product_id=10),
+            Item(wishlist_id=1, product_name="phone", product_id=11),
+            Item(wishlist_id=1, product_name="phone", product_id=11),
+            Item(wishlist_id=2, product_name="phone", product_id=11)])
+        phone_id = results[1][0]["id"]
+        self.assertEqual([result and (result[0]["id"], result[1])
+                          for result in results],
+                         [(1, False), (phone_id, True), (phone_id, False),
+                          None])
+        self.assertEqual(Item.query.count(), 2)
+        self.assertEqual(Stats.summary()["items"], 2)
+        self.assertEqual([change["op"] for change in Change.since(0, 100)
+                          if change["entity"] == "item"],
+                         ["created", "created"])
+        wishlist = Wishlist.find(1)
+        self.assertRaises(DataValidationError, wishlist.update_from, {
+            "name": "tech", "user_id": 1,
+            "items": [{"id": 1, "product_id": 11, "product_name": "phone"},
+                      {"id": phone_id, "product_id": 11,
+                       "product_name": "phone"}]})
+        # a product repeated in a document is dropped
+        data = Wishlist.find(1).update_from({
+            "name": "tech", "user_id": 1,
+            "items": [{"product_id": 11, "product_name": "mobile"},
+                      {"id": 1, "product_id": 10, "product_name": "laptop"},
+                      {"id": phone_id, "product_id": 11,
+                       "product_name": "phone"}]})
+        self.assertEqual([(item["id"], item["product_name"])
+                          for item in data["items"]],
+                         [(1, "laptop"), (phone_id, "phone")])
+
+    def test_item_positions(self):
+        """ Items keep their order and move by rewriting one row """
+        wishlist = Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10),
+            Item(product_name="phone", product_id=11)])
+        wishlist.create()
+        wishlist.items.append(Item(product_name="cable", product_id=12))
+        wishlist.save()
+        Item.create_many([Item(wishlist_id=1, product_name="mouse",
+                               product_id=13)])
+        db.session.expunge_all()
+        wishlist = Wishlist.find(1)
+        self.assertEqual([item.product_id for item in wishlist.items],
+                         [10, 11, 12, 13])
+        self.assertEqual([item.position for item in wishlist.items],
+                         ["i", "j", "k", "l"])
+        ids = [item.id for item in wishlist.items]
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        try:
+            moved = Item.move(1, ids[3], None)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record_statement)
+        self.assertEqual(moved["position"], "h")
+        self.assertEqual([sql for sql in statements
+                          if sql.startswith("UPDATE item")],
+                         ["UPDATE item SET position=? WHERE item.id = ?"])
+        Item.move(1, ids[0], ids[1])
+        self.assertIsNone(Item.move(1, 99, None))
+        self.assertRaises(DataValidationError, Item.move, 1, ids[0], 99)
+        self.assertRaises(DataValidationError, Item.move, 1, ids[0], ids[0])
+        db.session.expunge_all()
+        self.assertEqual([item.product_id for item in Wishlist.find(1).items],
+                         [13, 11, 10, 12])
+
+        # equal ranks, as concurrent appends may write, are spread first
+        Item.query.update({Item.position: "i"}, synchronize_session=False)
+        db.session.commit()
+        Item.move(1, ids[0], ids[2])
+        db.session.expunge_all()
+        items = Wishlist.find(1).items
+        self.assertEqual([item.id for item in items],
+                         [ids[1], ids[2], ids[0], ids[3]])
+        self.assertEqual(len({item.position for item in items}), 4)
+        self.assertEqual(Item.spread_positions(1), 3)
+        self.assertEqual(Item.spread_positions(1), 0)
+        db.session.expunge_all()
+        self.assertEqual([item.position for item in Wishlist.find(1).items],
+                         ["77", "ee", "ll", "ss"])
+
+    def test_product_names_cache(self):
+        """ Product names are cached, bounded and expire """
+        Wishlist(name="tech", user_id=1, items=[
+            Item(product_name="laptop", product_id=10),
+            Item(product_name="phone", product_id=11)]).create()
+        product_names.clear()
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            self.assertEqual(product_names.get_many([10, 11, 12]),
+                             {10: "laptop", 11: "phone"})
+            self.assertEqual(product_names.get(10), "laptop")
+            self.assertEqual(len(statements), 1)
+            with patch.object(product_names, "max_size", 1):
+                product_names.clear()
+                product_names.get_many([10, 11])
+                product_names.get(11)
+                self.assertEqual(len(statements), 2)
+                product_names.get(10)
+                self.assertEqual(len(statements), 3)
+            with patch.object(product_names, "ttl", 0):
+                product_names.put({10: "stale"})
+            self.assertEqual(product_names.get(10), "laptop")
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+
+    def test_archive_wishlists(self):
+        """ Disabled and stale wishlists move to the archive with their items """
+        Wishlist(name="old", user_id=1, items=[
+            Item(product_name="laptop", product_id=10)]).create()
+        Wishlist(name="off", user_id=1, status=False, items=[
+            Item(product_name="phone", product_id=11)]).create()
+        Wishlist(name="new", user_id=2).create()
+        db.session.query(Wishlist).filter(Wishlist.id == 1).update(
+            {Wishlist.updated_at: datetime.utcnow() - timedelta(days=800)},
+            synchronize_session=False)
+        db.session.commit()
+        cursor = Change.latest()
+        before = datetime.utcnow() - timedelta(days=730)
+        self.assertEqual(Wishlist.archive(before, 1), (2, 2))
+        self.assertEqual([wishlist.id for wishlist in Wishlist.all()], [3])
+        archived = ArchivedWishlist.find(2)
+        self.assertEqual(archived.serialize()["items"][0]["product_id"], 11)
+        self.assertFalse(archived.status)
+        self.assertEqual(Stats.summary()["items"], 0)
+        self.assertEqual(Stats.for_user(1)["wishlists"], 0)
+        self.assertEqual([change["op"] for change in Change.since(cursor, 10)],
+                         ["archived", "archived"])
+        self.assertEqual(
+            ArchivedWishlist.find_by_filters(user_id=1, product_id=10).count(),
+            1)
+        self.assertEqual(Wishlist.archive(before, 1), (0, 0))
+
+    def test_restore_wishlist(self):
+        """ A restored wishlist is back in the hot tables """
+        Wishlist(name="off", user_id=1, status=False, items=[
+            Item(product_name="phone", product_id=11)]).create()
+        Wishlist.archive(datetime.utcnow() - timedelta(days=1), 10)
+        self.assertTrue(Wishlist.restore(1))
+        self.assertFalse(Wishlist.restore(1))
+        self.assertIsNone(ArchivedWishlist.find(1))
+        wishlist = Wishlist.find(1)
+        self.assertEqual(len(wishlist.items), 1)
+        self.assertGreater(wishlist.updated_at,
+                           datetime.utcnow() - timedelta(minutes=1))
+        self.assertEqual(Stats.summary()["items"], 1)
+
+    def test_item_writes_touch_wishlist(self):
+        """ Adding an item marks its wishlist as updated """
+        wishlist = Wishlist(name="tech", user_id=1)
+        wishlist.create()
+        stale = datetime.utcnow() - timedelta(days=800)
+        db.session.query(Wishlist).update({Wishlist.updated_at: stale},
+                                          synchronize_session=False)
+        db.session.commit()
+        wishlist = Wishlist.find(1)
+        wishlist.items.append(Item(product_name="laptop", product_id=10))
+        wishlist.save()
+        db.session.expire_all()
+        self.assertGreater(Wishlist.find(1).updated_at, stale)
+
+    @staticmethod
+    def _notify_commit():
+        """ Signals a commit as another request would """
+        with Change.committed:
+            Change.committed.notify_all()
+
     def test_serialize_an_item(self):
         """Test Serialize an Item """
         item = Item(product_name='laptop', product_id=1, wishlist_id=1)
@@ -231,6 +837,26 @@ class TestModel(unittest.TestCase):
         item = Item()
         self.assertRaises(DataValidationError, item.deserialize, {})
 
+    def test_deserialize_checks_types(self):
+        """ Ids must be integers and names strings """
+        item = Item().deserialize({"wishlist_id": "3", "product_id": " 7",
+                                   "product_name": "laptop"})
+        self.assertEqual((item.wishlist_id, item.product_id), (3, 7))
+        for data in ({"product_id": "abc"}, {"product_id": True},
+                     {"product_id": None}, {"product_id": 1.5},
+                     {"wishlist_id": "x"}, {"product_name": 5}):
+            document = {"wishlist_id": 1, "product_id": 1,
+                        "product_name": "laptop"}
+            document.update(data)
+            self.assertRaises(DataValidationError, Item().deserialize,
+                              document)
+        wishlist = Wishlist().deserialize({"name": "tech", "user_id": "12"})
+        self.assertEqual(wishlist.user_id, 12)
+        self.assertRaises(DataValidationError, Wishlist().deserialize,
+                          {"name": "tech", "user_id": "abc"})
+        self.assertRaises(DataValidationError, Wishlist().deserialize,
+                          {"name": ["tech"], "user_id": 1})
+
     def test_serialize_a_wishlist(self):
         """ Serialize a wishlist """
         item = Item(product_name='laptop',
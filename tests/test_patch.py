@@ -0,0 +1,83 @@
+"""
+Patch Document Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import unittest
+from service.models import DataValidationError
+from service.patch import apply_merge_patch, apply_json_patch
+
+
+######################################################################
+#  P A T C H   T E S T   C A S E S
+######################################################################
+class TestPatch(unittest.TestCase):
+    """ Tests for JSON Merge Patch and JSON Patch """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.document = {
+            "id": 1,
+            "name": "tech",
+            "status": True,
+            "items": [{"id": 1, "product_id": 10, "product_name": "laptop"},
+                      {"id": 2, "product_id": 11, "product_name": "phone"}]
+        }
+
+    def test_merge_patch(self):
+        """ Apply a merge patch """
+        patched = apply_merge_patch(self.document,
+                                    {"name": "gear", "status": None,
+                                     "items": [{"product_id": 12}]})
+        self.assertEqual(patched["name"], "gear")
+        self.assertNotIn("status", patched)
+        self.assertEqual(patched["items"], [{"product_id": 12}])
+        self.assertEqual(self.document["name"], "tech")
+
+    def test_json_patch(self):
+        """ Apply a JSON patch """
+        patched = apply_json_patch(self.document, [
+            {"op": "test", "path": "/name", "value": "tech"},
+            {"op": "replace", "path": "/name", "value": "gear"},
+            {"op": "remove", "path": "/items/0"},
+            {"op": "add", "path": "/items/-",
+             "value": {"product_id": 12, "product_name": "tv"}},
+            {"op": "replace", "path": "/items/0/product_name", "value": "cell"}
+        ])
+        self.assertEqual(patched["name"], "gear")
+        self.assertEqual([item.get("id") for item in patched["items"]],
+                         [2, None])
+        self.assertEqual(patched["items"][0]["product_name"], "cell")
+        self.assertEqual(len(self.document["items"]), 2)
+
+    def test_json_patch_root(self):
+        """ Replace and test the whole document """
+        replacement = {"name": "gear", "items": []}
+        patched = apply_json_patch(self.document, [
+            {"op": "test", "path": "", "value": self.document},
+            {"op": "replace", "path": "", "value": replacement},
+            {"op": "replace", "path": "/name", "value": "books"}
+        ])
+        self.assertEqual(patched, {"name": "books", "items": []})
+        self.assertEqual(replacement["name"], "gear")
+        self.assertEqual(self.document["name"], "tech")
+
+    def test_json_patch_errors(self):
+        """ Reject bad JSON patches """
+        bad_patches = [
+            {"op": "replace", "path": "/name", "value": "x"},
+            [{"op": "move", "path": "/name", "from": "/status"}],
+            [{"op": "replace", "path": "/missing", "value": 1}],
+            [{"op": "remove", "path": "/items/2"}],
+            [{"op": "add", "path": "name", "value": 1}],
+            [{"op": "add", "path": "/name"}],
+            [{"op": "test", "path": "/name", "value": "other"}],
+            [{"op": "remove", "path": ""}],
+            [{"op": "test", "path": "", "value": {}}],
+            ["replace"]
+        ]
+        for patch in bad_patches:
+            self.assertRaises(DataValidationError, apply_json_patch,
+                              self.document, patch)
@@ -0,0 +1,73 @@
+"""
+Item Positions Test Suite
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+
+import random
+import unittest
+from flask import Flask
+from service.positions import PositionRebalancer, rank_between, spread_ranks
+
+
+######################################################################
+#  P O S I T I O N S   T E S T   C A S E S
+######################################################################
+class TestPositions(unittest.TestCase):
+    """ Tests for fractional ranks and their rebalancing """
+
+    def test_rank_between(self):
+        """ New ranks sort between their neighbours """
+        self.assertEqual(rank_between(), "i")
+        self.assertEqual(rank_between("i"), "j")
+        self.assertEqual(rank_between(None, "i"), "h")
+        self.assertEqual(rank_between("a", "c"), "b")
+        self.assertEqual(rank_between("a", "b"), "ai")
+        self.assertEqual(rank_between("z"), "z1")
+        self.assertEqual(rank_between(None, "1"), "0z")
+
+    def test_random_inserts(self):
+        """ Ranks stay ordered, short and never end with 0 """
+        generator = random.Random(7)
+        ranks = []
+        for _ in range(2000):
+            index = generator.choice([0, len(ranks),
+                                      generator.randint(0, len(ranks))])
+            before = ranks[index - 1] if index else None
+            after = ranks[index] if index < len(ranks) else None
+            rank = rank_between(before, after)
+            self.assertTrue(before is None or before < rank)
+            self.assertTrue(after is None or rank < after)
+            self.assertNotEqual(rank[-1], "0")
+            ranks.insert(index, rank)
+        self.assertLess(max(len(rank) for rank in ranks), 12)
+
+    def test_appends_stay_short(self):
+        """ Appending and prepending grow ranks logarithmically """
+        last = first = None
+        for _ in range(5000):
+            last = rank_between(last)
+            first = rank_between(None, first) if first else rank_between()
+        self.assertLessEqual(len(last), 8)
+        self.assertLessEqual(len(first), 8)
+
+    def test_spread_ranks(self):
+        """ Spread ranks are ascending, distinct and leave room """
+        self.assertEqual(spread_ranks(0), [])
+        self.assertEqual(spread_ranks(5), ["6", "c", "i", "o", "u"])
+        ranks = spread_ranks(1000)
+        self.assertEqual(ranks, sorted(set(ranks)))
+        self.assertTrue(all(len(rank) <= 3 for rank in ranks))
+        self.assertNotIn("0", [rank[-1] for rank in ranks])
+
+    def test_rebalancer(self):
+        """ Wishlists are spread in the background, once while queued """
+        spread = []
+        rebalancer = PositionRebalancer(Flask(__name__), spread.append)
+        rebalancer.request(1)
+        rebalancer.request(2)
+        rebalancer.join()
+        rebalancer.request(1)
+        rebalancer.join()
+        self.assertEqual(spread, [1, 2, 1])